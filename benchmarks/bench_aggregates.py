@@ -0,0 +1,149 @@
+'''
+Aggregate query benchmark over three layouts of the tweet table:
+- v1: string dates, coordinates and flags in one heap, no indexes
+- v2: created_at TIMESTAMPTZ with generated date/time/date_hour,
+  DOUBLE PRECISION coordinates, BOOLEAN flags, still one heap
+- partitioned: v2 as created by schema.create_table, partitioned by day,
+  with the primary key and the (politician, date_hour)/(us_state, date) indexes
+
+All tables are filled with the same synthetic rows in SQL, then the
+queries that build the aggregate sums (aggregates.fill_sums) and some
+narrower dashboard-style queries are timed on each, best of --repeat.
+
+Usage: python benchmarks/bench_aggregates.py --dsn postgresql://postgres:pw@localhost:5555/postgres [--rows N]
+Use a scratch database: the bench_tweets_* tables are dropped and recreated.
+Needs the ETL requirements (etl/requirements_etl.txt).
+'''
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'etl'))
+
+from sqlalchemy import create_engine
+
+import schema
+from aggregates import SUM_TABLES, key_names
+from bulk_load import TWEET_COLUMNS
+
+V1_TABLE = 'bench_tweets_v1'
+V2_TABLE = 'bench_tweets_v2'
+PARTITIONED_TABLE = 'bench_tweets_partitioned'
+TABLES = [V1_TABLE, V2_TABLE, PARTITIONED_TABLE]
+
+# one synthetic tweet per row of generate_series, spread over the collection period
+# (mod() rather than %, which the driver would read as a placeholder)
+SYNTHETIC_ROWS = '''SELECT g::TEXT AS tweet_id, 'user' || mod(g, 50000) AS username, \
+'synthetic tweet text' AS text, 'synthetic tweet text' AS clean_text, \
+'{{}}' AS handles, '{{}}' AS hashtags, mod(g, 10000)::BIGINT AS followers_count, \
+mod(g, 3) = 0 AS was_retweeted, \
+CASE WHEN mod(g, 4) = 0 THEN NULL ELSE 25 + mod(g, 2400) / 100.0 END AS loc_lat, \
+CASE WHEN mod(g, 4) = 0 THEN NULL ELSE -120 + mod(g, 5000) / 100.0 END AS loc_lon, \
+CASE WHEN mod(g, 4) = 0 THEN 'no_loc' ELSE 'user_loc' END AS loc_type, 'somewhere' AS location, \
+'United States of America' AS in_us, \
+(ARRAY['California', 'Texas', 'Florida', 'New York', 'Ohio', 'other'])[1 + mod(g, 6)] AS us_state, \
+(ARRAY['joebiden', 'kamalaharris', 'realdonaldtrump', 'mike_pence'])[1 + mod(g, 4)] AS politician, \
+TIMESTAMPTZ '2020-09-28 00:00:00+00' + mod(g, 3542400) * INTERVAL '1 second' AS created_at, \
+(mod(g, 2001) - 1000) / 1000.0 AS sentiment \
+FROM generate_series(1, {rows}) AS g'''
+
+V1_DDL = '''CREATE TABLE {table} (
+tweet_ID VARCHAR(50), username VARCHAR(50), text TEXT, clean_text TEXT, \
+handles TEXT, hashtags TEXT, followers_count BIGINT, \
+was_retweeted VARCHAR(50), loc_lat VARCHAR(50), loc_lon VARCHAR(50), \
+loc_type VARCHAR(50), location VARCHAR(50), in_us VARCHAR(50), \
+us_state VARCHAR(50), politician VARCHAR(50), date DATE, time VARCHAR(15), \
+date_hour VARCHAR(15), sentiment REAL, extracted VARCHAR(5) );'''
+
+# label: (v1 query, v2 query); {table} is filled in per layout
+QUERIES = dict(
+    [(f'fill {sum_table}', (f'SELECT {key_names(sum_table)}, SUM(sentiment), COUNT(*) '
+                            f'FROM {{table}} GROUP BY {key_names(sum_table)}',) * 2)
+     for sum_table in SUM_TABLES] + [
+        ('one politician, hourly', ("SELECT date_hour, AVG(sentiment) FROM {table} "
+                                    "WHERE politician = 'mike_pence' GROUP BY date_hour",) * 2),
+        ('located tweets per state', ("SELECT us_state, COUNT(*) FROM {table} "
+                                      "WHERE loc_lat <> 'no_loc' GROUP BY us_state",
+                                      "SELECT us_state, COUNT(*) FROM {table} "
+                                      "WHERE loc_lat IS NOT NULL GROUP BY us_state")),
+        ('one day, hourly per politician', (
+            "SELECT date_hour, politician, AVG(sentiment) FROM {table} "
+            "WHERE date = '2020-11-03' GROUP BY date_hour, politician",
+            "SELECT date_hour, politician, AVG(sentiment) FROM {table} "
+            "WHERE created_at >= '2020-11-03 00:00:00+00' AND created_at < '2020-11-04 00:00:00+00' "
+            "GROUP BY date_hour, politician")),
+        ('one state, one day', ("SELECT politician, AVG(sentiment) FROM {table} "
+                                "WHERE us_state = 'Ohio' AND date = '2020-11-03' "
+                                "GROUP BY politician",) * 2),
+    ])
+
+
+def fill_tables(db_pg, rows):
+    '''
+    Creates the three tables and fills them with the same synthetic rows
+    '''
+    for table in TABLES:
+        db_pg.execute(f'DROP TABLE IF EXISTS {table};')
+    db_pg.execute(V1_DDL.format(table=V1_TABLE))
+    db_pg.execute(f'''INSERT INTO {V1_TABLE} SELECT tweet_id, username, text, clean_text, \
+    handles, hashtags, followers_count, was_retweeted::TEXT, \
+    COALESCE(loc_lat::TEXT, 'no_loc'), COALESCE(loc_lon::TEXT, 'no_loc'), loc_type, location, \
+    in_us, us_state, politician, (created_at AT TIME ZONE 'UTC')::DATE, \
+    to_char(created_at AT TIME ZONE 'UTC', 'HH24:MI:SS'), \
+    to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24'), sentiment, 'yes' \
+    FROM ({SYNTHETIC_ROWS.format(rows=rows)}) AS synthetic;''')
+    schema.create_table(PARTITIONED_TABLE, db_pg)
+    days = [day for (day,) in db_pg.execute(f"""SELECT DISTINCT (created_at AT TIME ZONE 'UTC')::DATE \
+    FROM ({SYNTHETIC_ROWS.format(rows=rows)}) AS synthetic;""").fetchall()]
+    schema.ensure_partitions(PARTITIONED_TABLE, db_pg, days)
+    db_pg.execute(f'''CREATE TABLE {V2_TABLE} \
+    (LIKE {PARTITIONED_TABLE} INCLUDING DEFAULTS INCLUDING GENERATED);''')
+    for table in (V2_TABLE, PARTITIONED_TABLE):
+        db_pg.execute(f'''INSERT INTO {table} ({', '.join(TWEET_COLUMNS)}) \
+        SELECT *, 'yes' FROM ({SYNTHETIC_ROWS.format(rows=rows)}) AS synthetic;''')
+    for table in TABLES:
+        db_pg.execute(f'VACUUM ANALYZE {table};')
+
+
+def best_time(db_pg, query, repeat):
+    '''
+    Runs query repeat times, returns the fastest run in seconds
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db_pg.execute(query).fetchall()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    '''
+    Prints table sizes and query timings for each layout
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    db_pg = create_engine(args.dsn, echo=False, isolation_level='AUTOCOMMIT')
+    fill_tables(db_pg, args.rows)
+
+    for table in TABLES:
+        size = db_pg.execute(f"SELECT pg_size_pretty(pg_total_relation_size('{table}'));").scalar()
+        if table == PARTITIONED_TABLE:
+            size = db_pg.execute(f"""SELECT pg_size_pretty(SUM(pg_total_relation_size(inhrelid))) \
+            FROM pg_inherits WHERE inhparent = to_regclass('{table}');""").scalar()
+        print(f'{table:<26} {args.rows} rows, {size}')
+    print(f'{"query":<32}' + ''.join(f'{table[len("bench_tweets_"):]:>14}' for table in TABLES))
+    for label, (v1_query, v2_query) in QUERIES.items():
+        timings = [best_time(db_pg, (v1_query if table == V1_TABLE else v2_query).format(table=table),
+                             args.repeat) for table in TABLES]
+        print(f'{label:<32}' + ''.join(f'{timing * 1000:11.1f} ms' for timing in timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+'''
+Threaded vs asyncio collector, both against the local HTTP stubs.
+
+The runtimes get the same payloads, rate and ArcGIS stub (http_stubs.py,
+--geocode-latency per request):
+- threads: replay.run_collection, i.e. TwitterListener.on_data ->
+  IngestPool -> process_tweet -> TweetWriter, geocoding with
+  geocoder.arcgis pointed at the stub (a new connection per call)
+- asyncio: AsyncCollector reading the stub's filter stream over HTTP and
+  geocoding over its shared keep-alive session
+
+Per runtime it prints the stage table (collect: throughput over the run,
+latency = processing time per payload, as in replay.py; for asyncio also
+arrival: from reading the payload off the stream to the write buffer,
+queueing included) and the counters, among them the geocoder requests and
+the TCP connections they came in on.
+
+Usage: python benchmarks/bench_async_collector.py [--tweets N] [--rate R] [--workers N]
+           [--async-workers N] [--geocode-concurrency N] [--geocode-latency SECONDS] ...
+Needs the collector requirements (aiohttp, oauthlib and motor included),
+plus mongomock unless --mongo-uri is given.
+'''
+import argparse
+import asyncio
+import logging
+import time
+
+# replay puts etl, tweet_collect, common and benchmarks on sys.path (in that order)
+from replay import add_collection_args, get_payloads, run_collection
+
+import aiohttp
+
+import async_collector
+import election_tweets
+import geocache
+from async_collector import AsyncCollector, ensure_indexes
+from geocache import GeoCache
+from scheduler import QuotaScheduler
+
+from http_stubs import StubServer
+from stage_report import StageReport
+from standins import AsyncCollection, mongo_collection
+
+# the whole run is one stream window
+RUNTIME = 24 * 60 * 60
+
+
+class HTTPLookup():
+    '''
+    geocache.arcgis_lookup (the geocoder package, against the stub), counting calls
+    '''
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, location):
+        self.calls += 1
+        return geocache.arcgis_lookup(location)
+
+
+class TimedCollector(AsyncCollector):
+    '''
+    Keeps the processing time and the arrival-to-buffer time of every payload
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        self.arrivals = []
+
+    async def process(self, item):
+        started = time.perf_counter()
+        await super().process(item)
+        finished = time.perf_counter()
+        self.latencies.append(finished - started)
+        self.arrivals.append(finished - item[2])
+
+
+def run_threads(payloads, args, report):
+    '''
+    The threaded collector; payloads are replayed at --rate, ArcGIS is the stub
+    '''
+    server = StubServer(latency=args.geocode_latency).start()
+    geocache.ARCGIS_URL = server.geocode_url
+    try:
+        counters = run_collection(payloads, mongo_collection(args.mongo_uri), report, args.rate,
+                                  args.workers, args.policy, HTTPLookup())
+    finally:
+        server.stop()
+    counters['stubs'] = server.stats()
+    return counters
+
+
+async def collect(payloads, args, report, server):
+    '''
+    One long window of the async collector, stopped once every payload has arrived
+    '''
+    if args.mongo_uri:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        mongo_collection(args.mongo_uri)
+        collection = AsyncIOMotorClient(args.mongo_uri).tweet_benchmark.tweet
+    else:
+        collection = AsyncCollection(mongo_collection())
+    await ensure_indexes(collection)
+    connector = aiohttp.TCPConnector(limit=async_collector.HTTP_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        collector = TimedCollector(session, collection,
+                                   QuotaScheduler(election_tweets.SEARCHTERMS), server.stream_url,
+                                   server.geocode_url, args.async_workers, args.policy,
+                                   args.geocode_concurrency)
+        collector.tweet_writer.start()
+        collector.ingest_pool.start()
+        started = time.perf_counter()
+        window = asyncio.ensure_future(collector.window(None, RUNTIME))
+        while collector.ingest_pool.counters['submitted'] < len(payloads):
+            await asyncio.sleep(0.01)
+        collector.stop()
+        await window
+        await collector.ingest_pool.stop()
+        await collector.tweet_writer.close()
+        elapsed = time.perf_counter() - started
+    report.record('collect', len(payloads), elapsed, collector.latencies)
+    report.record('arrival', len(collector.arrivals), elapsed, collector.arrivals)
+    counters = collector.stats()
+    counters['collected'] = collector.scheduler.collected()
+    return counters
+
+
+def run_async(payloads, args, report):
+    '''
+    The async collector; the stub streams the payloads at --rate
+    '''
+    election_tweets.GEOCODE_CACHE = GeoCache(path=None)
+    server = StubServer(payloads, args.rate, args.geocode_latency).start()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        counters = loop.run_until_complete(collect(payloads, args, report, server))
+    finally:
+        loop.close()
+        server.stop()
+    counters['stubs'] = server.stats()
+    return counters
+
+
+def main():
+    '''
+    Runs both collectors on the same payloads and prints their reports
+    '''
+    parser = argparse.ArgumentParser()
+    add_collection_args(parser)
+    parser.add_argument('--async-workers', type=int, default=async_collector.WORKERS)
+    parser.add_argument('--geocode-concurrency', type=int,
+                        default=async_collector.GEOCODE_CONCURRENCY)
+    args = parser.parse_args()
+    payloads = get_payloads(args)
+    logging.disable(logging.CRITICAL)
+    results = []
+    try:
+        for name, run in (('threads', run_threads), ('asyncio', run_async)):
+            report = StageReport()
+            results.append((name, report, run(payloads, args, report)))
+    finally:
+        logging.disable(logging.NOTSET)
+    for name, report, counters in results:
+        print(f'\n== {name} ==')
+        report.print()
+        for counter, value in counters.items():
+            print(f'{counter}: {value}')
+
+
+if __name__ == '__main__':
+    main()
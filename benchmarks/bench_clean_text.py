@@ -0,0 +1,109 @@
+'''
+Text cleaning benchmark and golden-output check.
+
+Compares the former per-tweet implementation (REFERENCE_*, copied from
+election_etl before batching) with the current get_handles_hashtags +
+clean_texts path on the synthetic corpus from bench_transform_scaling plus
+EDGE_CASES, fails if any output differs, and reports per-tweet latency.
+
+Usage: python benchmarks/bench_clean_text.py [--tweets N]
+Needs the ETL requirements (etl/requirements_etl.txt).
+'''
+import argparse
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'etl'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import election_etl
+from bench_transform_scaling import make_corpus
+
+EDGE_CASES = [
+    '',
+    '\n',
+    'RT @JoeBiden: we did it!\n\n#Election2020 https://t.co/abc123',
+    'amp &amp; amp; AMP Amp RT rt',
+    'email me at someone@example.com or @someone_else',
+    'a#b c@d #e@f @g#h ##double @@double',
+    'link http://example.com/@user/#tag and https://x.co/#frag',
+    'httpsfoo https https: https://',
+    'Vote!!! #VOTE #vote @Vote vote...',
+    'Emoji \U0001F1FA\U0001F1F8 #USA — café @café #mañana',
+    '"quoted" (parens) [brackets] {braces} - -- --- ... …',
+    'tab\tseparated\r\nwindows line @end',
+    '@start of the tweet and #end',
+    '1,000 votes at 9:30pm on 11/03/2020 for $5.00 #2020',
+]
+
+
+def reference_get_handles_hashtags(text):
+    handles = re.findall('\\B\\@\\w+', text)
+    hashtags = re.findall('\\B\\#\\w+', text)
+    return handles, hashtags
+
+
+def reference_clean_text(text, handles, hashtags):
+    combined = handles + hashtags + ['RT', 'amp', '\n']
+    doc = election_etl.NLP(text)
+    stripped = [token.orth_ for token in doc if not token.is_punct]
+    cleaned = [str(word) for word in stripped if word not in combined and not word.startswith('https')]
+    cleaned = ' '.join(cleaned)
+    return cleaned
+
+
+def run_reference(texts):
+    '''
+    Former path: one regex pass per entity type and one NLP() call per tweet
+    '''
+    results = []
+    for text in texts:
+        handles, hashtags = reference_get_handles_hashtags(text)
+        results.append((handles, hashtags, reference_clean_text(text, handles, hashtags)))
+    return results
+
+
+def run_current(texts):
+    '''
+    Current path: single-scan entities and batched tokenization
+    '''
+    entities = [election_etl.get_handles_hashtags(text) for text in texts]
+    cleaned = election_etl.clean_texts(texts, [handles for handles, _ in entities],
+                                       [hashtags for _, hashtags in entities])
+    return [(handles, hashtags, clean) for (handles, hashtags), clean in zip(entities, cleaned)]
+
+
+def main():
+    '''
+    Checks both paths agree, then times them
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tweets', type=int, default=20000)
+    args = parser.parse_args()
+    texts = EDGE_CASES + [tweet.text for tweet in make_corpus(args.tweets)]
+
+    timings = {}
+    outputs = {}
+    for name, run in (('reference', run_reference), ('current', run_current)):
+        start = time.perf_counter()
+        outputs[name] = run(texts)
+        timings[name] = time.perf_counter() - start
+
+    mismatches = [(text, expected, got) for text, expected, got
+                  in zip(texts, outputs['reference'], outputs['current']) if expected != got]
+    for text, expected, got in mismatches[:10]:
+        print(f'MISMATCH {text!r}\n  expected {expected!r}\n  got      {got!r}')
+    print(f'{len(texts)} texts, {len(mismatches)} mismatches')
+    for name, elapsed in timings.items():
+        print(f'{name:10s} {elapsed:7.2f} s  {elapsed / len(texts) * 1e6:8.1f} us/tweet')
+    print(f'speedup x{timings["reference"] / timings["current"]:.2f}')
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Accuracy/speed benchmark: offline gazetteer vs. the ArcGIS results
+recorded in data-analysis/location_random_sample_13012021.csv
+
+Usage: python benchmarks/bench_gazetteer.py [--arcgis N]
+--arcgis N also times N live ArcGIS lookups (needs network and geocoder)
+'''
+import argparse
+import csv
+import math
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'tweet_collect'))
+
+from gazetteer import Gazetteer
+
+SAMPLE_PATH = os.path.join(ROOT, 'data-analysis', 'location_random_sample_13012021.csv')
+AGREE_KM = 50
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    '''
+    Great-circle distance between two points
+    '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    hav = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * math.asin(math.sqrt(hav))
+
+
+def load_sample():
+    '''
+    Returns the labelled rows that went through the remote geocoder
+    '''
+    with open(SAMPLE_PATH, newline='', encoding='utf-8') as sample_file:
+        return [row for row in csv.DictReader(sample_file) if row['loc_type'] == 'user_loc']
+
+
+def bench_gazetteer(rows):
+    '''
+    Resolves every sample location offline and compares with ArcGIS
+    '''
+    start = time.perf_counter()
+    gazetteer = Gazetteer()
+    build_ms = (time.perf_counter() - start) * 1000
+
+    hits = agree = 0
+    clean_hits = clean_total = 0
+    start = time.perf_counter()
+    results = [gazetteer.resolve(row['location']) for row in rows]
+    elapsed = time.perf_counter() - start
+
+    for row, coords in zip(rows, results):
+        clean = row['unclear_loc'] == '0'
+        clean_total += clean
+        if coords is None:
+            continue
+        hits += 1
+        clean_hits += clean
+        if distance_km(coords[0], coords[1], float(row['loc_lat']), float(row['loc_lon'])) <= AGREE_KM:
+            agree += 1
+
+    print(f'gazetteer build:        {build_ms:.1f} ms')
+    print(f'locations:              {len(rows)}')
+    print(f'offline hits:           {hits} ({hits / len(rows):.1%})')
+    print(f'hits on clear locations: {clean_hits}/{clean_total} ({clean_hits / clean_total:.1%})')
+    print(f'agree with ArcGIS (<{AGREE_KM} km): {agree}/{hits} ({agree / max(hits, 1):.1%})')
+    print(f'mean lookup:            {elapsed / len(rows) * 1e6:.1f} us')
+
+
+def bench_arcgis(rows, count):
+    '''
+    Times live ArcGIS lookups for comparison
+    '''
+    import geocoder
+    start = time.perf_counter()
+    for row in rows[:count]:
+        geocoder.arcgis(row['location'])
+    elapsed = time.perf_counter() - start
+    print(f'mean ArcGIS lookup:     {elapsed / count * 1e3:.1f} ms ({count} calls)')
+
+
+def main():
+    '''
+    Runs the benchmark
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arcgis', type=int, default=0)
+    args = parser.parse_args()
+    rows = load_sample()
+    bench_gazetteer(rows)
+    if args.arcgis:
+        bench_arcgis(rows, args.arcgis)
+
+
+if __name__ == '__main__':
+    main()
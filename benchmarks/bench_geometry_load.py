@@ -0,0 +1,49 @@
+'''
+Cold-start benchmark for boundary geometry:
+download + build (what every ETL start used to do at import)
+vs. reading the cached WKB file, plus building the state index.
+
+Usage: python benchmarks/bench_geometry_load.py
+The download step needs network access; it also (re)writes the cache file.
+'''
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'etl'))
+
+import geometry
+from state_index import StateIndex
+
+
+def timed(label, function, *args):
+    '''
+    Runs function once and prints how long it took
+    '''
+    start = time.perf_counter()
+    result = function(*args)
+    print(f'{label:<28} {(time.perf_counter() - start) * 1000:9.1f} ms')
+    return result
+
+
+def main():
+    '''
+    Times each way of getting to a usable state index
+    '''
+    try:
+        boundaries = timed('download + build polygons', geometry.download_boundaries)
+        timed('write cache file', geometry.save_boundaries, *boundaries)
+    except OSError as err:
+        print(f'download skipped: {err}')
+    if not os.path.exists(geometry.BOUNDARY_PATH):
+        print(f'no cache file at {geometry.BOUNDARY_PATH}; run with network access first')
+        return
+    print(f'cache file size              {os.path.getsize(geometry.BOUNDARY_PATH) / 1024:9.1f} kB')
+    boundaries = timed('read cache file', geometry.read_boundaries)
+    timed('build state index', StateIndex, *boundaries)
+
+
+if __name__ == '__main__':
+    main()
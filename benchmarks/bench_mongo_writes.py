@@ -0,0 +1,133 @@
+'''
+Throughput benchmark: per-tweet find().count() + insert_one
+vs. the buffered TweetWriter (insert_many + unique index)
+
+Usage: python benchmarks/bench_mongo_writes.py [--uri mongodb://localhost:27017] [--tweets N]
+           [--latency SECONDS]
+Use --uri with a local mongod for real numbers. Without it the benchmark
+runs against mongomock (pip install mongomock), with --latency seconds
+(default 0.5 ms, a round-trip to a mongod on the same host) added to every
+call, since the round-trips are what the buffered writer saves: mongomock
+alone is an in-process dict, where the per-tweet path costs nothing extra.
+mongomock checks unique indexes by scanning the collection, so both paths
+slow down quadratically there; keep --tweets small without --uri.
+The first line of the output names the backend.
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'tweet_collect'))
+
+from mongo_writer import TweetWriter, ensure_indexes
+
+from standins import RoundTripCollection
+
+DUPLICATE_SHARE = 0.1
+# seconds per call added to mongomock
+LATENCY = 0.0005
+
+
+def make_tweets(count):
+    '''
+    Returns collector-shaped tweet documents, some of them repeated
+    '''
+    tweets = []
+    for number in range(count):
+        if tweets and random.random() < DUPLICATE_SHARE:
+            tweets.append(dict(random.choice(tweets)))
+            tweets[-1].pop('_id', None)
+            continue
+        tweets.append({
+            'text': f'synthetic tweet {number} about the debate #debates2020',
+            'username': f'user{number % 5000}',
+            'followers_count': number % 10000,
+            'was_retweeted': 'false',
+            'timestamp': 'Wed Oct 07 01:23:45 +0000 2020',
+            'tweet_ID': str(1313000000000000000 + number),
+            'loc_lat': 40.71455,
+            'loc_lon': -74.00714,
+            'loc_type': 'user_loc',
+            'location': 'NYC',
+            'politician': 'joebiden',
+            'extracted': 'no'
+        })
+    return tweets
+
+
+def get_collection(uri, name, latency):
+    '''
+    Returns an empty collection on mongod, or on mongomock with latency per call
+    '''
+    if uri:
+        from pymongo import MongoClient
+        client = MongoClient(uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    collection = client.tweet_benchmark[name]
+    collection.drop()
+    if not uri and latency:
+        return RoundTripCollection(collection, latency)
+    return collection
+
+
+def bench_per_tweet(collection, tweets):
+    '''
+    The old on_data path: one dedup query and one insert per tweet
+    '''
+    start = time.perf_counter()
+    for tweet in tweets:
+        tweet = dict(tweet)
+        if collection.count_documents({'tweet_ID': tweet['tweet_ID']}, limit=1) == 0:
+            collection.insert_one(tweet)
+    return time.perf_counter() - start
+
+
+def bench_writer(collection, tweets):
+    '''
+    The buffered path: recent-ID set, insert_many, unique index
+    '''
+    ensure_indexes(collection)
+    writer = TweetWriter(collection)
+    start = time.perf_counter()
+    for tweet in tweets:
+        if not writer.seen(tweet['tweet_ID']):
+            writer.add(dict(tweet))
+    writer.close()
+    return time.perf_counter() - start
+
+
+def main():
+    '''
+    Runs both paths on the same tweets and reports tweets/second
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', default=None)
+    parser.add_argument('--tweets', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=LATENCY,
+                        help='without --uri: simulated round-trip per call, in seconds')
+    args = parser.parse_args()
+    tweets = make_tweets(args.tweets)
+    if args.uri:
+        print(f'backend: mongod at {args.uri}')
+    else:
+        print(f'backend: mongomock, {args.latency * 1000:g} ms simulated round-trip per call')
+
+    old_collection = get_collection(args.uri, 'per_tweet', args.latency)
+    elapsed = bench_per_tweet(old_collection, tweets)
+    print(f'per-tweet find+insert: {len(tweets) / elapsed:10.0f} tweets/s '
+          f'({old_collection.count_documents({})} stored)')
+
+    new_collection = get_collection(args.uri, 'buffered', args.latency)
+    elapsed = bench_writer(new_collection, tweets)
+    print(f'buffered insert_many:  {len(tweets) / elapsed:10.0f} tweets/s '
+          f'({new_collection.count_documents({})} stored)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+'''
+End-to-end pipeline benchmark on stand-ins.
+
+Raw payloads (synthetic, or --recorded) are replayed through the collector
+into Mongo (mongomock or --mongo-uri), then the ETL runs over the
+collection batch by batch into Postgres (RecordingPostgres or --pg-dsn).
+Prints throughput and latency per stage:
+
+  stream      TwitterListener.on_data, per payload (stream thread)
+  collect     ingest pool + process_tweet + TweetWriter, end to end; latency per tweet
+  extract     extract() + mark_extracted(), per batch
+  transform   text cache + (parallel) transform, per batch
+  load        COPY/upsert into tweet_pg, per batch (without the aggregate hooks)
+  aggregate   capture_previous + apply_deltas inside the load transaction, per batch
+  batches     batch_state bookkeeping (open, transformed, loaded, marked), per batch
+
+Without --pg-dsn, load measures the client side only (row formatting and the
+COPY buffer) and aggregate is near zero: pass a scratch database to see
+server-side costs. tweet_pg and the aggregate tables in it are created or
+reused as the ETL would.
+
+Usage: python benchmarks/bench_pipeline.py [--tweets N] [--rate R] [--batch-size N]
+                                           [--transform-workers N] [--pg-dsn DSN] ...
+Needs both services' requirements, plus mongomock unless --mongo-uri is given.
+'''
+import argparse
+import functools
+import logging
+import time
+from datetime import timezone
+
+# replay puts etl, tweet_collect, common and benchmarks on sys.path (in that order)
+from replay import add_collection_args, get_payloads, run_collection
+
+import batch_state
+import election_etl
+import geometry
+import metrics
+import parallel_transform
+from aggregates import apply_deltas, capture_previous, create_aggregates
+from bulk_load import bulk_load, tweet_rows
+from schema import create_table, ensure_partitions
+from text_cache import TextCache
+
+from stage_report import StageReport
+from standins import RecordingPostgres, StubGeocoder, mongo_collection
+
+PG_TABLE = 'tweet_pg'
+
+
+def get_postgres(dsn):
+    '''
+    A scratch Postgres with the ETL's tables, or RecordingPostgres
+    '''
+    if not dsn:
+        return RecordingPostgres()
+    from sqlalchemy import create_engine
+    db_pg = create_engine(dsn, echo=False)
+    create_table(PG_TABLE, db_pg)
+    create_aggregates(PG_TABLE, db_pg)
+    batch_state.create_batch_table(db_pg)
+    return db_pg
+
+
+def after_upsert(hooks, state_hook, batch_id, cursor, pg_table_name, stage_name):
+    '''
+    election_etl.load's hook: the aggregate deltas, then the batch's move to 'loaded'
+    '''
+    hooks.wrap(apply_deltas)(cursor, pg_table_name, stage_name)
+    state_hook.wrap(batch_state.record_loaded)(cursor, batch_id)
+
+
+def run_etl(collection, db_pg, report, batch_size, workers, chunk_size):
+    '''
+    Runs extract -> transform -> load (+ aggregates) until the collection is drained
+    Returns the text cache statistics
+    '''
+    analysis_cache = TextCache()
+    checkpoint = None
+    while True:
+        started = time.perf_counter()
+        extracted_tweets = election_etl.extract(collection, checkpoint, batch_size)
+        extract_seconds = time.perf_counter() - started
+        if not extracted_tweets:
+            break
+        count = len(extracted_tweets)
+        bookkeeping = metrics.Stopwatch()
+        batch_id = bookkeeping.wrap(batch_state.open_batch)(db_pg, extracted_tweets)
+
+        started = time.perf_counter()
+        analysis_cache.fill(extracted_tweets)
+        transformed_tweets = parallel_transform.parallel_transform(
+            election_etl.transform, extracted_tweets, workers, chunk_size)
+        transform_seconds = time.perf_counter() - started
+        report.record('transform', count, transform_seconds, [transform_seconds])
+        bookkeeping.wrap(batch_state.set_state)(db_pg, batch_id, 'transformed')
+
+        hooks = metrics.Stopwatch()
+        state_hook = metrics.Stopwatch()
+        started = time.perf_counter()
+        ensure_partitions(PG_TABLE, db_pg, {tweet.created_at.astimezone(timezone.utc).date()
+                                            for tweet in transformed_tweets})
+        bulk_load(tweet_rows(transformed_tweets), PG_TABLE, db_pg,
+                  before_upsert=hooks.wrap(capture_previous),
+                  after_upsert=functools.partial(after_upsert, hooks, state_hook, batch_id))
+        load_seconds = time.perf_counter() - started - hooks.seconds - state_hook.seconds
+        report.record('load', count, load_seconds, [load_seconds])
+        report.record('aggregate', count, hooks.seconds, [hooks.seconds])
+
+        started = time.perf_counter()
+        checkpoint = election_etl.mark_extracted(collection, extracted_tweets)
+        analysis_cache.store(transformed_tweets)
+        extract_seconds += time.perf_counter() - started
+        report.record('extract', count, extract_seconds, [extract_seconds])
+        bookkeeping.wrap(batch_state.record_marked)(db_pg, batch_id)
+        bookkeeping_seconds = bookkeeping.seconds + state_hook.seconds
+        report.record('batches', count, bookkeeping_seconds, [bookkeeping_seconds])
+    return analysis_cache.stats()
+
+
+def main():
+    '''
+    Collect, then ETL, then print the per-stage report
+    '''
+    parser = argparse.ArgumentParser()
+    add_collection_args(parser)
+    parser.add_argument('--batch-size', type=int, default=election_etl.EXTRACT_BATCH_SIZE)
+    parser.add_argument('--transform-workers', type=int, default=1)
+    parser.add_argument('--transform-chunk-size', type=int, default=parallel_transform.CHUNK_SIZE)
+    parser.add_argument('--pg-dsn', help='scratch Postgres instead of RecordingPostgres')
+    parser.add_argument('--fetch-boundaries', action='store_true')
+    args = parser.parse_args()
+    geometry.ALLOW_DOWNLOAD = args.fetch_boundaries
+    geometry.get_state_index()
+
+    payloads = get_payloads(args)
+    collection = mongo_collection(args.mongo_uri)
+    db_pg = get_postgres(args.pg_dsn)
+    report = StageReport()
+    logging.disable(logging.CRITICAL)
+    try:
+        counters = run_collection(payloads, collection, report, args.rate, args.workers,
+                                  args.policy, StubGeocoder(args.geocode_latency))
+        counters['text_cache'] = run_etl(collection, db_pg, report, args.batch_size,
+                                         args.transform_workers, args.transform_chunk_size)
+    finally:
+        parallel_transform.close_pool()
+        logging.disable(logging.NOTSET)
+    report.print()
+    for name, value in counters.items():
+        print(f'{name}: {value}')
+    if isinstance(db_pg, RecordingPostgres):
+        print(f'postgres stand-in: {db_pg.statements} statements, {db_pg.commits} commits, '
+              f'{db_pg.copied_bytes} bytes copied')
+
+
+if __name__ == '__main__':
+    main()
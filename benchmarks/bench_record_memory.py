@@ -0,0 +1,178 @@
+'''
+Peak memory of an extracted + transformed backlog: full pymongo documents
+widened in place (as before TweetRecord) vs. TweetRecords.
+
+Each representation is measured in a fresh process: documents are decoded
+one by one (as the cursor hands them over, every retweet's text a separate
+string), then analysed the way transform does it (once per distinct text,
+timestamps parsed once per distinct value). Reports the growth of peak RSS
+(ru_maxrss) over the process baseline, per 100k tweets.
+
+The analysis itself is a cheap stand-in (regex entities, a cleaned copy of
+the text, a fixed score), so this only needs the standard library.
+
+Usage: python benchmarks/bench_record_memory.py [--tweets N] [--retweet-share 0.4]
+'''
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'etl'))
+
+from tweet_record import TweetRecord
+
+ENTITY_PATTERN = re.compile(r'\B[@#]\w+')
+WORDS = ('the vote count is in and the debate was a disaster for the campaign tonight '
+         'great rally economy jobs healthcare taxes election fraud win lose america').split()
+HANDLES = ['@JoeBiden', '@KamalaHarris', '@realDonaldTrump', '@Mike_Pence', '@CNN', '@FoxNews']
+HASHTAGS = ['#Election2020', '#Debates2020', '#MAGA', '#BidenHarris2020', '#Vote']
+LOCATIONS = ['California', 'Texas, USA', 'New York, NY', 'Philadelphia, PA', 'London',
+             'hell since 2016', 'Florida', 'Ohio', 'Earth']
+POLITICIANS = ['joe biden', 'kamala harris', 'donald trump', 'mike pence']
+STATES = ['California', 'Texas', 'New York', 'Pennsylvania', 'Florida', 'Ohio', 'other', 'no_loc']
+VIRAL_POOL = 50
+
+
+def make_text(rng):
+    '''
+    A tweet text of typical length with a handle and two hashtags
+    '''
+    words = rng.sample(WORDS, 14) + rng.sample(HANDLES, 1) + rng.sample(HASHTAGS, 2)
+    rng.shuffle(words)
+    return ' '.join(words) + ' https://t.co/' + format(rng.getrandbits(40), 'x')
+
+
+def raw_documents(size, retweet_share, seed=0):
+    '''
+    Yields collector documents as JSON, one at a time (decoded separately, like BSON)
+    '''
+    rng = random.Random(seed)
+    viral = [make_text(rng) for _ in range(VIRAL_POOL)]
+    for number in range(size):
+        text = rng.choice(viral) if rng.random() < retweet_share else make_text(rng)
+        yield json.dumps({
+            '_id': '%024x' % number,
+            'text': text,
+            'username': 'user' + str(rng.randrange(1000000)),
+            'followers_count': rng.randint(0, 10000),
+            'was_retweeted': 'true' if rng.random() < retweet_share else 'false',
+            'timestamp': 'Tue Oct 20 21:%02d:%02d +0000 2020' % (number // 3000 % 60,
+                                                                number // 50 % 60),
+            'tweet_ID': str(1318000000000000000 + number),
+            'loc_lat': str(rng.uniform(25, 48)), 'loc_lon': str(rng.uniform(-122, -70)),
+            'loc_type': 'user_loc', 'location': rng.choice(LOCATIONS),
+            'politician': rng.choice(POLITICIANS), 'extracted': 'no'})
+
+
+def analyse(texts):
+    '''
+    Stand-in for analyse_texts: {text: (handles, hashtags, clean_text, sentiment)}
+    '''
+    analysed = {}
+    for text in texts:
+        if text not in analysed:
+            entities = ENTITY_PATTERN.findall(text)
+            handles = tuple(entity for entity in entities if entity[0] == '@')
+            hashtags = tuple(entity for entity in entities if entity[0] == '#')
+            clean = ' '.join(word for word in text.split() if word not in entities)
+            analysed[text] = (handles, hashtags, clean, 0.1)
+    return analysed
+
+
+def timestamps(values):
+    '''
+    One datetime per distinct timestamp, as parse_timestamps does
+    '''
+    parsed = {}
+    for value in values:
+        if value not in parsed:
+            parsed[value] = datetime.strptime(value, '%a %b %d %H:%M:%S %z %Y')
+    return [parsed[value] for value in values]
+
+
+def hold_documents(payloads):
+    '''
+    The former representation: list(cursor) of full documents, widened by transform
+    '''
+    tweets = [json.loads(payload) for payload in payloads]
+    analysed = analyse(tweet['text'] for tweet in tweets)
+    for tweet, created_at in zip(tweets, timestamps([tweet['timestamp'] for tweet in tweets])):
+        handles, hashtags, tweet['clean_text'], tweet['sentiment'] = analysed[tweet['text']]
+        tweet['handles'] = list(handles)
+        tweet['hashtags'] = list(hashtags)
+        tweet['created_at'] = created_at
+        tweet['loc_lat'] = float(tweet['loc_lat'])
+        tweet['loc_lon'] = float(tweet['loc_lon'])
+        tweet['was_retweeted'] = tweet['was_retweeted'] == 'true'
+        tweet['in_us'] = 'USA'
+        tweet['us_state'] = STATES[len(tweet['text']) % len(STATES)]
+    return tweets
+
+
+def hold_records(payloads):
+    '''
+    TweetRecords, transformed as election_etl.transform does
+    '''
+    tweets = [TweetRecord.from_document(json.loads(payload)) for payload in payloads]
+    analysed = analyse(tweet.text for tweet in tweets)
+    for tweet, created_at in zip(tweets, timestamps([tweet.timestamp for tweet in tweets])):
+        tweet.handles, tweet.hashtags, tweet.clean_text, tweet.sentiment = analysed[tweet.text]
+        tweet.created_at = created_at
+        tweet.loc_lat = float(tweet.loc_lat)
+        tweet.loc_lon = float(tweet.loc_lon)
+        tweet.was_retweeted = tweet.was_retweeted == 'true'
+        tweet.in_us = 'USA'
+        tweet.us_state = STATES[len(tweet.text) % len(STATES)]
+    return tweets
+
+
+def peak_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(mode, size, retweet_share):
+    '''
+    Runs in the child process: prints the peak RSS growth in KiB
+    '''
+    baseline = peak_rss_kib()
+    hold = hold_documents if mode == 'documents' else hold_records
+    tweets = hold(raw_documents(size, retweet_share))
+    print(peak_rss_kib() - baseline, len(tweets))
+
+
+def main():
+    '''
+    Measures both representations in fresh processes and compares them
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tweets', type=int, default=100000)
+    parser.add_argument('--retweet-share', type=float, default=0.4)
+    parser.add_argument('--child', choices=['documents', 'records'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        measure(args.child, args.tweets, args.retweet_share)
+        return
+    results = {}
+    for mode in ('documents', 'records'):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', mode, '--tweets',
+             str(args.tweets), '--retweet-share', str(args.retweet_share)],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        growth = int(output.split()[0])
+        results[mode] = growth
+        print(f'{mode:<10} peak RSS +{growth / 1024:7.1f} MiB  '
+              f'({growth * 1024 / args.tweets:6.0f} bytes/tweet, '
+              f'{growth / 1024 * 100000 / args.tweets:7.1f} MiB per 100k tweets)')
+    print(f'reduction: {1 - results["records"] / results["documents"]:.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+State assignment benchmark: get_state (twice per tweet, polygon by polygon)
+vs. get_states (one StateIndex lookup per tweet, bulk API)
+over the points in data-analysis/location_random_sample_13012021.csv
+
+Usage: python benchmarks/bench_state_index.py [--repeat N]
+Needs the ETL requirements (etl/requirements_etl.txt).
+'''
+import argparse
+import csv
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'etl'))
+
+import election_etl
+import geometry
+from tweet_record import TweetRecord
+
+SAMPLE_PATH = os.path.join(ROOT, 'data-analysis', 'location_random_sample_13012021.csv')
+
+
+def load_sample():
+    '''
+    Returns the sample rows as TweetRecords (us_state holds the labelled state)
+    '''
+    tweets = []
+    with open(SAMPLE_PATH, newline='', encoding='utf-8') as sample_file:
+        for row in csv.DictReader(sample_file):
+            tweet = TweetRecord(loc_lat=row['loc_lat'], loc_lon=row['loc_lon'],
+                                loc_type=row['loc_type'], location=row['location'])
+            tweet.us_state = row['us_state']
+            tweets.append(tweet)
+    return tweets
+
+
+def main():
+    '''
+    Times both implementations and checks they agree
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    tweets = load_sample() * args.repeat
+    state_dict, usa_dict = geometry.load_boundaries(allow_download=True)
+    geometry.get_state_index()
+
+    start = time.perf_counter()
+    old = []
+    for tweet in tweets:
+        if election_etl.get_coords(tweet) is None:
+            old.append(('no_loc', 'no_loc'))
+            continue
+        old.append((election_etl.get_state(tweet, usa_dict),
+                    election_etl.get_state(tweet, state_dict)))
+    old_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    in_us, us_state = election_etl.get_states(tweets)
+    new_elapsed = time.perf_counter() - start
+    new = list(zip(in_us, us_state))
+
+    same = sum(1 for a, b in zip(old, new) if a == b)
+    labelled = sum(1 for tweet, (_, state) in zip(tweets, new) if state == tweet.us_state)
+    print(f'tweets:                  {len(tweets)}')
+    print(f'get_state x2:            {old_elapsed / len(tweets) * 1e6:8.1f} us/tweet')
+    print(f'get_states (StateIndex): {new_elapsed / len(tweets) * 1e6:8.1f} us/tweet')
+    print(f'speed-up:                {old_elapsed / new_elapsed:8.1f}x')
+    print(f'identical results:       {same}/{len(tweets)}')
+    print(f'matches labelled state:  {labelled}/{len(tweets)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Transform stage scaling: election_etl.transform on 1..N worker processes
+(parallel_transform) over a synthetic corpus of extracted tweets.
+Locations are drawn from data-analysis/location_random_sample_13012021.csv.
+
+Usage: python benchmarks/bench_transform_scaling.py [--tweets N] [--chunk-size N] [--max-workers N]
+Needs the ETL requirements (etl/requirements_etl.txt).
+'''
+import argparse
+import copy
+import csv
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'etl'))
+
+import election_etl
+import geometry
+import parallel_transform
+from tweet_record import TweetRecord
+
+SAMPLE_PATH = os.path.join(ROOT, 'data-analysis', 'location_random_sample_13012021.csv')
+
+POLITICIANS = ['Biden', 'Harris', 'Trump', 'Pence']
+WORDS = ('the vote count is in and the debate was a disaster for the campaign tonight '
+         'great rally economy jobs healthcare taxes election fraud win lose america').split()
+HANDLES = ['@JoeBiden', '@KamalaHarris', '@realDonaldTrump', '@Mike_Pence', '@CNN', '@FoxNews']
+HASHTAGS = ['#Election2020', '#Debates2020', '#MAGA', '#BidenHarris2020', '#Vote']
+
+
+def make_corpus(size, seed=0):
+    '''
+    Returns size TweetRecords like the ones extract() returns
+    '''
+    with open(SAMPLE_PATH, newline='', encoding='utf-8') as sample_file:
+        locations = [row for row in csv.DictReader(sample_file)]
+    rng = random.Random(seed)
+    corpus = []
+    for number in range(size):
+        words = rng.sample(WORDS, 12) + rng.sample(HANDLES, 1) + rng.sample(HASHTAGS, 2)
+        rng.shuffle(words)
+        if rng.random() < 0.3:
+            words.append('https://t.co/' + str(number))
+        location = rng.choice(locations)
+        corpus.append(TweetRecord.from_document({
+            '_id': '%024x' % number,
+            'text': 'RT ' + ' '.join(words) + '! &amp; more...',
+            'username': 'user' + str(number),
+            'followers_count': rng.randint(0, 10000),
+            'was_retweeted': rng.random() < 0.4,
+            'timestamp': 'Tue Oct 20 %02d:%02d:%02d +0000 2020' % (
+                rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59)),
+            'tweet_ID': str(1318000000000000000 + number),
+            'loc_lat': location['loc_lat'],
+            'loc_lon': location['loc_lon'],
+            'loc_type': location['loc_type'],
+            'location': location['location'],
+            'politician': rng.choice(POLITICIANS),
+            'extracted': 'no'
+        }))
+    return corpus
+
+
+def main():
+    '''
+    Times the transform stage for each worker count and checks outputs match
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=parallel_transform.CHUNK_SIZE)
+    parser.add_argument('--max-workers', type=int, default=parallel_transform.WORKERS)
+    args = parser.parse_args()
+    geometry.load_boundaries(allow_download=True)
+    corpus = make_corpus(args.tweets)
+
+    baseline = None
+    reference = None
+    for workers in range(1, args.max_workers + 1):
+        tweets = copy.deepcopy(corpus)
+        # start the pool (and its per-worker setup) outside the timed region
+        if workers > 1:
+            parallel_transform.get_pool(workers)
+        start = time.perf_counter()
+        transformed = parallel_transform.parallel_transform(
+            election_etl.transform, tweets, workers, args.chunk_size)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = transformed
+            baseline = elapsed
+        assert transformed == reference, f'{workers} workers changed the output'
+        print(f'workers={workers:2d}  {elapsed:7.2f} s  {len(tweets) / elapsed:8.0f} tweets/s  '
+              f'speedup x{baseline / elapsed:.2f}')
+    parallel_transform.close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+'''
+Local HTTP stubs for the collector's remote services:
+- the Twitter filter stream (POST STREAM_PATH): replays the payloads, rate
+  per second (0: as fast as the client reads), each one once across
+  connections, then sends keep-alive newlines; the first rate_limited
+  connects are answered with 420
+- the ArcGIS find endpoint (GET GEOCODE_PATH): answers like StubGeocoder,
+  after latency seconds
+
+StubServer runs both on a background thread and counts what it saw
+(stream connects, payloads sent, geocode requests and the TCP connections
+they came in on). They also run on their own, for the async collector:
+
+    python benchmarks/http_stubs.py --port 8080 --rate 200
+    python tweet_collect/async_collector.py --mode combined \\
+        --stream-url http://127.0.0.1:8080/1.1/statuses/filter.json \\
+        --geocode-url http://127.0.0.1:8080/find
+
+Needs aiohttp.
+'''
+import argparse
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+
+from raw_tweets import RawTweetGenerator, load_recorded
+from standins import StubGeocoder
+
+STREAM_PATH = '/1.1/statuses/filter.json'
+GEOCODE_PATH = '/find'
+KEEP_ALIVE = 1.0
+# most payloads per write when the stream is behind
+CHUNK = 100
+
+
+class StubServer():
+    '''
+    Stream and geocoder stubs on 127.0.0.1:port (0: any free port)
+    '''
+
+    def __init__(self, payloads=(), rate=0, latency=0.05, hit_rate=0.8, rate_limited=0, port=0):
+        self.payloads = [payload.encode('utf-8') + b'\r\n' for payload in payloads]
+        self.rate = rate
+        self.latency = latency
+        self.geocoder = StubGeocoder(latency=0, hit_rate=hit_rate)
+        self.rate_limited = rate_limited
+        self.port = port
+        self.counters = {'stream_connects': 0, 'sent': 0, 'geocode_requests': 0}
+        self.geocode_peers = set()
+        self.loop = None
+        self.runner = None
+        self.thread = None
+        self.ready = threading.Event()
+
+    @property
+    def stream_url(self):
+        return f'http://127.0.0.1:{self.port}{STREAM_PATH}'
+
+    @property
+    def geocode_url(self):
+        return f'http://127.0.0.1:{self.port}{GEOCODE_PATH}'
+
+    async def stream(self, request):
+        '''
+        The filter stream: the payloads not sent yet, then keep-alives
+        '''
+        self.counters['stream_connects'] += 1
+        if self.counters['stream_connects'] <= self.rate_limited:
+            return web.Response(status=420, text='Enhance Your Calm')
+        response = web.StreamResponse()
+        await response.prepare(request)
+        started = time.perf_counter()
+        first = self.counters['sent']
+        while True:
+            sent = self.counters['sent']
+            if sent >= len(self.payloads):
+                await response.write(b'\r\n')
+                await asyncio.sleep(KEEP_ALIVE)
+                continue
+            due = len(self.payloads)
+            if self.rate:
+                due = first + int((time.perf_counter() - started) * self.rate) + 1
+            due = min(due, sent + CHUNK, len(self.payloads))
+            if due > sent:
+                self.counters['sent'] = due
+                await response.write(b''.join(self.payloads[sent:due]))
+            else:
+                await asyncio.sleep(1 / self.rate)
+
+    async def find(self, request):
+        '''
+        ArcGIS find: one location or none
+        '''
+        self.counters['geocode_requests'] += 1
+        self.geocode_peers.add(request.transport.get_extra_info('peername'))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        status, coords = self.geocoder.answer(request.query.get('text', ''))
+        locations = []
+        if status == 'ok':
+            locations.append({'name': request.query.get('text', ''),
+                              'feature': {'geometry': {'x': coords[1], 'y': coords[0]}}})
+        return web.json_response({'locations': locations})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(STREAM_PATH, self.stream)
+        app.router.add_get(GEOCODE_PATH, self.find)
+        return app
+
+    def serve(self):
+        '''
+        Server thread: runs the stubs on their own event loop until stop()
+        '''
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.runner = web.AppRunner(self.app())
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', self.port)
+        self.loop.run_until_complete(site.start())
+        self.port = self.runner.addresses[0][1]
+        self.ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+    def start(self):
+        '''
+        Starts the server thread; returns once it is listening
+        '''
+        self.thread = threading.Thread(target=self.serve, name='http-stubs', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def stats(self):
+        '''
+        Returns the counters, with the number of TCP connections geocode requests came in on
+        '''
+        stats = dict(self.counters)
+        stats['geocode_connections'] = len(self.geocode_peers)
+        return stats
+
+
+def main():
+    '''
+    Serves the stubs until interrupted
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--recorded', help='replay raw payloads from this file (one per line)')
+    parser.add_argument('--rate', type=float, default=50, help='payloads per second, 0 = unpaced')
+    parser.add_argument('--geocode-latency', type=float, default=0.05)
+    parser.add_argument('--rate-limited', type=int, default=0,
+                        help='answer the first N stream connects with 420')
+    args = parser.parse_args()
+    payloads = (load_recorded(args.recorded)[:args.tweets] if args.recorded
+                else RawTweetGenerator().payloads(args.tweets))
+    server = StubServer(payloads, args.rate, args.geocode_latency,
+                        rate_limited=args.rate_limited, port=args.port).start()
+    print(f'stream: {server.stream_url}\ngeocoder: {server.geocode_url}')
+    try:
+        while True:
+            time.sleep(10)
+            print(server.stats())
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
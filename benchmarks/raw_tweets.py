@@ -0,0 +1,182 @@
+'''
+Raw tweet payloads in the Twitter v1.1 streaming JSON shape that
+TwitterListener.on_data receives.
+
+RawTweetGenerator makes synthetic ones with a configurable mix of the
+cases the collector handles differently (MIX):
+- short: plain tweet without extended_tweet (the collector drops these as text_empty)
+- extended: extended_tweet.full_text
+- retweet: retweeted_status carrying the original's full text; a small
+  pool of originals is reused, like viral tweets on debate nights
+- geo: exact coordinates in 'geo' (lat, lon)
+- place_box: place with a bounding box (lon, lat)
+- place_name: place without a bounding box, geocoded by name
+- user_location: self-reported user.location, geocoded (or not)
+- no_location: none of the above
+
+load_recorded() reads a recorded stream instead: one raw payload per line.
+
+Usage: python benchmarks/raw_tweets.py [--tweets N] > tweets.jsonl
+'''
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_PATH = os.path.join(ROOT, 'data-analysis', 'location_random_sample_13012021.csv')
+
+SEARCHTERMS = [['joe biden', 'joebiden'], ['kamala harris', 'kamalaharris'],
+               ['donald trump', 'donaldtrump'], ['mike pence', 'mikepence']]
+
+MIX = {'short': 0.10, 'extended': 0.15, 'retweet': 0.40, 'geo': 0.02, 'place_box': 0.03,
+       'place_name': 0.02, 'user_location': 0.23, 'no_location': 0.05}
+
+# share of retweets that reuse one of the viral originals
+VIRAL_SHARE = 0.6
+VIRAL_POOL = 50
+
+TEMPLATES = [
+    'Watching {name} right now and honestly {feeling} #Debates2020 @{handle}',
+    '{name} just said something {feeling}. Thread below \U0001F447 https://t.co/{link}',
+    'RT if you agree: {name} is {feeling} &amp; everyone knows it #Election2020',
+    "Can't believe what {name} did tonight... {feeling}!!! @{handle} #Vote",
+    'New poll: {name} up 3 in Ohio, down 2 in Florida. {feeling} https://t.co/{link}',
+]
+FEELINGS = ['great', 'terrible', 'a disaster', 'so inspiring', 'not ok', 'the best',
+            'exhausting', 'hopeful', 'wild', 'unbelievable']
+HANDLES = ['JoeBiden', 'KamalaHarris', 'realDonaldTrump', 'Mike_Pence', 'CNN', 'FoxNews']
+PLACES = [('Philadelphia, PA', -75.28, 39.87), ('Austin, TX', -97.94, 30.10),
+          ('Miami, FL', -80.32, 25.71), ('Columbus, OH', -83.21, 39.81),
+          ('London, England', -0.51, 51.28), ('Toronto, Ontario', -79.64, 43.58)]
+TWITTER_TIME = '%a %b %d %H:%M:%S +0000 %Y'
+
+
+def sample_locations():
+    '''
+    Self-reported locations from the labelled sample (US, abroad and nonsense)
+    '''
+    with open(SAMPLE_PATH, newline='', encoding='utf-8') as sample_file:
+        return [row['location'] for row in csv.DictReader(sample_file)]
+
+
+def load_recorded(path):
+    '''
+    Reads raw payloads recorded from the stream, one JSON document per line
+    '''
+    with open(path, encoding='utf-8') as recorded_file:
+        return [line.rstrip('\n') for line in recorded_file if line.strip()]
+
+
+class RawTweetGenerator():
+    '''
+    Deterministic (seeded) source of raw tweet payloads
+    '''
+
+    def __init__(self, seed=0, mix=None, start=datetime(2020, 10, 22, 23, 0, tzinfo=timezone.utc),
+                 tweets_per_second=50):
+        self.random = random.Random(seed)
+        self.mix = mix or MIX
+        self.start = start
+        self.tweets_per_second = tweets_per_second
+        self.locations = sample_locations()
+        self.number = 0
+        self.viral = [self.original() for _ in range(VIRAL_POOL)]
+
+    def text(self):
+        '''
+        A tweet text about one of the politicians
+        '''
+        terms = self.random.choice(SEARCHTERMS)
+        return self.random.choice(TEMPLATES).format(
+            name=self.random.choice([terms[0].title(), terms[1]]),
+            feeling=self.random.choice(FEELINGS), handle=self.random.choice(HANDLES),
+            link=format(self.random.getrandbits(40), 'x'))
+
+    def user(self, location=None):
+        '''
+        A v1.1 user object
+        '''
+        return {'id_str': str(self.random.getrandbits(40)),
+                'screen_name': f'user{self.random.randrange(100000)}',
+                'followers_count': int(self.random.paretovariate(1.2) * 10),
+                'location': location}
+
+    def original(self):
+        '''
+        An original (retweeted) tweet with extended text
+        '''
+        text = self.text()
+        return {'id_str': str(1310000000000000000 + self.random.getrandbits(48)),
+                'text': text[:140], 'truncated': len(text) > 140,
+                'extended_tweet': {'full_text': text}, 'user': self.user()}
+
+    def created_at(self):
+        '''
+        Stream time of the next tweet
+        '''
+        return (self.start + timedelta(seconds=self.number / self.tweets_per_second)).strftime(
+            TWITTER_TIME)
+
+    def tweet(self, kind):
+        '''
+        One raw tweet of the given kind (see MIX)
+        '''
+        self.number += 1
+        text = self.text()
+        tweet = {'id_str': str(1319000000000000000 + self.number), 'created_at': self.created_at(),
+                 'text': text[:140], 'truncated': False, 'lang': 'en', 'geo': None,
+                 'coordinates': None, 'place': None, 'user': self.user()}
+        if kind != 'short':
+            tweet['truncated'] = True
+            tweet['extended_tweet'] = {'full_text': text}
+        if kind == 'retweet':
+            if self.random.random() < VIRAL_SHARE:
+                original = self.random.choice(self.viral)
+            else:
+                original = self.original()
+            tweet['retweeted_status'] = original
+            tweet['text'] = ('RT @' + original['user']['screen_name'] + ': '
+                             + original['text'])[:140]
+            tweet['user']['location'] = self.random.choice(self.locations + [None] * 200)
+        elif kind == 'geo':
+            lon, lat = self.random.uniform(-122, -72), self.random.uniform(27, 47)
+            tweet['geo'] = {'type': 'Point', 'coordinates': [lat, lon]}
+            tweet['coordinates'] = {'type': 'Point', 'coordinates': [lon, lat]}
+        elif kind in ('place_box', 'place_name'):
+            name, lon, lat = self.random.choice(PLACES)
+            box = {'type': 'Polygon', 'coordinates': [[[lon, lat], [lon + 0.3, lat],
+                                                      [lon + 0.3, lat + 0.3], [lon, lat + 0.3]]]}
+            tweet['place'] = {'full_name': name, 'place_type': 'city',
+                              'bounding_box': box if kind == 'place_box' else None}
+        elif kind == 'user_location':
+            tweet['user']['location'] = self.random.choice(self.locations)
+        return tweet
+
+    def payloads(self, count):
+        '''
+        Returns count raw payloads (JSON strings, as on_data gets them)
+        '''
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        return [json.dumps(self.tweet(kind))
+                for kind in self.random.choices(kinds, weights, k=count)]
+
+
+def main():
+    '''
+    Writes synthetic payloads to stdout, one per line
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tweets', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for payload in RawTweetGenerator(args.seed).payloads(args.tweets):
+        sys.stdout.write(payload + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+'''
+Replay driver for the collector: feeds raw payloads to TwitterListener.on_data
+at a fixed rate, with the ingest pool and TweetWriter working as in production
+but against stand-ins (stub geocoder, mongomock or a local mongod).
+
+Reports how long the stream thread spent per payload, the worker latency
+per tweet (process_tweet: parse, locate, buffer) and the pool/writer/
+geocoder counters, e.g. how many tweets a policy drops at a given rate.
+
+Usage: python benchmarks/replay.py [--tweets N] [--rate PER_SECOND] [--workers N]
+                                   [--geocode-latency SECONDS] [--recorded FILE] [--mongo-uri URI]
+--rate 0 feeds as fast as possible. Needs the collector requirements and mongomock
+(or --mongo-uri).
+'''
+import argparse
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+# etl first: both services have a credentials.py, and the collector only
+# needs the Mongo settings, which the ETL's copy has too
+sys.path.insert(0, os.path.join(ROOT, 'tweet_collect'))
+sys.path.insert(0, os.path.join(ROOT, 'etl'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import election_tweets
+import ingest
+from geocache import GeoCache
+from mongo_writer import TweetWriter, ensure_indexes
+from scheduler import QuotaScheduler
+
+from raw_tweets import RawTweetGenerator, load_recorded
+from stage_report import StageReport
+from standins import StubGeocoder, mongo_collection
+
+
+def replay(listener, payloads, rate=0):
+    '''
+    Calls listener.on_data for each payload, rate per second (0: no pacing)
+    Returns per-payload on_data durations
+    '''
+    durations = []
+    start = time.perf_counter()
+    for number, payload in enumerate(payloads):
+        if rate:
+            delay = start + number / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        called = time.perf_counter()
+        listener.on_data(payload)
+        durations.append(time.perf_counter() - called)
+    return durations
+
+
+def run_collection(payloads, collection, report, rate=0, workers=ingest.WORKERS,
+                   policy=ingest.DROP_POLICY, geocoder=None, politician=None):
+    '''
+    Replays payloads through TwitterListener -> IngestPool -> process_tweet -> TweetWriter
+    politician None runs a combined stream (tweets routed by keyword)
+    Records the 'stream' and 'collect' stages in report and returns the counters
+    '''
+    geocoder = geocoder or StubGeocoder()
+    election_tweets.GEOCODE_CACHE = GeoCache(path=None, lookup=geocoder)
+    ensure_indexes(collection)
+    scheduler = QuotaScheduler(election_tweets.SEARCHTERMS)
+    tweet_writer = TweetWriter(collection)
+    tweet_writer.start()
+    latencies = []
+
+    def handler(item):
+        started = time.perf_counter()
+        election_tweets.process_tweet(item[0], item[1], tweet_writer, scheduler)
+        latencies.append(time.perf_counter() - started)
+
+    ingest_pool = ingest.IngestPool(handler, workers=workers, policy=policy)
+    ingest_pool.start()
+    listener = election_tweets.TwitterListener(None, politician, float('inf'), ingest_pool,
+                                               tweet_writer)
+    start = time.perf_counter()
+    durations = replay(listener, payloads, rate)
+    ingest_pool.stop(drain=True)
+    tweet_writer.close()
+    elapsed = time.perf_counter() - start
+    report.record('stream', len(payloads), sum(durations), durations)
+    report.record('collect', len(payloads), elapsed, latencies)
+    return {'pool': ingest_pool.stats(), 'writer': tweet_writer.stats(),
+            'geocoder_calls': geocoder.calls,
+            'geocode_cache': election_tweets.GEOCODE_CACHE.stats(),
+            'collected': scheduler.collected()}
+
+
+def add_collection_args(parser):
+    '''
+    Command line options shared with bench_pipeline.py
+    '''
+    parser.add_argument('--tweets', type=int, default=20000)
+    parser.add_argument('--recorded', help='replay raw payloads from this file (one per line)')
+    parser.add_argument('--rate', type=float, default=0, help='payloads per second, 0 = unpaced')
+    parser.add_argument('--workers', type=int, default=ingest.WORKERS)
+    parser.add_argument('--policy', default=ingest.DROP_POLICY,
+                        choices=['drop_newest', 'drop_oldest', 'block'])
+    parser.add_argument('--geocode-latency', type=float, default=0.05,
+                        help='seconds per stub geocoder call')
+    parser.add_argument('--mongo-uri', help='local mongod instead of mongomock')
+
+
+def get_payloads(args):
+    '''
+    Recorded payloads if given, synthetic ones otherwise
+    '''
+    if args.recorded:
+        return load_recorded(args.recorded)[:args.tweets]
+    return RawTweetGenerator().payloads(args.tweets)
+
+
+def main():
+    '''
+    Runs the collection stage on its own
+    '''
+    parser = argparse.ArgumentParser()
+    add_collection_args(parser)
+    args = parser.parse_args()
+    payloads = get_payloads(args)
+    collection = mongo_collection(args.mongo_uri)
+    report = StageReport()
+    logging.disable(logging.CRITICAL)
+    counters = run_collection(payloads, collection, report, args.rate, args.workers, args.policy,
+                              StubGeocoder(args.geocode_latency))
+    logging.disable(logging.NOTSET)
+    report.print()
+    for name, value in counters.items():
+        print(f'{name}: {value}')
+
+
+if __name__ == '__main__':
+    main()
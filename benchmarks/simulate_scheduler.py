@@ -0,0 +1,126 @@
+'''
+Offline simulation of stream scheduling on a simulated clock.
+
+A fake stream source emits tweets per politician at fixed rates
+(tweets per streamed second). The simulation compares the old round-robin
+loop (fixed ~1 minute streams, 3-9 minute sleeps) with QuotaScheduler in
+'scheduled' and 'combined' mode, reporting tweets per politician per hour,
+stream seconds used and the share of time spent sleeping.
+
+Usage: python benchmarks/simulate_scheduler.py [--hours N]
+'''
+import argparse
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'common'))
+sys.path.insert(0, os.path.join(ROOT, 'tweet_collect'))
+
+from scheduler import QuotaScheduler, SimulatedClock
+
+SEARCHTERMS = [['joe biden', 'joebiden'], ['kamala harris', 'kamalaharris'],
+               ['donald trump', 'donaldtrump'], ['mike pence', 'mikepence']]
+
+# tweets per second on a single-politician stream
+RATES = {'joebiden': 12.0, 'kamalaharris': 4.0, 'donaldtrump': 25.0, 'mikepence': 1.5}
+
+
+class FakeStreamSource():
+    '''
+    Emits (politician, text) pairs for one second of streaming
+    '''
+
+    def __init__(self, rates, seed=0):
+        self.rates = rates
+        self.random = random.Random(seed)
+        self.texts = {terms[1]: f'what do you think about {terms[0]} tonight'
+                      for terms in SEARCHTERMS}
+
+    def second(self, politicians):
+        for politician in politicians:
+            rate = self.rates[politician]
+            count = int(rate) + (self.random.random() < rate - int(rate))
+            for _ in range(count):
+                yield politician, self.texts[politician]
+
+
+def simulate_round_robin(hours, source):
+    '''
+    The old main() loop: fixed runtimes and random sleeps
+    '''
+    rng = random.Random(1)
+    clock = SimulatedClock()
+    collected = dict.fromkeys(RATES, 0)
+    streamed = 0
+    i = 0
+    while clock.time() < hours * 3600:
+        politician = SEARCHTERMS[i][1]
+        runtime = (120 if politician == 'mikepence' else 75) - rng.randint(8, 17)
+        for _ in range(runtime):
+            for name, _ in source.second([politician]):
+                collected[name] += 1
+        clock.sleep(runtime)
+        streamed += runtime
+        i = (i + 1) % len(SEARCHTERMS)
+        clock.sleep(rng.randint(50, 70) * rng.randint(3, 8))
+    return collected, streamed, clock.time()
+
+
+def simulate_scheduler(hours, source, combined):
+    '''
+    QuotaScheduler driving the fake source
+    '''
+    clock = SimulatedClock()
+    scheduler = QuotaScheduler(SEARCHTERMS, clock=clock, seed=1)
+    collected = dict.fromkeys(RATES, 0)
+    streamed = 0
+    while clock.time() < hours * 3600:
+        if combined:
+            politician, runtime, wait = scheduler.next_combined_window()
+        else:
+            politician, runtime, wait = scheduler.next_window()
+        clock.sleep(wait)
+        start = clock.time()
+        active = list(RATES) if politician is None else [politician]
+        for _ in range(runtime):
+            for name, text in source.second(active):
+                if politician is None:
+                    name = scheduler.route(text)
+                    if name is None:
+                        continue
+                scheduler.record(name)
+                collected[name] += 1
+            clock.sleep(1)
+        streamed += runtime
+        scheduler.end_window(politician, start, clock.time())
+    return collected, streamed, clock.time()
+
+
+def report(label, result):
+    '''
+    Prints per-politician tweets/hour and stream time share
+    '''
+    collected, streamed, elapsed = result
+    hours = elapsed / 3600
+    per_hour = ', '.join(f'{name} {count / hours:6.0f}' for name, count in collected.items())
+    print(f'{label:<14} {per_hour} | streaming {streamed / elapsed:5.1%} '
+          f'sleeping {1 - streamed / elapsed:5.1%}')
+
+
+def main():
+    '''
+    Runs all three strategies on the same fake source
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hours', type=int, default=24)
+    args = parser.parse_args()
+    print('tweets/hour per politician')
+    report('round robin', simulate_round_robin(args.hours, FakeStreamSource(RATES)))
+    report('scheduled', simulate_scheduler(args.hours, FakeStreamSource(RATES), False))
+    report('combined', simulate_scheduler(args.hours, FakeStreamSource(RATES), True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+'''
+Per-stage throughput/latency table for the pipeline benchmarks.
+'''
+
+
+def percentile(values, share):
+    '''
+    Nearest-rank percentile of a list of numbers (None if empty)
+    '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+class StageReport():
+    '''
+    Collects (items, seconds, per-item or per-batch latencies) per stage
+    '''
+
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage, items, seconds, latencies=()):
+        '''
+        Adds a run of a stage; repeated calls for the same stage accumulate
+        '''
+        entry = self.stages.setdefault(stage, {'items': 0, 'seconds': 0.0, 'latencies': []})
+        entry['items'] += items
+        entry['seconds'] += seconds
+        entry['latencies'].extend(latencies)
+
+    def rows(self):
+        '''
+        Returns one dict per stage with throughput and latency percentiles (ms)
+        '''
+        rows = []
+        for stage, entry in self.stages.items():
+            latencies = entry['latencies']
+            rows.append({
+                'stage': stage, 'items': entry['items'], 'seconds': round(entry['seconds'], 3),
+                'per_second': round(entry['items'] / entry['seconds']) if entry['seconds'] else None,
+                'p50_ms': None if not latencies else round(percentile(latencies, 0.5) * 1000, 2),
+                'p95_ms': None if not latencies else round(percentile(latencies, 0.95) * 1000, 2),
+                'max_ms': None if not latencies else round(max(latencies) * 1000, 2),
+            })
+        return rows
+
+    def print(self):
+        '''
+        Prints the table; the slowest stage (lowest throughput) is marked
+        '''
+        rows = self.rows()
+        rates = [row['per_second'] for row in rows if row['per_second']]
+        slowest = min(rates) if rates else None
+        print(f'{"stage":<12} {"items":>8} {"seconds":>9} {"items/s":>9} '
+              f'{"p50 ms":>9} {"p95 ms":>9} {"max ms":>9}')
+        for row in rows:
+            cells = [row['p50_ms'], row['p95_ms'], row['max_ms']]
+            print(f'{row["stage"]:<12} {row["items"]:>8} {row["seconds"]:>9} '
+                  f'{row["per_second"] or "-":>9} '
+                  + ' '.join(f'{"-" if cell is None else cell:>9}' for cell in cells)
+                  + ('   <- bottleneck' if row['per_second'] == slowest and len(rows) > 1 else ''))
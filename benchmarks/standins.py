@@ -0,0 +1,197 @@
+'''
+Stand-ins for the external services, so the pipeline can be measured
+without ArcGIS, MongoDB or Postgres:
+- StubGeocoder: a lookup function for GeoCache with a fixed latency and hit rate
+- mongo_collection(): an empty collection on mongomock (pip install mongomock)
+  or, given a URI, on a real mongod
+- AsyncCollection: awaitable insert_many/create_index on such a collection,
+  standing in for motor
+- RoundTripCollection: a collection whose calls first wait a fixed latency,
+  the network round-trip mongomock doesn't have
+- RecordingPostgres: a minimal engine for bulk_load/ensure_partitions that
+  formats and consumes everything (COPY buffer included) without a server,
+  so the load stage measures the client-side cost only
+'''
+import asyncio
+import functools
+import random
+import time
+
+
+class StubGeocoder():
+    '''
+    Replaces arcgis_lookup: answers after latency seconds,
+    'ok' with a point in the US for hit_rate of the locations, 'not_found' otherwise
+    '''
+
+    def __init__(self, latency=0.05, hit_rate=0.8, seed=0):
+        self.latency = latency
+        self.hit_rate = hit_rate
+        self.seed = seed
+        self.calls = 0
+
+    def __call__(self, location):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.answer(location)
+
+    def answer(self, location):
+        '''
+        The (status, coords) for location, without the wait
+        '''
+        answer = random.Random(f'{self.seed}:{location}')
+        if answer.random() < self.hit_rate:
+            return 'ok', (answer.uniform(27, 47), answer.uniform(-122, -72))
+        return 'not_found', None
+
+
+def mongo_collection(uri=None, name='tweet'):
+    '''
+    Returns an empty tweet collection on mongod (uri) or mongomock
+    '''
+    if uri:
+        from pymongo import MongoClient
+        client = MongoClient(uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    database = client.tweet_benchmark
+    database[name].drop()
+    database.etl_checkpoint.drop()
+    return database[name]
+
+
+class AsyncCollection():
+    '''
+    The motor calls AsyncTweetWriter makes, on a pymongo or mongomock collection;
+    like motor, the blocking call runs on the loop's thread pool
+    '''
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def call(self, method, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(method, *args, **kwargs))
+
+    async def insert_many(self, documents, ordered=True):
+        return await self.call(self.collection.insert_many, documents, ordered=ordered)
+
+    async def create_index(self, keys, **kwargs):
+        return await self.call(self.collection.create_index, keys, **kwargs)
+
+
+class RoundTripCollection():
+    '''
+    Wraps a (mongomock) collection: every call in ROUND_TRIPS sleeps latency
+    seconds first, like a request to mongod; everything else is passed through
+    '''
+    ROUND_TRIPS = frozenset(['find', 'find_one', 'count_documents', 'insert_one', 'insert_many',
+                             'update_one', 'update_many', 'replace_one', 'bulk_write',
+                             'create_index', 'drop'])
+
+    def __init__(self, collection, latency):
+        self.collection = collection
+        self.latency = latency
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.collection, name)
+        if name not in self.ROUND_TRIPS:
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            self.round_trips += 1
+            time.sleep(self.latency)
+            return attribute(*args, **kwargs)
+        return call
+
+
+class RecordingResult():
+    '''
+    What RecordingPostgres.execute returns
+    '''
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    def scalar(self):
+        return self.rows[0][0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class RecordingCursor():
+    '''
+    DB-API cursor that counts statements and the rows sent to it
+    '''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.staged = 0
+        self.result = []
+        self.description = None
+
+    def execute(self, statement, parameters=None):
+        self.engine.statements += 1
+        if 'RETURNING batch_id' in statement:
+            # batch_state.open_batch
+            self.result = [(self.engine.statements,)]
+        else:
+            self.result = [(True,)] * self.staged if 'RETURNING' in statement else []
+        self.description = [('result',)] if 'RETURNING' in statement else None
+
+    def executemany(self, statement, rows):
+        rows = list(rows)
+        self.engine.statements += 1
+        self.staged += len(rows)
+
+    def copy_expert(self, statement, buffer):
+        self.engine.statements += 1
+        self.engine.copied_bytes += len(buffer.getvalue())
+        self.staged += buffer.getvalue().count('\n')
+
+    def fetchall(self):
+        return self.result
+
+
+class RecordingConnection():
+    '''
+    raw_connection() of RecordingPostgres
+    '''
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def cursor(self):
+        return RecordingCursor(self.engine)
+
+    def commit(self):
+        self.engine.commits += 1
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class RecordingPostgres():
+    '''
+    Stands in for the SQLAlchemy engine in the load path
+    '''
+
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+        self.copied_bytes = 0
+
+    def execute(self, statement):
+        self.statements += 1
+        return RecordingResult()
+
+    def raw_connection(self):
+        return RecordingConnection(self)
@@ -0,0 +1,528 @@
+'''
+Counters, gauges and histograms for the collector and the ETL,
+plus an on-demand profiler.
+
+Metrics live in process memory (REGISTRY) and are cheap to update from the
+hot path: one lock and a dict lookup. They are read out
+- over HTTP: serve(port) answers /metrics in the Prometheus text format
+  and /metrics.json with the same numbers as JSON
+- or as a JSON file rewritten every DUMP_INTERVAL seconds: start_dump(path)
+
+PROFILER profiles the next cycle (a stream window in the collector, a batch
+run or micro-batch in the ETL) once asked to: PROFILER.request(), kill -USR1,
+or POST /profile. 'cprofile' profiles the calling thread, 'sampling' samples
+the stacks of all threads every SAMPLE_INTERVAL seconds and writes them in
+collapsed-stack format (flamegraph.pl, speedscope).
+
+The collector and the ETL share this module: both images are built from
+the repo root and put common/ on PYTHONPATH (see the Dockerfiles and
+docker-compose.yml). To run a service outside Docker, do the same, e.g.
+PYTHONPATH=../common python election_etl.py.
+'''
+import cProfile
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+DUMP_INTERVAL = 60.0
+PROFILE_DIR = 'profiles'
+PROFILE_KIND = 'cprofile'
+SAMPLE_INTERVAL = 0.005
+
+# seconds; covers a cache hit (sub-millisecond) up to a slow batch
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def format_labels(labelnames, key, extra=()):
+    '''
+    Returns {name="value",...} for the Prometheus text format ('' without labels)
+    '''
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric():
+    '''
+    Base class: a named family of values, one per combination of label values
+    '''
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        '''
+        Label values in labelnames order; raises KeyError for a missing label
+        '''
+        if len(labels) != len(self.labelnames):
+            raise KeyError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        '''
+        Returns [(label values, value)] at this moment
+        '''
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self):
+        '''
+        Returns the Prometheus text format lines for this metric
+        '''
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in self.samples():
+            lines.append(f'{self.name}{format_labels(self.labelnames, key)} {value}')
+        return lines
+
+    def snapshot(self):
+        '''
+        Returns the metric as a JSON-serialisable dict
+        '''
+        return {'type': self.kind, 'help': self.documentation,
+                'values': [{'labels': dict(zip(self.labelnames, key)), 'value': value}
+                           for key, value in self.samples()]}
+
+
+class Counter(Metric):
+    '''
+    Monotonic count, e.g. tweets stored
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    Current value, e.g. queue depth. set_function() reads it only when the
+    metrics are rendered, which keeps it off the hot path entirely.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.functions[key] = function
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = list(self.functions.items())
+        for key, function in functions:
+            values[key] = function()
+        return list(values.items())
+
+
+class Histogram(Metric):
+    '''
+    Distribution of observed values (latencies in seconds) over fixed buckets
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0,
+                                            'count': 0}
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][position] += 1
+                    break
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Observes the time spent in the with block
+        '''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            return [(key, {'counts': list(entry['counts']), 'sum': entry['sum'],
+                           'count': entry['count']})
+                    for key, entry in self.values.items()]
+
+    def cumulative(self, entry):
+        '''
+        Returns [(upper bound, observations <= bound)] including +Inf
+        '''
+        total = 0
+        bounds = []
+        for bound, count in zip(self.buckets, entry['counts']):
+            total += count
+            bounds.append((bound, total))
+        bounds.append(('+Inf', entry['count']))
+        return bounds
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, entry in self.samples():
+            for bound, count in self.cumulative(entry):
+                labels = format_labels(self.labelnames, key, [('le', bound)])
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {entry["sum"]}')
+            lines.append(f'{self.name}_count{labels} {entry["count"]}')
+        return lines
+
+    def snapshot(self):
+        return {'type': 'histogram', 'help': self.documentation,
+                'values': [{'labels': dict(zip(self.labelnames, key)), 'count': entry['count'],
+                            'sum': round(entry['sum'], 6),
+                            'buckets': {str(bound): count
+                                        for bound, count in self.cumulative(entry)}}
+                           for key, entry in self.samples()]}
+
+
+class Registry():
+    '''
+    All metrics of the process, by name
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric_class, name, documentation, labelnames=(), **options):
+        '''
+        Returns the metric called name, creating it on first use
+        '''
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, documentation, labelnames,
+                                                           **options)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f'{name} is already registered as a {metric.kind}')
+            return metric
+
+    def render(self):
+        '''
+        Returns all metrics in the Prometheus text format
+        '''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''
+        Returns all metrics as one JSON-serialisable dict
+        '''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {'time': round(time.time(), 3),
+                'metrics': {metric.name: metric.snapshot() for metric in metrics}}
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+class Stopwatch():
+    '''
+    Adds up the time spent in wrapped calls, e.g. hooks that run inside another stage
+    '''
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def wrap(self, function):
+        '''
+        Returns function with timing around it
+        '''
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - started
+        return timed
+
+
+class SamplingProfiler():
+    '''
+    Samples the stacks of all other threads every interval seconds
+    '''
+
+    def __init__(self, interval=None):
+        self.interval = interval or SAMPLE_INTERVAL
+        self.stacks = StackCounter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.sample, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        '''
+        Sampler loop: counts each thread's current stack, outermost frame first
+        '''
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}'
+                                 f':{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def write(self, path):
+        '''
+        Writes 'frame;frame;frame count' lines
+        '''
+        with open(path, 'w', encoding='utf-8') as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f'{stack} {count}\n')
+
+
+class Profiler():
+    '''
+    Profiles the next cycle(s) once requested, and nothing otherwise
+    Cycles nested in a profiled one (an ETL batch in a batch run) are
+    part of its profile rather than profiled on their own
+    '''
+
+    def __init__(self):
+        self.pending = 0
+        # bumped only by the signal handler, which must not take the lock:
+        # it runs on the main thread, possibly while claim() holds it
+        self.signalled = 0
+        self.signals_seen = 0
+        self.active = False
+        self.lock = threading.Lock()
+
+    def request(self, cycles=1):
+        '''
+        Asks for the next cycles to be profiled (from other threads; see signalled)
+        '''
+        with self.lock:
+            self.pending += cycles
+
+    def signal(self, signum=None, frame=None):
+        '''
+        SIGUSR1 handler: asks for the next cycle to be profiled, without locking
+        '''
+        self.signalled += 1
+
+    def claim(self):
+        '''
+        Returns True (and counts it off) if a profile is pending and none is running
+        '''
+        with self.lock:
+            if self.active:
+                return False
+            signalled = self.signalled
+            self.pending += signalled - self.signals_seen
+            self.signals_seen = signalled
+            if self.pending <= 0:
+                return False
+            self.pending -= 1
+            self.active = True
+            return True
+
+    @contextmanager
+    def cycle(self, name, kind=None):
+        '''
+        Profiles the with block if a profile was requested
+        Writes PROFILE_DIR/{name}-{timestamp}.prof (cprofile) or .collapsed (sampling)
+        '''
+        if not self.claim():
+            yield
+            return
+        kind = kind or PROFILE_KIND
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, time.strftime(f'{name}-%Y%m%d-%H%M%S'))
+        try:
+            if kind == 'sampling':
+                profile = SamplingProfiler()
+                profile.start()
+                try:
+                    yield
+                finally:
+                    profile.stop()
+                    path += '.collapsed'
+                    profile.write(path)
+            else:
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    path += '.prof'
+                    profile.dump_stats(path)
+        finally:
+            with self.lock:
+                self.active = False
+        logging.critical('--- Wrote %s profile of %s to %s ---', kind, name, path)
+
+
+PROFILER = Profiler()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    GET /metrics (Prometheus text), GET /metrics.json, POST /profile[?cycles=N]
+    '''
+
+    def do_GET(self):
+        if self.path.startswith('/metrics.json'):
+            self.reply(json.dumps(REGISTRY.snapshot()), 'application/json')
+        elif self.path.startswith('/metrics'):
+            self.reply(REGISTRY.render(), 'text/plain; version=0.0.4')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if not self.path.startswith('/profile'):
+            self.send_error(404)
+            return
+        cycles = 1
+        if 'cycles=' in self.path:
+            try:
+                cycles = int(self.path.split('cycles=', 1)[1].split('&')[0])
+            except ValueError:
+                self.send_error(400)
+                return
+        PROFILER.request(cycles)
+        self.reply(f'profiling the next {cycles} cycle(s)\n', 'text/plain')
+
+    def reply(self, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # scrapes every few seconds would drown the service's own log
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host=''):
+    '''
+    Serves the metrics endpoint from a background thread
+    Returns the server (server.shutdown() stops it)
+    '''
+    server = MetricsServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logging.critical('--- Serving metrics on port %s ---', server.server_address[1])
+    return server
+
+
+def dump(path):
+    '''
+    Writes REGISTRY.snapshot() to path (atomically, so readers never see half a file)
+    '''
+    partial_path = path + '.tmp'
+    with open(partial_path, 'w', encoding='utf-8') as out:
+        json.dump(REGISTRY.snapshot(), out)
+    os.replace(partial_path, path)
+
+
+def start_dump(path, interval=None):
+    '''
+    Rewrites the JSON dump every interval seconds from a background thread
+    '''
+    interval = interval or DUMP_INTERVAL
+
+    def dump_periodically():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(path)
+            except OSError:
+                logging.exception('--- Could not write metrics to %s ---', path)
+
+    thread = threading.Thread(target=dump_periodically, name='metrics-dump', daemon=True)
+    thread.start()
+    return thread
+
+
+def start(port=None, dump_path=None, profile_cycles=0):
+    '''
+    Switches on whichever outputs are configured; kill -USR1 requests a profile
+    Call from the main thread (signal handlers can only be installed there)
+    '''
+    if port is not None:
+        serve(port)
+    if dump_path:
+        start_dump(dump_path)
+    if profile_cycles:
+        PROFILER.request(profile_cycles)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, PROFILER.signal)
@@ -0,0 +1,114 @@
+'''
+Incrementally maintained aggregates for the dashboard.
+
+Instead of dropping and re-aggregating the agg_* tables over all of
+tweet_pg every cycle, the ETL keeps running sums and counts per group key
+(SUM_TABLES) and only touches the groups in the batch being loaded.
+The dashboard tables agg_sentiment, agg_state_sentiment, agg_count and
+agg_noticket_state_sentiment are views over those sums (VIEWS) with the
+same columns as before, so averages are computed on read. date_hour is a
+TIMESTAMP in the sums and formatted as 'YYYY-MM-DD HH' text in the view.
+
+The batch delta is applied inside the load transaction: rows that already
+existed (reloaded batches) first have their old contribution subtracted.
+rebuild_aggregates() recomputes everything from tweet_pg for backfills,
+in a single transaction, so readers never see empty or missing tables.
+'''
+import logging
+
+SUM_TABLES = {
+    'agg_sentiment_sums': [('date_hour', 'TIMESTAMP'), ('politician', 'VARCHAR(50)')],
+    'agg_state_sentiment_sums': [('us_state', 'VARCHAR(50)'), ('date', 'DATE'),
+                                 ('politician', 'VARCHAR(50)')],
+}
+
+VIEWS = {
+    'agg_sentiment': '''SELECT (sentiment_sum / tweet_count)::REAL AS avg, \
+    to_char(date_hour, 'YYYY-MM-DD HH24') AS date_hour, politician FROM agg_sentiment_sums \
+    ORDER BY agg_sentiment_sums.date_hour''',
+    'agg_state_sentiment': '''SELECT (sentiment_sum / tweet_count)::REAL AS avg, \
+    us_state, date::VARCHAR(20) AS date, politician FROM agg_state_sentiment_sums \
+    ORDER BY date''',
+    'agg_count': '''SELECT SUM(tweet_count)::BIGINT AS count, date::VARCHAR(20) AS date, \
+    politician FROM agg_state_sentiment_sums GROUP BY date, politician ORDER BY date''',
+    'agg_noticket_state_sentiment': '''SELECT (SUM(sentiment_sum) / SUM(tweet_count))::REAL \
+    AS avg, us_state FROM agg_state_sentiment_sums GROUP BY us_state''',
+}
+
+PREVIOUS_TABLE = 'agg_previous'
+
+
+def key_names(sum_table):
+    '''
+    Group key columns of a sum table, comma separated
+    '''
+    return ', '.join(name for name, _ in SUM_TABLES[sum_table])
+
+
+def create_aggregates(pg_table_name, db_pg):
+    '''
+    Creates the sum tables and dashboard views
+    On first run this replaces the old DROP/CREATE agg_* tables and backfills the sums
+    '''
+    first_run = db_pg.execute("SELECT to_regclass('agg_sentiment_sums');").scalar() is None
+    with db_pg.begin() as conn:
+        for sum_table, keys in SUM_TABLES.items():
+            columns = ', '.join(f'{name} {column_type}' for name, column_type in keys)
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS {sum_table} ({columns}, \
+            sentiment_sum DOUBLE PRECISION NOT NULL, tweet_count BIGINT NOT NULL, \
+            PRIMARY KEY ({key_names(sum_table)}));''')
+        if first_run:
+            for view_name in VIEWS:
+                conn.execute(f'DROP TABLE IF EXISTS {view_name};')
+        for view_name, query in VIEWS.items():
+            conn.execute(f'CREATE OR REPLACE VIEW {view_name} AS {query};')
+        if first_run:
+            fill_sums(conn, pg_table_name)
+    logging.critical('\n*\n*\n--- Aggregate tables ready ---\n*\n*')
+
+
+def fill_sums(conn, pg_table_name):
+    '''
+    Recomputes every sum table from scratch
+    '''
+    for sum_table in SUM_TABLES:
+        keys = key_names(sum_table)
+        conn.execute(f'DELETE FROM {sum_table};')
+        conn.execute(f'''INSERT INTO {sum_table} ({keys}, sentiment_sum, tweet_count) \
+        SELECT {keys}, SUM(sentiment), COUNT(*) FROM {pg_table_name} GROUP BY {keys};''')
+
+
+def rebuild_aggregates(pg_table_name, db_pg):
+    '''
+    Full rebuild for backfills; swaps the contents atomically in one transaction
+    '''
+    with db_pg.begin() as conn:
+        fill_sums(conn, pg_table_name)
+    logging.critical('\n*\n*\n--- Rebuilt aggregate tables from %s ---\n*\n*', pg_table_name)
+
+
+def capture_previous(cursor, pg_table_name, stage_name):
+    '''
+    Before the upsert: remembers the current version of rows the batch will overwrite
+    '''
+    columns = sorted({name for keys in SUM_TABLES.values() for name, _ in keys} | {'sentiment'})
+    cursor.execute(f'''CREATE TEMP TABLE {PREVIOUS_TABLE} ON COMMIT DROP AS \
+    SELECT {', '.join(columns)} FROM {pg_table_name} \
+    WHERE (tweet_ID, created_at) IN (SELECT tweet_ID, created_at FROM {stage_name});''')
+
+
+def apply_deltas(cursor, pg_table_name, stage_name):
+    '''
+    After the upsert: adds the batch to the sums and takes out overwritten rows
+    '''
+    for sum_table in SUM_TABLES:
+        keys = key_names(sum_table)
+        cursor.execute(f'''INSERT INTO {sum_table} ({keys}, sentiment_sum, tweet_count) \
+        SELECT {keys}, SUM(sentiment), SUM(tweets) FROM ( \
+        SELECT {keys}, sentiment, 1 AS tweets FROM {stage_name} \
+        UNION ALL SELECT {keys}, -sentiment, -1 FROM {PREVIOUS_TABLE}) AS delta \
+        GROUP BY {keys} \
+        ON CONFLICT ({keys}) DO UPDATE SET \
+        sentiment_sum = {sum_table}.sentiment_sum + EXCLUDED.sentiment_sum, \
+        tweet_count = {sum_table}.tweet_count + EXCLUDED.tweet_count;''')
+        cursor.execute(f'DELETE FROM {sum_table} WHERE tweet_count = 0;')
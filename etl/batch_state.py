@@ -0,0 +1,299 @@
+'''
+Numbered ETL batches, their state in Postgres, retries and dead letters.
+
+Every extracted batch gets a row in BATCH_TABLE with its Mongo _id range:
+
+    pending -> transformed -> loaded (-> marked_at set)
+
+The move to 'loaded' happens inside the load transaction (record_loaded,
+called from the after_upsert hook), so a batch is loaded exactly when its
+rows and aggregate deltas are committed. The tweets are marked extracted
+in MongoDB only after that commit; marked_at records that this happened.
+After a crash, unfinished() lists what to redo: batches that never got to
+'loaded' are extracted again by _id range and rerun, and loaded batches
+without marked_at only need the Mongo update.
+
+retry() reruns failing work with exponential backoff. Connection trouble
+(TRANSIENT_ERRORS: Postgres or MongoDB unreachable) is retried until it
+goes away, instead of crashing into a restart loop. Other errors are
+retried RETRIES times; after that run_batch bisects the batch (isolate)
+and the tweets that fail on their own go to the DEAD_LETTER collection
+with the error, marked extracted: 'dead' in the tweet collection. More
+than MAX_DEAD_LETTERS of those in one batch looks like a broken stage
+rather than bad tweets, so the batch is retried as a whole instead.
+SETUP_ERRORS (a missing boundary file or model, a missing module) are never
+a tweet's fault: they are raised without bisecting, and the batch is left
+unfinished for resume after the setup is fixed.
+'''
+import logging
+import time
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from psycopg2 import InterfaceError, OperationalError as PgOperationalError
+from pymongo.errors import ConnectionFailure
+from sqlalchemy.exc import OperationalError, DisconnectionError
+
+import metrics
+from tweet_record import EXTRACT_FIELDS, PROJECTION
+
+BATCH_TABLE = 'etl_batch'
+DEAD_LETTER = 'tweet_dead_letter'
+RETRIES = 2
+BACKOFF = 2.0
+MAX_BACKOFF = 300.0
+# more poison tweets than this in one batch: retry the whole batch instead
+MAX_DEAD_LETTERS = 10
+# finished batches are kept this long for inspection
+RETAIN_DAYS = 14
+
+TRANSIENT_ERRORS = (PgOperationalError, InterfaceError, OperationalError, DisconnectionError,
+                    ConnectionFailure)
+# broken setup or configuration, not bad tweets
+SETUP_ERRORS = (OSError, ImportError, MemoryError)
+
+RETRIED = metrics.counter('etl_batch_retries_total', 'Failed batch attempts', ('kind',))
+DEAD_LETTERED = metrics.counter('etl_dead_letters_total',
+                                'Tweets moved to the dead-letter collection')
+
+
+class TooManyFailures(Exception):
+    '''
+    Raised while bisecting when more than MAX_DEAD_LETTERS tweets fail on their own
+    '''
+
+
+def execute(db_pg, statement, parameters=None):
+    '''
+    Runs one parameterised statement in its own transaction
+    Returns the rows it produced
+    '''
+    connection = db_pg.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(statement, parameters)
+        rows = cursor.fetchall() if cursor.description is not None else []
+        connection.commit()
+    finally:
+        connection.close()
+    return rows
+
+
+def create_batch_table(db_pg):
+    '''
+    Creates the batch state table
+    '''
+    db_pg.execute(f'''CREATE TABLE IF NOT EXISTS {BATCH_TABLE} (
+    batch_id BIGSERIAL PRIMARY KEY, first_id CHAR(24) NOT NULL, last_id CHAR(24) NOT NULL, \
+    tweet_count INTEGER NOT NULL, state VARCHAR(12) NOT NULL DEFAULT 'pending', \
+    attempts INTEGER NOT NULL DEFAULT 0, dead_letters INTEGER NOT NULL DEFAULT 0, \
+    last_error TEXT, created_at TIMESTAMPTZ NOT NULL DEFAULT now(), \
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), marked_at TIMESTAMPTZ);''')
+    db_pg.execute(f'''CREATE INDEX IF NOT EXISTS {BATCH_TABLE}_open ON {BATCH_TABLE} (batch_id) \
+    WHERE marked_at IS NULL;''')
+
+
+def open_batch(db_pg, tweets):
+    '''
+    Registers a batch of extracted tweets as pending
+    Returns its batch_id
+    '''
+    ids = [tweet.mongo_id for tweet in tweets]
+    rows = execute(db_pg, f'''INSERT INTO {BATCH_TABLE} (first_id, last_id, tweet_count) \
+    VALUES (%s, %s, %s) RETURNING batch_id;''', (str(min(ids)), str(max(ids)), len(tweets)))
+    return rows[0][0]
+
+
+def set_state(db_pg, batch_id, state):
+    '''
+    Moves a batch to state ('transformed', or 'loaded' after a bisected load)
+    '''
+    execute(db_pg, f'''UPDATE {BATCH_TABLE} SET state = %s, updated_at = now() \
+    WHERE batch_id = %s;''', (state, batch_id))
+
+
+def record_loaded(cursor, batch_id):
+    '''
+    Marks a batch loaded from inside the load transaction
+    '''
+    cursor.execute(f'''UPDATE {BATCH_TABLE} SET state = 'loaded', updated_at = now() \
+    WHERE batch_id = %s;''', (batch_id,))
+
+
+def record_failure(db_pg, batch_id, error):
+    '''
+    Counts a failed attempt; never raises (Postgres may be what failed)
+    '''
+    try:
+        execute(db_pg, f'''UPDATE {BATCH_TABLE} SET attempts = attempts + 1, last_error = %s, \
+        updated_at = now() WHERE batch_id = %s;''', (repr(error)[:1000], batch_id))
+    except Exception:
+        logging.exception('--- Could not record the failure of batch %s ---', batch_id)
+
+
+def record_marked(db_pg, batch_id, dead_letters=0):
+    '''
+    Notes that the batch's tweets are marked in MongoDB
+    '''
+    execute(db_pg, f'''UPDATE {BATCH_TABLE} SET marked_at = now(), updated_at = now(), \
+    dead_letters = dead_letters + %s WHERE batch_id = %s;''', (dead_letters, batch_id))
+
+
+def unfinished(db_pg):
+    '''
+    Returns [(batch_id, first_id, last_id, state)] of batches not yet marked in MongoDB,
+    oldest first; the _ids as ObjectIds
+    '''
+    rows = execute(db_pg, f'''SELECT batch_id, first_id, last_id, state FROM {BATCH_TABLE} \
+    WHERE marked_at IS NULL ORDER BY batch_id;''')
+    return [(batch_id, ObjectId(first_id), ObjectId(last_id), state)
+            for batch_id, first_id, last_id, state in rows]
+
+
+def prune(db_pg, retain_days=None):
+    '''
+    Deletes finished batches older than retain_days
+    '''
+    retain_days = retain_days or RETAIN_DAYS
+    execute(db_pg, f'''DELETE FROM {BATCH_TABLE} WHERE marked_at IS NOT NULL \
+    AND marked_at < now() - %s * INTERVAL '1 day';''', (retain_days,))
+
+
+def backoff(attempt):
+    '''
+    Seconds to wait before the given retry (1, 2, ...)
+    '''
+    return min(MAX_BACKOFF, BACKOFF * 2 ** (attempt - 1))
+
+
+def retry(work, db_pg=None, batch_id=None, retries=None):
+    '''
+    Calls work() until it succeeds
+    Transient errors are retried with backoff for as long as they last, others
+    up to retries times (default RETRIES). Failures are counted on the batch.
+    Returns (True, result), or (False, error) once the retries are used up
+    '''
+    retries = RETRIES if retries is None else retries
+    attempt = 0
+    failures = 0
+    while True:
+        try:
+            return True, work()
+        except Exception as error:
+            attempt += 1
+            transient = isinstance(error, TRANSIENT_ERRORS)
+            RETRIED.inc(kind='transient' if transient else 'error')
+            if db_pg is not None and batch_id is not None:
+                record_failure(db_pg, batch_id, error)
+            if not transient:
+                failures += 1
+                if failures > retries:
+                    logging.critical('--- Batch %s failed %s times: %r ---', batch_id, failures,
+                                     error)
+                    return False, error
+            delay = backoff(attempt)
+            logging.critical('--- Batch %s: %r, retrying in %s s ---', batch_id, error, delay)
+            time.sleep(delay)
+
+
+def retry_transient(work):
+    '''
+    Calls work(), waiting out connection trouble; other errors are raised
+    '''
+    succeeded, result = retry(work, retries=0)
+    if not succeeded:
+        raise result
+    return result
+
+
+def isolate(tweets, work, on_poison):
+    '''
+    Runs work() on halves of tweets, recursively, and passes tweets that
+    fail on their own to on_poison(tweet, error)
+    Transient errors are waited out (retry) rather than blamed on a tweet,
+    SETUP_ERRORS are raised
+    Returns the results of the parts that succeeded, concatenated
+    '''
+    succeeded, result = retry(lambda: work(tweets), retries=0)
+    if succeeded:
+        return result
+    if isinstance(result, SETUP_ERRORS):
+        raise result
+    if len(tweets) == 1:
+        on_poison(tweets[0], result)
+        return []
+    middle = len(tweets) // 2
+    return isolate(tweets[:middle], work, on_poison) + isolate(tweets[middle:], work, on_poison)
+
+
+def dead_letter(collection, tweet, batch_id, error):
+    '''
+    Stores a tweet that can't be processed in DEAD_LETTER (under its own _id, so
+    doing it twice is harmless) and takes it out of extraction
+    The extracted fields are read back from the tweet collection: transform
+    changes the record in place (coordinates, flags), and a dead letter should
+    hold the source values so that it can be replayed
+    '''
+    document = collection.find_one({'_id': tweet.mongo_id}, PROJECTION)
+    if document is None:
+        document = {field: getattr(tweet, field) for field in EXTRACT_FIELDS}
+    document.update({'_id': tweet.mongo_id, 'batch_id': batch_id, 'error': repr(error)[:1000],
+                     'failed_at': datetime.now(timezone.utc)})
+    collection.database[DEAD_LETTER].replace_one({'_id': tweet.mongo_id}, document, upsert=True)
+    collection.update_one({'_id': tweet.mongo_id}, {'$set': {'extracted': 'dead'}})
+    logging.critical('--- Dead-lettered tweet %s of batch %s: %r ---', tweet.tweet_ID, batch_id,
+                     error)
+
+
+def dead_letter_document(collection, document, error):
+    '''
+    Dead-letters a tweet document that isn't even a TweetRecord (fields missing
+    or of the wrong type), like dead_letter; documents without an _id are only logged
+    '''
+    if not isinstance(document, dict) or '_id' not in document:
+        logging.critical('--- Skipped malformed tweet document: %r ---', error)
+        return
+    stored = collection.find_one({'_id': document['_id']}, PROJECTION) or dict(document)
+    stored.update({'batch_id': None, 'error': repr(error)[:1000],
+                   'failed_at': datetime.now(timezone.utc)})
+    collection.database[DEAD_LETTER].replace_one({'_id': document['_id']}, stored, upsert=True)
+    collection.update_one({'_id': document['_id']}, {'$set': {'extracted': 'dead'}})
+    DEAD_LETTERED.inc()
+    logging.critical('--- Dead-lettered malformed tweet document %s: %r ---', document['_id'],
+                     error)
+
+
+def run_batch(work, tweets, collection, db_pg, batch_id):
+    '''
+    Runs work(tweets, batch_id) with retries. If the batch keeps failing, runs
+    work(part, None) on ever smaller parts and dead-letters the tweets that fail on
+    their own, then marks the batch loaded
+    SETUP_ERRORS are raised instead, leaving the batch unfinished
+    Returns (results, number of dead-lettered tweets)
+    '''
+    while True:
+        succeeded, result = retry(lambda: work(tweets, batch_id), db_pg, batch_id)
+        if succeeded:
+            return result, 0
+        if isinstance(result, SETUP_ERRORS):
+            logging.critical('--- Batch %s: setup error, not bisecting: %r ---', batch_id, result)
+            raise result
+        poison = []
+
+        def collect(tweet, error):
+            poison.append((tweet, error))
+            if len(poison) > MAX_DEAD_LETTERS:
+                raise TooManyFailures(f'more than {MAX_DEAD_LETTERS} tweets of batch {batch_id} '
+                                      f'fail on their own, last: {error!r}')
+
+        try:
+            results = isolate(tweets, lambda part: work(part, None), collect)
+        except TooManyFailures as error:
+            logging.critical('--- %s; retrying the batch in %s s ---', error, MAX_BACKOFF)
+            time.sleep(MAX_BACKOFF)
+            continue
+        for tweet, error in poison:
+            retry_transient(lambda: dead_letter(collection, tweet, batch_id, error))
+        DEAD_LETTERED.inc(len(poison))
+        retry_transient(lambda: set_state(db_pg, batch_id, 'loaded'))
+        return results, len(poison)
@@ -0,0 +1,149 @@
+'''
+Bulk loading of transformed tweets into Postgres.
+
+Each batch goes into a temporary staging table in one transaction:
+COPY FROM STDIN (psycopg2 copy_expert) where the driver supports it,
+executemany otherwise. From there it is upserted into the target table on
+its key (tweet_ID, created_at), so loading the same batch twice (e.g. after
+a crash between load and mark_extracted) doesn't duplicate rows.
+Generated columns (date, time, date_hour) are computed in the staging
+table already, so the hooks can group by them.
+Optional before_upsert/after_upsert hooks run inside the same transaction
+with (cursor, target table, staging table), e.g. to maintain aggregates.
+'''
+import io
+import logging
+import time
+
+import metrics
+
+# the tweet table's primary key; created_at is part of it because tweet_pg is partitioned on it
+TWEET_KEY = ('tweet_ID', 'created_at')
+
+TWEET_COLUMNS = ['tweet_ID', 'username', 'text', 'clean_text', 'handles', 'hashtags',
+                 'followers_count', 'was_retweeted', 'loc_lat', 'loc_lon', 'loc_type',
+                 'location', 'in_us', 'us_state', 'politician', 'created_at', 'sentiment',
+                 'extracted']
+
+ROWS_LOADED = metrics.counter('etl_rows_loaded_total',
+                              'Rows loaded into Postgres (repeat: already there or twice in a batch)',
+                              ('table', 'result'))
+LOAD_RATE = metrics.gauge('etl_load_rows_per_second',
+                          'Rows per second of the last batch loaded (COPY + upsert + hooks)',
+                          ('table',))
+
+ARRAY_SPECIAL = set('{}",\\ \t\n\r')
+
+
+def pg_array(values):
+    '''
+    Formats a list the way Postgres prints a text[] cast to TEXT,
+    i.e. what the per-row INSERT used to store for handles/hashtags
+    '''
+    items = []
+    for value in values:
+        value = str(value)
+        if not value or value.upper() == 'NULL' or ARRAY_SPECIAL.intersection(value):
+            value = '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        items.append(value)
+    return '{' + ','.join(items) + '}'
+
+
+def to_db(value):
+    '''
+    Converts a tweet field to what gets sent to Postgres
+    '''
+    if isinstance(value, (list, tuple)):
+        return pg_array(value)
+    return value
+
+
+def copy_field(value):
+    '''
+    Formats a value for COPY ... FROM STDIN in text format
+    '''
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def tweet_rows(transformed_tweets, columns=TWEET_COLUMNS):
+    '''
+    Turns transformed tweets (TweetRecords) into row tuples in column order
+    '''
+    return [tuple(to_db(getattr(tweet, column)) for column in columns)
+            for tweet in transformed_tweets]
+
+
+def copy_rows(cursor, table_name, columns, rows):
+    '''
+    Streams rows into table_name with a single COPY
+    '''
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_field(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table_name} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def insert_rows(cursor, table_name, columns, rows):
+    '''
+    Fallback for drivers without COPY support
+    '''
+    placeholders = ', '.join(['%s'] * len(columns))
+    cursor.executemany(
+        f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+def bulk_load(rows, pg_table_name, db_pg, columns=TWEET_COLUMNS, key=TWEET_KEY,
+              before_upsert=None, after_upsert=None):
+    '''
+    Loads rows into pg_table_name in one transaction, upserting on key
+    (a column name or a tuple of them, matching a unique index)
+    Returns the number of rows that were new (not updates of existing rows)
+    '''
+    if not rows:
+        return 0
+    start = time.perf_counter()
+    stage_name = f'{pg_table_name}_stage'
+    key = (key,) if isinstance(key, str) else tuple(key)
+    updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns if column not in key)
+    same_key = ' AND '.join(f'a.{column} = b.{column}' for column in key)
+    connection = db_pg.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f'''CREATE TEMP TABLE {stage_name} \
+        (LIKE {pg_table_name} INCLUDING DEFAULTS INCLUDING GENERATED) ON COMMIT DROP;''')
+        if hasattr(cursor, 'copy_expert'):
+            copy_rows(cursor, stage_name, columns, rows)
+        else:
+            insert_rows(cursor, stage_name, columns, rows)
+        # a batch may repeat a tweet; keep the last copy
+        cursor.execute(f'''DELETE FROM {stage_name} a USING {stage_name} b \
+        WHERE {same_key} AND a.ctid < b.ctid;''')
+        if before_upsert is not None:
+            before_upsert(cursor, pg_table_name, stage_name)
+        cursor.execute(f'''INSERT INTO {pg_table_name} ({', '.join(columns)}) \
+        SELECT {', '.join(columns)} FROM {stage_name} \
+        ON CONFLICT ({', '.join(key)}) DO UPDATE SET {updates} \
+        RETURNING (xmax = 0);''')
+        inserted = sum(1 for (is_new,) in cursor.fetchall() if is_new)
+        if after_upsert is not None:
+            after_upsert(cursor, pg_table_name, stage_name)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    elapsed = time.perf_counter() - start
+    ROWS_LOADED.inc(inserted, table=pg_table_name, result='new')
+    ROWS_LOADED.inc(len(rows) - inserted, table=pg_table_name, result='repeat')
+    rate = round(len(rows) / max(elapsed, 1e-9))
+    LOAD_RATE.set(rate, table=pg_table_name)
+    # per batch, so debug; the rate is on /metrics as etl_load_rows_per_second
+    logging.debug('--- Loaded %s tweets into %s (%s new) at %s rows/s ---',
+                  len(rows), pg_table_name, inserted, rate)
+    return inserted
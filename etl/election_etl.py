@@ -1,9 +1,10 @@
 import time
 import logging
+import math
 import re
-import json
-from urllib.request import urlopen
-from datetime import datetime
+import argparse
+from functools import partial
+from datetime import datetime, timezone
 
 from pymongo import MongoClient
 from sqlalchemy import create_engine
@@ -11,51 +12,44 @@ from sqlalchemy import create_engine
 from spacy.lang.en import English
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
-from shapely.geometry import Point, Polygon
+from shapely.geometry import Point
+
+import batch_state
+import export
+import geometry
+import metrics
+import parallel_transform
+import stream_etl
+import text_cache
+import schema
+from schema import create_table, ensure_partitions, archive_partitions
+from text_cache import TextCache
+from tweet_record import TweetRecord, PROJECTION
+from bulk_load import bulk_load, tweet_rows
+from aggregates import create_aggregates, rebuild_aggregates, capture_previous, apply_deltas
 
 from credentials import *
 
-# initialise NLP tools
-SENT_ANALYSIS = SentimentIntensityAnalyzer()
-NLP = English()
-
-# set up data for USA outline & states
-with urlopen('https://raw.githubusercontent.com/johan/world.geo.json/master/countries/USA.geo.json') as usa_url:
-    USA_TOTAL = json.load(usa_url)
-
-with urlopen('https://raw.githubusercontent.com/PublicaMundi/MappingAPI/master/data/geojson/us-states.json') as states_url:
-    USA_STATES = json.load(states_url)
-
-def make_polygon_list(state):
-    '''
-    Returns list object containing polygon(s) that make up the state
-    state is feature level of USA geojson
-    '''
-    if state['geometry']['type'] == 'Polygon':
-        list_of_polygons = [Polygon(state['geometry']['coordinates'][0])]
-    else:
-        list_of_polygons = [Polygon(x[0]) for x in state['geometry']['coordinates']]
-    return list_of_polygons
+EXTRACT_BATCH_SIZE = 1000
 
-LIST_STATES = [state['properties']['name'] for state in USA_STATES['features']]
+STAGE_SECONDS = metrics.histogram('etl_stage_seconds', 'Time per batch and stage '
+                                  '(load excludes the aggregate hooks)', ('stage',))
+TWEETS_EXTRACTED = metrics.counter('etl_tweets_extracted_total', 'Tweets read from MongoDB')
 
-ALL_POLYGON_LISTS = [make_polygon_list(state) for state in USA_STATES['features']]
+MONTHS = {month: number for number, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
 
-STATE_DICT = dict(zip(LIST_STATES, ALL_POLYGON_LISTS))
-
-USA_POLY_LIST = make_polygon_list(USA_TOTAL['features'][0])
-# This geojson is missing some large chunks of Alaska and all of Puerto Rico.
-# steps:
-# 1. remove existing Alaska shape
-# 2. re-add the more detailed Alaska and Puerto Rico shapes manually
-# (taken from PublicaMundi source)
-USA_POLY_LIST = USA_POLY_LIST[:-1]
-TO_APPEND = ['Alaska', 'Puerto Rico']
-for state in TO_APPEND:
-    for poly in STATE_DICT[state]:
-        USA_POLY_LIST.append(poly)
+# initialise NLP tools
+SENT_ANALYSIS = SentimentIntensityAnalyzer()
+NLP = English()
+TOKENIZER_BATCH_SIZE = 1000
 
-USA_DICT = {'United States of America' : USA_POLY_LIST}
+# @handles and #hashtags (same matches as the former separate patterns)
+ENTITY_PATTERN = re.compile(r'\B[@#]\w+')
+# tokens always dropped from clean_text
+STOP_TOKENS = frozenset(['RT', 'amp', '\n'])
+# get_coords for coordinates no boundary can contain (NaN, infinite): 'other', as before
+OFF_MAP = 'other'
 
 def is_point_in_state(point, list_of_polygons):
     '''
@@ -72,9 +66,11 @@ def get_state(tweet, search_space):
     Finds out which boundary a point is within
     When search_space is state_dict, returns state
     When search_space is usa_dict, returns whether point is in USA or not
+    (both dicts come from geometry.load_boundaries)
+    Polygon-by-polygon reference version; transform uses get_states
     '''
-    if tweet['location'] not in ['no_loc', 'none']:
-        point = Point([float(tweet['loc_lon']), float(tweet['loc_lat'])])
+    if tweet.location not in ['no_loc', 'none']:
+        point = Point([float(tweet.loc_lon), float(tweet.loc_lat)])
         for place in search_space.items():
             if is_point_in_state(point, place[1]):
                 state_name = place[0]
@@ -85,6 +81,50 @@ def get_state(tweet, search_space):
         state_name = 'no_loc'
     return state_name
 
+def get_coords(tweet):
+    '''
+    Returns (lon, lat) as floats, or None for tweets without usable coordinates
+    NaN or infinite coordinates come back as OFF_MAP: outside every boundary
+    '''
+    if tweet.location in ['no_loc', 'none']:
+        return None
+    try:
+        coords = float(tweet.loc_lon), float(tweet.loc_lat)
+    except (TypeError, ValueError):
+        # e.g. a place name the collector could not geocode
+        return None
+    if not (math.isfinite(coords[0]) and math.isfinite(coords[1])):
+        return OFF_MAP
+    return coords
+
+def get_states(tweets):
+    '''
+    Finds out for a batch of tweets whether each is in the USA and which state,
+    with one lookup per tweet in the (lazily loaded) state index
+    Returns two lists (in_us, us_state) in the same order as tweets
+    '''
+    in_us = ['no_loc'] * len(tweets)
+    us_state = ['no_loc'] * len(tweets)
+    located = []
+    lons = []
+    lats = []
+    for position, tweet in enumerate(tweets):
+        coords = get_coords(tweet)
+        if coords == OFF_MAP:
+            in_us[position] = OFF_MAP
+            us_state[position] = OFF_MAP
+        elif coords is not None:
+            located.append(position)
+            lons.append(coords[0])
+            lats.append(coords[1])
+    if not located:
+        return in_us, us_state
+    found_us, found_state = geometry.get_state_index().locate_many(lons, lats)
+    for position, country, state in zip(located, found_us, found_state):
+        in_us[position] = country
+        us_state[position] = state
+    return in_us, us_state
+
 def mongo_connect(db_name, collection_name):
     '''
     Connects to MongoDB database
@@ -94,6 +134,7 @@ def mongo_connect(db_name, collection_name):
     client = MongoClient(host=MDB_HOST, port=MDB_PORT)
     collection_name = getattr(client, db_name)
     tweets = collection_name.tweet
+    tweets.create_index([('extracted', 1), ('_id', 1)])
     logging.critical('Connected to MongoDB database %s\n*\n*\n*', db_name)
     return tweets
 
@@ -102,160 +143,230 @@ def postgres_connect():
     Connects to postgres database
     '''
     db_pg_string = f'postgres://{PG_USER}:{PG_PASSWORD}@{PG_HOST}:{PG_PORT}'
-    db_pg = create_engine(db_pg_string, echo=True)
+    db_pg = create_engine(db_pg_string, echo=False)
     logging.critical('\n*\n*\n*Connected to Postgres database\n*\n*\n*')
     return db_pg
 
-def create_table(table_name, db_pg):
+def load_checkpoint(collection_name):
     '''
-    Creates table in Postgres database
+    Returns the extract high-water mark: the _id of the last tweet
+    in the last batch that made it into Postgres (None on first run)
     '''
-    create_table_query = f"""CREATE TABLE IF NOT EXISTS {table_name} (
-    tweet_ID VARCHAR(50), username VARCHAR(50), text TEXT, clean_text TEXT, \
-    handles TEXT, hashtags TEXT, followers_count BIGINT, \
-    was_retweeted VARCHAR(50), loc_lat VARCHAR(50), loc_lon VARCHAR(50), \
-    loc_type VARCHAR(50), location VARCHAR(50), in_us VARCHAR(50), \
-    us_state VARCHAR(50), politician VARCHAR(50), date DATE, time VARCHAR(15), \
-    date_hour VARCHAR(15), sentiment REAL, extracted VARCHAR(5) );"""
-    logging.critical('\n*\n*\n--- Creating table in Postgres database ---\n*\n*\n*')
-    db_pg.execute(create_table_query)
+    checkpoint = collection_name.database.etl_checkpoint.find_one({'_id': 'extract'})
+    return checkpoint['last_id'] if checkpoint else None
 
-def extract(collection_name):
+def read_records(collection_name, documents):
     '''
-    Extract previously unextracted tweets from MongoDB database
-    Marks them as extracted
+    TweetRecords of extracted documents; malformed ones are dead-lettered
     '''
-    logging.critical('\n*\n*\n--- Extracting tweets ---\n*\n*\n*')
-    extracted_tweets = list(collection_name.find({'extracted': 'no'}))
-    logging.critical('\n*\n*\n--- Found %s tweets to extract ---\n*\n*\n*', len(extracted_tweets))
-    for tweet in extracted_tweets:
-        collection_name.update_one({'tweet_ID': tweet['tweet_ID']}, {'$set' : {'extracted' : 'yes'}})
+    records = []
+    for document in documents:
+        try:
+            records.append(TweetRecord.from_document(document))
+        except (KeyError, TypeError) as error:
+            batch_state.dead_letter_document(collection_name, document, error)
+    return records
+
+def extract(collection_name, after=None, batch_size=EXTRACT_BATCH_SIZE):
+    '''
+    Extract the next batch of previously unextracted tweets from MongoDB database,
+    in _id order and starting after the high-water mark
+    Does not mark them as extracted: that happens in mark_extracted, after loading
+    ObjectIds don't always arrive in _id order (several writers, client clocks):
+    tweets inserted below the high-water mark are picked up by sweep
+    Only the fields the ETL uses are fetched; returns TweetRecords
+    '''
+    query = {'extracted': 'no'}
+    if after is not None:
+        query['_id'] = {'$gt': after}
+    with STAGE_SECONDS.time(stage='extract'):
+        cursor = collection_name.find(query, PROJECTION).sort('_id', 1).limit(batch_size) \
+            .batch_size(batch_size)
+        extracted_tweets = read_records(collection_name, cursor)
+    TWEETS_EXTRACTED.inc(len(extracted_tweets))
+    logging.debug('--- Found %s tweets to extract ---', len(extracted_tweets))
     return extracted_tweets
 
-def get_date_and_time(tweet):
+def extract_below(collection_name, last_id, batch_size=EXTRACT_BATCH_SIZE):
     '''
-    Splits Twitter 'created_by' field into date and time
+    Extracts unextracted tweets at or below the high-water mark, in _id order
     '''
-    if isinstance(tweet, str):
-        date = datetime.strptime(str(tweet), '%a %b %d %H:%M:%S %z %Y').date()
-        tweet_time = datetime.strptime(str(tweet), '%a %b %d %H:%M:%S %z %Y').time()
-    else:
-        date = datetime.strptime(str(tweet), '%Y-%m-%d %H:%M:%S').date()
-        tweet_time = datetime.strptime(str(tweet), '%Y-%m-%d %H:%M:%S').time()
-    date_hour = str(date) + ' ' + str(tweet_time)
-    date_hour = date_hour[:-6]
-    return date, tweet_time, date_hour
+    query = {'extracted': 'no', '_id': {'$lte': last_id}}
+    cursor = collection_name.find(query, PROJECTION).sort('_id', 1).limit(batch_size) \
+        .batch_size(batch_size)
+    extracted_tweets = read_records(collection_name, cursor)
+    TWEETS_EXTRACTED.inc(len(extracted_tweets))
+    return extracted_tweets
 
-def get_handles_hashtags(text):
+def extract_range(collection_name, first_id, last_id):
     '''
-    Returns a list of hashtags and user handles in the text
+    Extracts the unextracted tweets of an earlier batch again, by its _id range
     '''
-    handles = re.findall('\B\@\w+', text)
-    hashtags = re.findall('\B\#\w+', text)
-    return handles, hashtags
+    query = {'extracted': 'no', '_id': {'$gte': first_id, '$lte': last_id}}
+    cursor = collection_name.find(query, PROJECTION).sort('_id', 1)
+    return read_records(collection_name, cursor)
 
-def clean_text(text, handles, hashtags):
+def mark_extracted(collection_name, extracted_tweets):
     '''
-    Returns text that has been tokenised and stripped of handles, hashtags, RT abbreviations and URLs
+    Marks a loaded batch as extracted in one update_many
+    and moves the high-water mark up to its highest _id (never back)
+    Dead-lettered tweets keep extracted: 'dead'
+    Returns the batch's highest _id
     '''
-    combined = handles + hashtags + ['RT', 'amp', '\n']
-    doc = NLP(text)
-    stripped = [token.orth_ for token in doc if not token.is_punct]
-    cleaned = [str(word) for word in stripped if word not in combined and not word.startswith('https')]
-    cleaned = ' '.join(cleaned)
-    return cleaned
+    tweet_ids = [tweet.mongo_id for tweet in extracted_tweets]
+    last_id = max(tweet_ids)
+    collection_name.update_many({'_id': {'$in': tweet_ids}, 'extracted': 'no'},
+                                {'$set' : {'extracted' : 'yes'}})
+    collection_name.database.etl_checkpoint.update_one(
+        {'_id': 'extract'}, {'$max': {'last_id': last_id}}, upsert=True)
+    return last_id
 
-def analyse_sentiment(tweet):
+def parse_created_at(timestamp):
     '''
-    Simple lexical approach to sentiment analysis using VADER
-    Returns compound sentiment score
+    Returns the Twitter 'created_at' field as a timezone-aware datetime
+    'Tue Oct 20 14:03:22 +0000 2020' is sliced directly, anything else goes through strptime
+    Older documents may hold a naive datetime (UTC) instead of the string
     '''
-    sentiment = SENT_ANALYSIS.polarity_scores(tweet)
-    return sentiment['compound']
+    if isinstance(timestamp, datetime):
+        return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+    if len(timestamp) == 30 and timestamp[19:26] == ' +0000 ' and timestamp[4:7] in MONTHS:
+        return datetime(int(timestamp[26:]), MONTHS[timestamp[4:7]], int(timestamp[8:10]),
+                        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+                        tzinfo=timezone.utc)
+    try:
+        return datetime.strptime(timestamp, '%a %b %d %H:%M:%S %z %Y')
+    except ValueError:
+        return datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
 
-def transform(extracted_tweets):
+def parse_timestamps(timestamps):
     '''
-    Transform data and return sentiment analysis
+    Parses a batch of timestamps, each distinct value once
+    (tweets stream in at many per second, so a batch repeats the same created_at a lot)
     '''
-    transformed_tweets = []
-    for tweet in extracted_tweets:
-        tweet['handles'], tweet['hashtags'] = get_handles_hashtags(tweet['text'])
-        tweet['clean_text'] = clean_text(tweet['text'], tweet['handles'], tweet['hashtags'])
-        tweet['sentiment'] = analyse_sentiment(tweet['clean_text'])
-        tweet['date'], tweet['time'], tweet['date_hour'] = get_date_and_time(tweet['timestamp'])
-        tweet['in_us'] = get_state(tweet, USA_DICT)
-        tweet['us_state'] = get_state(tweet, STATE_DICT)
-        transformed_tweets.append(tweet)
-    return transformed_tweets
+    parsed = {}
+    for timestamp in timestamps:
+        if timestamp not in parsed:
+            parsed[timestamp] = parse_created_at(timestamp)
+    return [parsed[timestamp] for timestamp in timestamps]
 
+def to_coordinate(value):
+    '''
+    Returns a coordinate as float, None for 'no_loc' and anything else that isn't a number
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
 
-def load(transformed_tweets, pg_table_name, db_pg):
+def get_handles_hashtags(text):
     '''
-    Load transformed data into postgres database
-    Takes db name as string
+    Returns (handles, hashtags) found in one scan of the text, in order of appearance
     '''
-    for tweet in transformed_tweets:
-        insert_query = f"INSERT INTO {pg_table_name} VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
-        db_pg.execute(insert_query, (tweet['tweet_ID'], tweet['username'], tweet['text'], tweet['clean_text'], tweet['handles'], tweet['hashtags'], tweet['followers_count'], tweet['was_retweeted'], tweet['loc_lat'], tweet['loc_lon'], tweet['loc_type'], tweet['location'], tweet['in_us'], tweet['us_state'], tweet['politician'], tweet['date'], tweet['time'], tweet['date_hour'], tweet['sentiment'], tweet['extracted']))
-        logging.critical('*\n*\n--- Inserting new tweet into postgres ---\n*\n*')
+    handles = []
+    hashtags = []
+    for entity in ENTITY_PATTERN.findall(text):
+        if entity[0] == '@':
+            handles.append(entity)
+        else:
+            hashtags.append(entity)
+    return handles, hashtags
 
-def execute_updates(drop_query, table_query, agg_query, db_pg):
+def clean_doc(doc, handles, hashtags):
     '''
-    Bundles update execution
+    Joins the tokens of a tokenized tweet, leaving out punctuation, handles,
+    hashtags, links and STOP_TOKENS
     '''
-    db_pg.execute(drop_query)
-    db_pg.execute(table_query)
-    db_pg.execute(agg_query)
+    combined = STOP_TOKENS.union(handles, hashtags)
+    cleaned = [token.orth_ for token in doc if not token.is_punct
+               and token.orth_ not in combined and not token.orth_.startswith('https')]
+    return ' '.join(cleaned)
 
-def update_sentiment_table(pg_table_name, db_pg):
+def clean_text(text, handles, hashtags):
     '''
-    Updates aggregate table of mean sentiment per date_hour and politician in Postgres database
+    Returns text that has been tokenised and stripped of handles, hashtags, RT abbreviations and URLs
     '''
-    drop_query = f'''DROP TABLE IF EXISTS agg_sentiment;'''
-    table_query = f'''CREATE TABLE agg_sentiment (avg REAL, \
-    date_hour VARCHAR(50), politician VARCHAR(50) );'''
-    agg_query = f'''INSERT INTO agg_sentiment SELECT AVG(sentiment), \
-    date_hour, politician FROM {pg_table_name} GROUP BY date_hour, politician \
-    ORDER BY date_hour;'''
-    execute_updates(drop_query, table_query, agg_query, db_pg)
-    logging.critical('\n*\n*\n--- Updated table agg_sentiment ---\n*\n*')
+    return clean_doc(NLP.tokenizer(text), handles, hashtags)
 
-def update_states_table(pg_table_name, db_pg):
+def clean_texts(texts, handles_list, hashtags_list):
     '''
-    Updates aggregate table of sentiment by politician, state in Postgres database
+    Batch version of clean_text: tokenizes all texts in one NLP.tokenizer.pipe call
     '''
-    drop_query = f'''DROP TABLE IF EXISTS agg_state_sentiment;'''
-    table_query = f'''CREATE TABLE agg_state_sentiment (avg REAL, \
-    us_state VARCHAR(50), date VARCHAR(20), politician VARCHAR(50) );'''
-    agg_query = f'''INSERT INTO agg_state_sentiment SELECT AVG(sentiment), \
-    us_state, date, politician FROM {pg_table_name} GROUP BY  politician, \
-    date, us_state ORDER BY date;'''
-    execute_updates(drop_query, table_query, agg_query, db_pg)
-    logging.critical('*\n*\n--- Updated table agg_state_sentiment ---\n*\n*')
+    docs = NLP.tokenizer.pipe(texts, batch_size=TOKENIZER_BATCH_SIZE)
+    return [clean_doc(doc, handles, hashtags)
+            for doc, handles, hashtags in zip(docs, handles_list, hashtags_list)]
 
-def update_states_no_politicians(pg_table_name, db_pg):
+def analyse_sentiment(tweet):
     '''
-    Updates aggregate table of sentiment by state in Postgres database (no segmentation by politician!)
+    Simple lexical approach to sentiment analysis using VADER
+    Returns compound sentiment score
+    '''
+    sentiment = SENT_ANALYSIS.polarity_scores(tweet)
+    return sentiment['compound']
+
+def analyse_texts(texts):
     '''
-    drop_query = f'''DROP TABLE IF EXISTS agg_noticket_state_sentiment;'''
-    table_query = f'''CREATE TABLE agg_noticket_state_sentiment (avg REAL, \
-    us_state VARCHAR(50) );'''
-    agg_query = f'''INSERT INTO agg_noticket_state_sentiment \
-    SELECT AVG(sentiment), us_state FROM {pg_table_name} GROUP BY us_state;'''
-    execute_updates(drop_query, table_query, agg_query, db_pg)
-    logging.critical('*\n*\n--- Updated table agg_noticket_state_sentiment ---\n*\n*')
+    Extracts entities, cleans and scores each distinct text once
+    Returns {text: (handles, hashtags, clean_text, sentiment)}, handles and hashtags as tuples
+    '''
+    unique_texts = list(dict.fromkeys(texts))
+    entities = [get_handles_hashtags(text) for text in unique_texts]
+    cleaned = clean_texts(unique_texts, [handles for handles, _ in entities],
+                          [hashtags for _, hashtags in entities])
+    return {text: (tuple(handles), tuple(hashtags), clean, analyse_sentiment(clean))
+            for text, (handles, hashtags), clean in zip(unique_texts, entities, cleaned)}
 
-def update_counts_table(pg_table_name, db_pg):
+def transform(extracted_tweets):
     '''
-    Updates aggregate table of sentiment by date_hour, politician, state in Postgres database
+    Transform data and return sentiment analysis
+    Tweets that already have a clean_text (filled in from the text cache) are not analysed again
+    Tweets with the same text share one handles and one hashtags tuple
+    '''
+    pending = [tweet for tweet in extracted_tweets if tweet.clean_text is None]
+    analysed = analyse_texts([tweet.text for tweet in pending])
+    for tweet in pending:
+        tweet.handles, tweet.hashtags, tweet.clean_text, tweet.sentiment = analysed[tweet.text]
+    created_at = parse_timestamps([tweet.timestamp for tweet in extracted_tweets])
+    transformed_tweets = []
+    for tweet, timestamp in zip(extracted_tweets, created_at):
+        tweet.created_at = timestamp
+        tweet.loc_lat = to_coordinate(tweet.loc_lat)
+        tweet.loc_lon = to_coordinate(tweet.loc_lon)
+        tweet.was_retweeted = tweet.was_retweeted in (True, 'true')
+        transformed_tweets.append(tweet)
+    in_us, us_state = get_states(transformed_tweets)
+    for tweet, country, state in zip(transformed_tweets, in_us, us_state):
+        tweet.in_us = country
+        tweet.us_state = state
+    return transformed_tweets
+
+
+def load(transformed_tweets, pg_table_name, db_pg, batch_id=None):
     '''
-    drop_query = f'''DROP TABLE IF EXISTS agg_count;'''
-    table_query = f'''CREATE TABLE agg_count (count BIGINT, date VARCHAR(20), \
-    politician VARCHAR(50) );'''
-    agg_query = f'''INSERT INTO agg_count SELECT COUNT(*), date, politician \
-    FROM {pg_table_name} GROUP BY date, politician ORDER BY date;'''
-    execute_updates(drop_query, table_query, agg_query, db_pg)
-    logging.critical('*\n*\n--- Updated table agg_count ---\n*\n*')
+    Load transformed data into postgres database
+    Takes db name as string
+    The whole batch goes in one transaction (COPY into a staging table, then
+    an upsert on tweet_ID, created_at), so reloading a batch doesn't duplicate rows
+    The aggregate sums are updated for the batch in the same transaction, and
+    so is its state in batch_state.BATCH_TABLE when batch_id is given
+    The daily partitions the batch needs are created first
+    Returns the number of new rows
+    '''
+    started = time.perf_counter()
+    aggregate_time = metrics.Stopwatch()
+
+    def after_upsert(cursor, pg_table_name, stage_name):
+        apply_deltas(cursor, pg_table_name, stage_name)
+        if batch_id is not None:
+            batch_state.record_loaded(cursor, batch_id)
+
+    ensure_partitions(pg_table_name, db_pg, {tweet.created_at.astimezone(timezone.utc).date()
+                                             for tweet in transformed_tweets})
+    inserted = bulk_load(tweet_rows(transformed_tweets), pg_table_name, db_pg,
+                         before_upsert=aggregate_time.wrap(capture_previous),
+                         after_upsert=aggregate_time.wrap(after_upsert))
+    STAGE_SECONDS.observe(time.perf_counter() - started - aggregate_time.seconds, stage='load')
+    STAGE_SECONDS.observe(aggregate_time.seconds, stage='aggregate')
+    return inserted
 
 def setup():
     '''
@@ -264,23 +375,204 @@ def setup():
     postgres_tweets = mongo_connect('tweet_mongodb', 'tweet_db')
     db_pg = postgres_connect()
     create_table('tweet_pg', db_pg)
-    return postgres_tweets, db_pg
+    create_aggregates('tweet_pg', db_pg)
+    batch_state.create_batch_table(db_pg)
+    analysis_cache = TextCache(db_pg=db_pg if text_cache.PERSIST else None)
+    return postgres_tweets, db_pg, analysis_cache
+
+def transform_and_load(db_pg, analysis_cache, extracted_tweets, batch_id=None):
+    '''
+    Transforms and loads tweets (a batch, or part of one when batch_id is None)
+    Texts seen before take their analysis from analysis_cache.
+    With --export-dir the loaded tweets are also appended to the Parquet export.
+    Returns the transformed tweets
+    '''
+    with STAGE_SECONDS.time(stage='transform'):
+        analysis_cache.fill(extracted_tweets)
+        transformed_tweets = parallel_transform.parallel_transform(transform, extracted_tweets)
+    if batch_id is not None:
+        batch_state.set_state(db_pg, batch_id, 'transformed')
+    load(transformed_tweets, 'tweet_pg', db_pg, batch_id)
+    if export.EXPORT_DIR:
+        with STAGE_SECONDS.time(stage='export'):
+            export.export_batch(transformed_tweets)
+    return transformed_tweets
 
-def main():
+def process_batch(postgres_tweets, db_pg, analysis_cache, extracted_tweets, batch_id=None):
+    '''
+    Transforms and loads one batch, then marks it as extracted
+    The batch is numbered in batch_state.BATCH_TABLE first (unless it is an
+    unfinished one being resumed) and only marked as extracted once it is in
+    Postgres, so a crash mid-batch means the batch is redone (at-least-once,
+    see resume_batches). Failures are retried with backoff; tweets that keep
+    failing on their own are dead-lettered (batch_state.run_batch).
+    Stage timings go to STAGE_SECONDS; a requested profile covers one batch
+    (in batch mode, the whole run, see main).
+    Returns the new high-water mark
+    '''
+    with metrics.PROFILER.cycle('etl-batch'):
+        if batch_id is None:
+            batch_id = batch_state.retry_transient(
+                lambda: batch_state.open_batch(db_pg, extracted_tweets))
+        transformed_tweets, dead_letters = batch_state.run_batch(
+            partial(transform_and_load, db_pg, analysis_cache), extracted_tweets,
+            postgres_tweets, db_pg, batch_id)
+        with STAGE_SECONDS.time(stage='mark'):
+            checkpoint = batch_state.retry_transient(
+                lambda: mark_extracted(postgres_tweets, extracted_tweets))
+            batch_state.retry_transient(
+                lambda: batch_state.record_marked(db_pg, batch_id, dead_letters))
+            batch_state.retry_transient(lambda: analysis_cache.store(transformed_tweets))
+    return checkpoint
+
+def resume_batches(postgres_tweets, db_pg, analysis_cache):
+    '''
+    Finishes the batches a previous run left unfinished (crash, restart):
+    loaded ones are only marked as extracted, the others are redone
+    '''
+    for batch_id, first_id, last_id, state in batch_state.unfinished(db_pg):
+        logging.critical('\n*\n*\n--- Resuming batch %s (%s) ---\n*\n*', batch_id, state)
+        extracted_tweets = extract_range(postgres_tweets, first_id, last_id)
+        if extracted_tweets and state != 'loaded':
+            process_batch(postgres_tweets, db_pg, analysis_cache, extracted_tweets, batch_id)
+            continue
+        if extracted_tweets:
+            mark_extracted(postgres_tweets, extracted_tweets)
+        batch_state.record_marked(db_pg, batch_id)
+
+def run_batches(postgres_tweets, db_pg, analysis_cache):
+    '''
+    Extracts, transforms and loads unextracted tweets batch by batch.
+    '''
+    logging.critical('\n*\n*\n--- Extracting tweets ---\n*\n*\n*')
+    resume_batches(postgres_tweets, db_pg, analysis_cache)
+    checkpoint = load_checkpoint(postgres_tweets)
+    while True:
+        extracted_tweets = extract(postgres_tweets, checkpoint)
+        if not extracted_tweets:
+            break
+        checkpoint = process_batch(postgres_tweets, db_pg, analysis_cache, extracted_tweets)
+
+def sweep(postgres_tweets, db_pg, analysis_cache):
     '''
-    All systems go! Extract, transform and load new tweets every 10 minutes.
+    Processes the tweets a batch past them moved the high-water mark over
+    (inserted late, with an older _id), which extract never sees again
+    Returns the number of tweets swept
     '''
-    postgres_tweets, db_pg = setup()
+    checkpoint = load_checkpoint(postgres_tweets)
+    if checkpoint is None:
+        return 0
+    swept = 0
     while True:
-        extracted_tweets = extract(postgres_tweets)
-        transformed_tweets = transform(extracted_tweets)
-        load(transformed_tweets, 'tweet_pg', db_pg)
-        update_sentiment_table('tweet_pg', db_pg)
-        update_states_table('tweet_pg', db_pg)
-        update_counts_table('tweet_pg', db_pg)
-        update_states_no_politicians('tweet_pg', db_pg)
-        logging.critical('... sleeping for 10 minutes')
-        time.sleep(600)
+        extracted_tweets = extract_below(postgres_tweets, checkpoint)
+        if not extracted_tweets:
+            break
+        process_batch(postgres_tweets, db_pg, analysis_cache, extracted_tweets)
+        swept += len(extracted_tweets)
+    if swept:
+        logging.critical('--- Swept %s tweets below the high-water mark ---', swept)
+    return swept
+
+def finish_cycle(postgres_tweets, db_pg, analysis_cache):
+    '''
+    Housekeeping after each batch run (every stream_etl.PERIODIC_INTERVAL in stream mode):
+    sweeping up tweets below the high-water mark, cache statistics, partition and batch
+    state retention and, with --export-dir, compacting finished days of the Parquet
+    export and refreshing the dashboard snapshots
+    '''
+    sweep(postgres_tweets, db_pg, analysis_cache)
+    analysis_cache.end_cycle()
+    archive_partitions('tweet_pg', db_pg)
+    batch_state.prune(db_pg)
+    if export.EXPORT_DIR:
+        export.compact()
+        export.write_snapshots(db_pg)
+
+def parse_args():
+    '''
+    Command line options
+    '''
+    parser = argparse.ArgumentParser(description='Tweet ETL: MongoDB -> Postgres')
+    parser.add_argument('--mode', choices=['batch', 'stream'], default='batch',
+                        help='batch: run every 10 minutes; stream: follow inserts in micro-batches')
+    parser.add_argument('--micro-batch-size', type=int, default=stream_etl.MAX_BATCH,
+                        help='stream mode: most tweets per micro-batch')
+    parser.add_argument('--micro-batch-wait', type=float, default=stream_etl.MAX_WAIT,
+                        help='stream mode: seconds a tweet waits for its micro-batch to fill')
+    parser.add_argument('--fetch-boundaries', action='store_true',
+                        help='download boundary geometry if geometry.BOUNDARY_PATH is missing')
+    parser.add_argument('--rebuild-aggregates', action='store_true',
+                        help='recompute the aggregate tables from tweet_pg and exit')
+    parser.add_argument('--transform-workers', type=int, default=parallel_transform.WORKERS,
+                        help='processes for the transform stage (1 = in-process)')
+    parser.add_argument('--transform-chunk-size', type=int, default=parallel_transform.CHUNK_SIZE,
+                        help='tweets per transform task')
+    parser.add_argument('--retain-days', type=int, default=schema.RETAIN_DAYS,
+                        help='detach daily partitions of tweet_pg older than this many days')
+    parser.add_argument('--drop-archived', action='store_true',
+                        help='drop partitions past --retain-days instead of keeping them detached')
+    parser.add_argument('--batch-retries', type=int, default=batch_state.RETRIES,
+                        help='retries of a failing batch before its bad tweets are dead-lettered')
+    parser.add_argument('--persist-text-cache', action='store_true',
+                        help='keep the text analysis cache in Postgres across restarts')
+    parser.add_argument('--export-dir',
+                        help='also write loaded tweets as Parquet and the dashboard views as '
+                        'JSON/Arrow snapshots under this directory (needs pyarrow)')
+    parser.add_argument('--metrics-port', type=int, default=9102,
+                        help='serve /metrics (Prometheus) and /metrics.json on this port (0: off)')
+    parser.add_argument('--metrics-dump', help='also write the metrics as JSON to this file')
+    parser.add_argument('--profile-cycles', type=int, default=0,
+                        help='profile the first N cycles (kill -USR1 profiles the next one)')
+    parser.add_argument('--profiler', choices=['cprofile', 'sampling'], default=metrics.PROFILE_KIND,
+                        help='cprofile: main process, by function; sampling: stacks of all threads')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='DEBUG shows a line per batch')
+    return parser.parse_args()
+
+def main():
+    '''
+    All systems go! Extract, transform and load new tweets every 10 minutes,
+    or as they come in with --mode stream.
+    Aggregates are kept up to date as part of each load.
+    '''
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+    geometry.ALLOW_DOWNLOAD = args.fetch_boundaries
+    parallel_transform.WORKERS = args.transform_workers
+    parallel_transform.CHUNK_SIZE = args.transform_chunk_size
+    text_cache.PERSIST = args.persist_text_cache
+    schema.RETAIN_DAYS = args.retain_days
+    schema.DROP_ARCHIVED = args.drop_archived
+    batch_state.RETRIES = args.batch_retries
+    stream_etl.MAX_BATCH = args.micro_batch_size
+    stream_etl.MAX_WAIT = args.micro_batch_wait
+    export.EXPORT_DIR = args.export_dir
+    if export.EXPORT_DIR:
+        export.require_pyarrow()
+    metrics.PROFILE_KIND = args.profiler
+    postgres_tweets, db_pg, analysis_cache = setup()
+    if args.rebuild_aggregates:
+        rebuild_aggregates('tweet_pg', db_pg)
+        return
+    metrics.start(args.metrics_port or None, args.metrics_dump, args.profile_cycles)
+    try:
+        while args.mode == 'stream':
+            resume_batches(postgres_tweets, db_pg, analysis_cache)
+            runner = stream_etl.StreamRunner(
+                postgres_tweets, extract,
+                partial(process_batch, postgres_tweets, db_pg, analysis_cache),
+                load_checkpoint(postgres_tweets),
+                periodic=partial(finish_cycle, postgres_tweets, db_pg, analysis_cache),
+                reject=partial(batch_state.dead_letter_document, postgres_tweets))
+            runner.run()
+        while True:
+            with metrics.PROFILER.cycle('etl-cycle'):
+                run_batches(postgres_tweets, db_pg, analysis_cache)
+                finish_cycle(postgres_tweets, db_pg, analysis_cache)
+            logging.critical('... sleeping for 10 minutes')
+            time.sleep(600)
+    finally:
+        parallel_transform.close_pool()
 
 
 #########
@@ -0,0 +1,288 @@
+'''
+Columnar export of the loaded tweets and the dashboard aggregates.
+
+With EXPORT_DIR set (election_etl.py --export-dir), every loaded batch is
+also written as Parquet, partitioned Hive-style by UTC day and politician:
+
+    EXPORT_DIR/tweets/date=2020-10-22/politician=joebiden/part-<last _id>.parquet
+
+Batches only ever add files. Part files are named after the batch's last
+Mongo _id, so re-exporting the same batch (after a crash between load and
+mark_extracted) overwrites its file. Batches are sorted by _id (the stream
+mode sorts its micro-batches too), so the last _id is the batch's highest
+and sorting by name is _id order. That is also the order the batches were
+loaded in, except for tweets swept up below the high-water mark
+(election_etl.sweep): their files sort before files loaded earlier.
+Once a day is over, compact() merges its part files into one, keeping the
+last copy of each tweet_ID.
+
+write_snapshots() stores each dashboard view (aggregates.VIEWS) as
+EXPORT_DIR/snapshots/<view>.json (records) and <view>.arrow (Arrow IPC
+file), small enough for the front-end to serve statically.
+
+read_tweets() and read_snapshot() are the analysis side: memory-mapped,
+reading only the requested columns and partitions, e.g.
+
+    tweets = read_tweets('etl/export', ['created_at', 'us_state', 'sentiment'],
+                         politicians=['joebiden'], start=date(2020, 10, 1)).to_pandas()
+
+pyarrow is only needed when exporting or reading.
+'''
+import json
+import logging
+import os
+from datetime import date, datetime, timezone
+from urllib.parse import quote, unquote
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from aggregates import VIEWS
+
+EXPORT_DIR = None
+COMPRESSION = 'snappy'
+
+TWEETS_DIR = 'tweets'
+SNAPSHOT_DIR = 'snapshots'
+PARTITION_KEYS = ('date', 'politician')
+
+
+def require_pyarrow():
+    '''
+    Fails early (at startup) if the export is switched on without pyarrow
+    '''
+    if pa is None:
+        raise RuntimeError('the Parquet export needs pyarrow (pip install pyarrow)')
+
+
+def tweet_schema(with_partition_keys=False):
+    '''
+    Columns of the exported part files (the partition keys live in the path)
+    '''
+    partition_keys = [('date', pa.date32()), ('politician', pa.string())]
+    return pa.schema(([] if not with_partition_keys else partition_keys) + [
+        ('tweet_ID', pa.string()), ('username', pa.string()), ('text', pa.string()),
+        ('clean_text', pa.string()), ('handles', pa.list_(pa.string())),
+        ('hashtags', pa.list_(pa.string())), ('followers_count', pa.int64()),
+        ('was_retweeted', pa.bool_()), ('loc_lat', pa.float64()), ('loc_lon', pa.float64()),
+        ('loc_type', pa.string()), ('location', pa.string()), ('in_us', pa.string()),
+        ('us_state', pa.string()), ('created_at', pa.timestamp('us', tz='UTC')),
+        ('sentiment', pa.float64()),
+    ])
+
+
+def partition_path(export_dir, day, politician):
+    '''
+    Directory of one (day, politician) partition
+    '''
+    return os.path.join(export_dir, TWEETS_DIR, f'date={day.isoformat()}',
+                        f'politician={quote(str(politician), safe="")}')
+
+
+def write_atomically(path, write):
+    '''
+    Calls write(temporary path), then moves the result into place
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial_path = path + '.tmp'
+    write(partial_path)
+    os.replace(partial_path, path)
+
+
+def column_values(tweets, name):
+    '''
+    One column of a batch; created_at is normalised to UTC
+    '''
+    if name == 'created_at':
+        return [tweet.created_at.astimezone(timezone.utc) for tweet in tweets]
+    return [getattr(tweet, name) for tweet in tweets]
+
+
+def tweets_table(tweets, schema):
+    '''
+    Builds a Table from transformed tweets
+    '''
+    return pa.Table.from_arrays(
+        [pa.array(column_values(tweets, field.name), type=field.type) for field in schema],
+        schema=schema)
+
+
+def export_batch(transformed_tweets, export_dir=None):
+    '''
+    Appends a transformed batch to the Parquet export, one part file per (day, politician)
+    Returns the number of files written
+    '''
+    export_dir = export_dir or EXPORT_DIR
+    if not transformed_tweets:
+        return 0
+    schema = tweet_schema()
+    name = f'part-{transformed_tweets[-1].mongo_id}.parquet'
+    groups = {}
+    for tweet in transformed_tweets:
+        key = (tweet.created_at.astimezone(timezone.utc).date(), tweet.politician)
+        groups.setdefault(key, []).append(tweet)
+    for (day, politician), tweets in groups.items():
+        table = tweets_table(tweets, schema)
+        write_atomically(os.path.join(partition_path(export_dir, day, politician), name),
+                         lambda path: pq.write_table(table, path, compression=COMPRESSION))
+    return len(groups)
+
+
+def list_partitions(export_dir):
+    '''
+    Returns [(day, politician, directory)] of the exported tweets
+    '''
+    partitions = []
+    tweets_dir = os.path.join(export_dir, TWEETS_DIR)
+    if not os.path.isdir(tweets_dir):
+        return partitions
+    for date_dir in sorted(os.listdir(tweets_dir)):
+        if not date_dir.startswith('date='):
+            continue
+        day = datetime.strptime(date_dir[5:], '%Y-%m-%d').date()
+        for politician_dir in sorted(os.listdir(os.path.join(tweets_dir, date_dir))):
+            if politician_dir.startswith('politician='):
+                partitions.append((day, unquote(politician_dir[11:]),
+                                   os.path.join(tweets_dir, date_dir, politician_dir)))
+    return partitions
+
+
+def part_files(directory):
+    '''
+    Part files of a partition, oldest first
+    '''
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.endswith('.parquet')]
+
+
+def last_copies(table):
+    '''
+    Keeps the last row for each tweet_ID
+    '''
+    last = {tweet_id: position
+            for position, tweet_id in enumerate(table.column('tweet_ID').to_pylist())}
+    if len(last) == table.num_rows:
+        return table
+    return table.take(pa.array(sorted(last.values())))
+
+
+def compact(export_dir=None, before=None):
+    '''
+    Merges the part files of each partition older than before (default: today, UTC)
+    into one, under the name of its newest part, and removes the rest
+    Returns the number of partitions compacted
+    '''
+    export_dir = export_dir or EXPORT_DIR
+    before = before or datetime.now(timezone.utc).date()
+    compacted = 0
+    for day, politician, directory in list_partitions(export_dir):
+        parts = part_files(directory)
+        if day >= before or len(parts) < 2:
+            continue
+        table = last_copies(pa.concat_tables([pq.read_table(path, memory_map=True)
+                                              for path in parts]))
+        write_atomically(parts[-1],
+                         lambda path: pq.write_table(table, path, compression=COMPRESSION))
+        for path in parts[:-1]:
+            os.remove(path)
+        compacted += 1
+    if compacted:
+        logging.critical('\n*\n*\n--- Compacted %s export partitions ---\n*\n*', compacted)
+    return compacted
+
+
+def snapshot_value(value):
+    '''
+    Turns a value from the views into something JSON and Arrow take as is
+    '''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if value is not None and not isinstance(value, (int, float, str, bool)):
+        # Decimal from NUMERIC
+        return float(value)
+    return value
+
+
+def write_snapshots(db_pg, export_dir=None):
+    '''
+    Writes every dashboard view as <view>.json and <view>.arrow, plus an index.json
+    with the row counts and when the snapshots were taken
+    '''
+    export_dir = export_dir or EXPORT_DIR
+    snapshot_dir = os.path.join(export_dir, SNAPSHOT_DIR)
+    index = {'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+             'views': {}}
+    for view_name in VIEWS:
+        result = db_pg.execute(f'SELECT * FROM {view_name};')
+        columns = list(result.keys())
+        rows = [[snapshot_value(value) for value in row] for row in result.fetchall()]
+        records = [dict(zip(columns, row)) for row in rows]
+        table = pa.Table.from_arrays(
+            [pa.array([row[position] for row in rows]) for position in range(len(columns))],
+            names=columns)
+
+        def write_json(path):
+            with open(path, 'w', encoding='utf-8') as out:
+                json.dump(records, out, separators=(',', ':'))
+
+        def write_arrow(path):
+            with pa.OSFile(path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+
+        write_atomically(os.path.join(snapshot_dir, f'{view_name}.json'), write_json)
+        write_atomically(os.path.join(snapshot_dir, f'{view_name}.arrow'), write_arrow)
+        index['views'][view_name] = len(rows)
+    def write_index(path):
+        with open(path, 'w', encoding='utf-8') as out:
+            json.dump(index, out, indent=1)
+
+    write_atomically(os.path.join(snapshot_dir, 'index.json'), write_index)
+    return index
+
+
+def read_tweets(export_dir, columns=None, politicians=None, start=None, end=None):
+    '''
+    Reads exported tweets as one pyarrow Table (.to_pandas() for a DataFrame)
+    Only the given columns (default: all) and the partitions in [start, end]
+    for the given politicians are read; files are memory-mapped.
+    'date' and 'politician' can be asked for like any other column.
+    '''
+    require_pyarrow()
+    wanted = None if columns is None else [column for column in columns
+                                           if column not in PARTITION_KEYS]
+    tables = []
+    for day, politician, directory in list_partitions(export_dir):
+        if (start is not None and day < start) or (end is not None and day > end) \
+                or (politicians is not None and politician not in politicians):
+            continue
+        for path in part_files(directory):
+            table = pq.read_table(path, columns=wanted, memory_map=True)
+            if columns is None or 'date' in columns:
+                table = table.append_column('date', pa.array([day] * table.num_rows,
+                                                             type=pa.date32()))
+            if columns is None or 'politician' in columns:
+                table = table.append_column('politician', pa.array(
+                    [politician] * table.num_rows, type=pa.string()))
+            tables.append(table)
+    schema = tweet_schema(with_partition_keys=True)
+    if columns is not None:
+        schema = pa.schema([schema.field(column) for column in columns])
+    if not tables:
+        return schema.empty_table()
+    table = pa.concat_tables(tables)
+    return pa.Table.from_arrays([table.column(name) for name in schema.names], schema=schema)
+
+
+def read_snapshot(export_dir, view_name):
+    '''
+    Reads one dashboard snapshot (memory-mapped Arrow file) as a pyarrow Table
+    '''
+    require_pyarrow()
+    path = os.path.join(export_dir, SNAPSHOT_DIR, f'{view_name}.arrow')
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
@@ -0,0 +1,138 @@
+'''
+US and state boundary geometry for state assignment.
+
+The boundaries are built once from the two source GeoJSON files (including
+the Alaska/Puerto Rico patch of the USA outline) and stored as WKB in a
+small gzipped JSON file, BOUNDARY_PATH. etl/ is mounted as /app, so the
+file survives container restarts. At runtime the file is read lazily, on
+the first state lookup. Nothing is downloaded unless asked for, either
+with ALLOW_DOWNLOAD (election_etl.py --fetch-boundaries) or by running
+this module:
+
+    python geometry.py    # download and (re)build BOUNDARY_PATH
+'''
+import gzip
+import json
+import logging
+import os
+from urllib.request import urlopen
+
+from shapely import wkb
+from shapely.geometry import Polygon
+
+from state_index import StateIndex
+
+USA_URL = 'https://raw.githubusercontent.com/johan/world.geo.json/master/countries/USA.geo.json'
+STATES_URL = 'https://raw.githubusercontent.com/PublicaMundi/MappingAPI/master/data/geojson/us-states.json'
+BOUNDARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'boundaries.json.gz')
+
+ALLOW_DOWNLOAD = False
+
+# filled on first use: 'state_dict', 'usa_dict', 'state_index'
+CACHE = {}
+
+
+def make_polygon_list(state):
+    '''
+    Returns list object containing polygon(s) that make up the state
+    state is feature level of USA geojson
+    '''
+    if state['geometry']['type'] == 'Polygon':
+        list_of_polygons = [Polygon(state['geometry']['coordinates'][0])]
+    else:
+        list_of_polygons = [Polygon(x[0]) for x in state['geometry']['coordinates']]
+    return list_of_polygons
+
+
+def download_boundaries():
+    '''
+    Builds (state_dict, usa_dict) from the source GeoJSON files
+    '''
+    with urlopen(USA_URL) as usa_url:
+        usa_total = json.load(usa_url)
+
+    with urlopen(STATES_URL) as states_url:
+        usa_states = json.load(states_url)
+
+    list_states = [state['properties']['name'] for state in usa_states['features']]
+    all_polygon_lists = [make_polygon_list(state) for state in usa_states['features']]
+    state_dict = dict(zip(list_states, all_polygon_lists))
+
+    usa_poly_list = make_polygon_list(usa_total['features'][0])
+    # This geojson is missing some large chunks of Alaska and all of Puerto Rico.
+    # steps:
+    # 1. remove existing Alaska shape
+    # 2. re-add the more detailed Alaska and Puerto Rico shapes manually
+    # (taken from PublicaMundi source)
+    usa_poly_list = usa_poly_list[:-1]
+    for state in ['Alaska', 'Puerto Rico']:
+        for poly in state_dict[state]:
+            usa_poly_list.append(poly)
+
+    usa_dict = {'United States of America' : usa_poly_list}
+    return state_dict, usa_dict
+
+
+def save_boundaries(state_dict, usa_dict, path=BOUNDARY_PATH):
+    '''
+    Writes the boundaries as WKB (hex) into a gzipped JSON file
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    serialised = {
+        'states': [[name, [poly.wkb_hex for poly in polys]] for name, polys in state_dict.items()],
+        'usa': [[name, [poly.wkb_hex for poly in polys]] for name, polys in usa_dict.items()]
+    }
+    with gzip.open(path, 'wt', encoding='utf-8') as boundary_file:
+        json.dump(serialised, boundary_file)
+
+
+def read_boundaries(path=BOUNDARY_PATH):
+    '''
+    Reads (state_dict, usa_dict) back from the file written by save_boundaries
+    Lists keep their order, so state priority is the same as in the source
+    '''
+    with gzip.open(path, 'rt', encoding='utf-8') as boundary_file:
+        serialised = json.load(boundary_file)
+    state_dict = {name: [wkb.loads(poly, hex=True) for poly in polys]
+                  for name, polys in serialised['states']}
+    usa_dict = {name: [wkb.loads(poly, hex=True) for poly in polys]
+                for name, polys in serialised['usa']}
+    return state_dict, usa_dict
+
+
+def load_boundaries(path=BOUNDARY_PATH, allow_download=None):
+    '''
+    Returns (state_dict, usa_dict), reading them once and caching them
+    Falls back to a download (and writes the file) only if allowed
+    '''
+    if 'state_dict' not in CACHE:
+        if allow_download is None:
+            allow_download = ALLOW_DOWNLOAD
+        if os.path.exists(path):
+            state_dict, usa_dict = read_boundaries(path)
+        elif allow_download:
+            logging.critical('\n*\n*\n--- Downloading boundary geometry to %s ---\n*\n*\n*', path)
+            state_dict, usa_dict = download_boundaries()
+            save_boundaries(state_dict, usa_dict, path)
+        else:
+            raise FileNotFoundError(
+                f'No boundary file at {path}. Build it with "python geometry.py" '
+                'or run election_etl.py with --fetch-boundaries.')
+        CACHE['state_dict'] = state_dict
+        CACHE['usa_dict'] = usa_dict
+    return CACHE['state_dict'], CACHE['usa_dict']
+
+
+def get_state_index():
+    '''
+    Returns the StateIndex over the boundaries, building it on first use
+    '''
+    if 'state_index' not in CACHE:
+        state_dict, usa_dict = load_boundaries()
+        CACHE['state_index'] = StateIndex(state_dict, usa_dict)
+    return CACHE['state_index']
+
+
+if __name__ == '__main__':
+    save_boundaries(*download_boundaries())
+    logging.critical('--- Wrote %s ---', BOUNDARY_PATH)
@@ -0,0 +1,74 @@
+'''
+Multi-process transform stage.
+
+Extracted tweets are cut into chunks of CHUNK_SIZE and transformed on a
+pool of WORKERS processes. The transform function is sent to the workers
+by reference, so its module (election_etl, with NLP and SENT_ANALYSIS) is
+set up once per worker, and init_worker loads the state index once per
+worker, before the first chunk. pool.imap keeps chunk order, so the output
+is in the same order as the input.
+The pool is created on first use and kept for the lifetime of the ETL.
+Small batches (a single chunk) and WORKERS = 1 run in-process.
+'''
+import logging
+import multiprocessing
+import os
+
+import geometry
+
+WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 250
+
+# the worker pool, created on first use: {'pool': ..., 'workers': ...}
+POOL = {}
+
+
+def init_worker(allow_download):
+    '''
+    Runs once in every worker process
+    '''
+    geometry.ALLOW_DOWNLOAD = allow_download
+    geometry.get_state_index()
+
+
+def get_pool(workers):
+    '''
+    Returns the worker pool, (re)creating it if the size changed
+    '''
+    if POOL.get('workers') != workers:
+        close_pool()
+        logging.critical('\n*\n*\n--- Starting %s transform workers ---\n*\n*', workers)
+        # build the index before forking so workers inherit it instead of reading the file
+        geometry.get_state_index()
+        POOL['pool'] = multiprocessing.Pool(workers, initializer=init_worker,
+                                            initargs=(geometry.ALLOW_DOWNLOAD,))
+        POOL['workers'] = workers
+    return POOL['pool']
+
+
+def close_pool():
+    '''
+    Shuts the worker pool down
+    '''
+    if 'pool' in POOL:
+        POOL['pool'].close()
+        POOL['pool'].join()
+        POOL.clear()
+
+
+def parallel_transform(transform, extracted_tweets, workers=None, chunk_size=None):
+    '''
+    Applies transform (a module-level function taking and returning a list of tweets)
+    to extracted tweets across the worker pool
+    Returns transformed tweets in input order
+    '''
+    workers = workers or WORKERS
+    chunk_size = chunk_size or CHUNK_SIZE
+    if workers <= 1 or len(extracted_tweets) <= chunk_size:
+        return transform(extracted_tweets)
+    chunks = [extracted_tweets[start:start + chunk_size]
+              for start in range(0, len(extracted_tweets), chunk_size)]
+    transformed_tweets = []
+    for chunk in get_pool(workers).imap(transform, chunks):
+        transformed_tweets.extend(chunk)
+    return transformed_tweets
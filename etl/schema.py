@@ -0,0 +1,266 @@
+'''
+Postgres layout of the tweet table.
+
+Schema v2 stores native types instead of strings:
+- created_at TIMESTAMPTZ is the one stored timestamp; date, time and the
+  hour bucket date_hour are generated from it (in UTC, as before)
+- loc_lat/loc_lon are DOUBLE PRECISION, NULL where the tweet has no location
+  (v1 stored 'no_loc')
+- was_retweeted is BOOLEAN (v1: 'true'/'false')
+
+The table is partitioned by day on created_at (one partition per UTC day,
+named <table>_pYYYYMMDD) with the primary key (tweet_ID, created_at):
+Postgres requires the partition key in every unique index of a partitioned
+table. Indexes on (politician, date_hour) and (us_state, date) cover the
+aggregate queries. Partitions are created ahead of the load for every day
+in a batch (ensure_partitions), and old ones can be detached and kept as
+standalone tables, or dropped (archive_partitions). Detached partitions are
+renamed to <table>_aYYYYMMDD, so tweets arriving late for an archived day
+get a new partition; the next archive_partitions merges it into the
+archived table.
+
+Tables created by earlier versions are migrated by migrate_to_v2() (v1
+string columns, in place) and migrate_to_partitioned() (copied into the
+partitioned table), each in one transaction. The aggregate sums and views
+are dropped by the v1 migration and rebuilt by create_aggregates().
+'''
+import logging
+from datetime import datetime, timedelta, timezone
+
+from aggregates import SUM_TABLES, VIEWS
+from bulk_load import TWEET_COLUMNS
+
+# generated from created_at, in UTC (Twitter's created_at is always +0000)
+GENERATED_COLUMNS = [
+    ('date', 'DATE', "(created_at AT TIME ZONE 'UTC')::DATE"),
+    ('time', 'TIME', "(created_at AT TIME ZONE 'UTC')::TIME"),
+    ('date_hour', 'TIMESTAMP', "date_trunc('hour', created_at AT TIME ZONE 'UTC')"),
+]
+
+NUMBER_PATTERN = r'^\s*[-+]?[0-9]*\.?[0-9]+([eE][-+]?[0-9]+)?\s*$'
+
+INDEXES = [('politician', 'date_hour'), ('us_state', 'date')]
+
+# partitions made ahead of time at startup, counting from today (UTC)
+DAYS_AHEAD = 1
+# partitions older than this many days are detached by archive_partitions; None keeps everything
+RETAIN_DAYS = None
+# drop detached partitions instead of keeping them as standalone tables
+DROP_ARCHIVED = False
+
+# (table, day) of partitions known to exist
+PARTITIONS = set()
+
+
+def generated_columns():
+    '''
+    Column definitions of the generated columns
+    '''
+    return [f'{name} {column_type} GENERATED ALWAYS AS ({expression}) STORED'
+            for name, column_type, expression in GENERATED_COLUMNS]
+
+
+def has_column(table_name, column_name, db_pg):
+    '''
+    Checks whether a table has a column
+    '''
+    return db_pg.execute(f'''SELECT EXISTS (SELECT 1 FROM information_schema.columns \
+    WHERE table_name = '{table_name.lower()}' AND column_name = '{column_name.lower()}');''').scalar()
+
+
+def table_kind(table_name, db_pg):
+    '''
+    Returns 'p' for a partitioned table, 'r' for a plain one, 'v' for a view,
+    None if there is no such table
+    '''
+    return db_pg.execute(f"""SELECT relkind FROM pg_class \
+    WHERE oid = to_regclass('{table_name}');""").scalar()
+
+
+def drop_relation(name, db_pg):
+    '''
+    Drops a table or view by that name, whichever it is
+    (DROP VIEW IF EXISTS fails on a table and DROP TABLE IF EXISTS on a view)
+    '''
+    kind = table_kind(name, db_pg)
+    if kind == 'v':
+        db_pg.execute(f'DROP VIEW {name};')
+    elif kind is not None:
+        db_pg.execute(f'DROP TABLE {name};')
+
+
+def create_table_query(table_name):
+    '''
+    DDL of the partitioned tweet table
+    '''
+    return f"""CREATE TABLE IF NOT EXISTS {table_name} (
+    tweet_ID VARCHAR(50), username VARCHAR(50), text TEXT, clean_text TEXT, \
+    handles TEXT, hashtags TEXT, followers_count BIGINT, \
+    was_retweeted BOOLEAN, loc_lat DOUBLE PRECISION, loc_lon DOUBLE PRECISION, \
+    loc_type VARCHAR(50), location VARCHAR(50), in_us VARCHAR(50), \
+    us_state VARCHAR(50), politician VARCHAR(50), created_at TIMESTAMPTZ NOT NULL, \
+    {', '.join(generated_columns())}, sentiment REAL, extracted VARCHAR(5), \
+    PRIMARY KEY (tweet_ID, created_at) ) PARTITION BY RANGE (created_at);"""
+
+
+def create_table(table_name, db_pg):
+    '''
+    Creates table in Postgres database (schema v2, partitioned by day),
+    migrating a table from an earlier version if there is one
+    '''
+    kind = table_kind(table_name, db_pg)
+    if kind is not None and not has_column(table_name, 'created_at', db_pg):
+        migrate_to_v2(table_name, db_pg)
+    if kind == 'r':
+        migrate_to_partitioned(table_name, db_pg)
+    logging.critical('\n*\n*\n--- Creating table in Postgres database ---\n*\n*\n*')
+    db_pg.execute(create_table_query(table_name))
+    create_indexes(table_name, db_pg)
+    today = datetime.now(timezone.utc).date()
+    ensure_partitions(table_name, db_pg, [today + timedelta(days=ahead)
+                                          for ahead in range(DAYS_AHEAD + 1)])
+
+
+def create_indexes(table_name, db_pg):
+    '''
+    Creates the aggregate query indexes (on the parent, so every partition gets them)
+    '''
+    for columns in INDEXES:
+        db_pg.execute(f"""CREATE INDEX IF NOT EXISTS {table_name}_{'_'.join(columns)}_idx \
+        ON {table_name} ({', '.join(columns)});""")
+
+
+def partition_name(table_name, day):
+    '''
+    Name of the partition holding one UTC day
+    '''
+    return f'{table_name}_p{day:%Y%m%d}'
+
+
+def archive_name(table_name, day):
+    '''
+    Name of the standalone table a detached partition is kept as
+    '''
+    return f'{table_name}_a{day:%Y%m%d}'
+
+
+def is_detached(name, db_pg):
+    '''
+    Checks whether name is a plain table that is not a partition
+    (e.g. a partition detached before archived partitions were renamed)
+    '''
+    row = db_pg.execute(f"""SELECT relkind, relispartition FROM pg_class \
+    WHERE oid = to_regclass('{name}');""").fetchone()
+    return row is not None and row[0] == 'r' and not row[1]
+
+
+def keep_archived(table_name, db_pg, day, name):
+    '''
+    Keeps the detached partition name as the day's archived table,
+    merging it into one archived before
+    '''
+    archived = archive_name(table_name, day)
+    if table_kind(archived, db_pg) is None:
+        db_pg.execute(f'ALTER TABLE {name} RENAME TO {archived};')
+    else:
+        db_pg.execute(f'INSERT INTO {archived} SELECT * FROM {name} ON CONFLICT DO NOTHING;')
+        db_pg.execute(f'DROP TABLE {name};')
+
+
+def list_partitions(table_name, db_pg):
+    '''
+    Returns {day: partition name} for the partitions currently attached
+    '''
+    rows = db_pg.execute(f"""SELECT child.relname FROM pg_inherits \
+    JOIN pg_class child ON child.oid = pg_inherits.inhrelid \
+    WHERE pg_inherits.inhparent = to_regclass('{table_name}');""").fetchall()
+    prefix = f'{table_name.lower()}_p'
+    return {datetime.strptime(name[len(prefix):], '%Y%m%d').date(): name
+            for (name,) in rows if name.startswith(prefix)}
+
+
+def ensure_partitions(table_name, db_pg, days):
+    '''
+    Creates the partitions for the given UTC days unless they exist already
+    A detached partition still under the partition's name is archived first
+    '''
+    for day in sorted(set(days) - {day for table, day in PARTITIONS if table == table_name}):
+        name = partition_name(table_name, day)
+        if is_detached(name, db_pg):
+            keep_archived(table_name, db_pg, day, name)
+        db_pg.execute(f"""CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table_name} \
+        FOR VALUES FROM ('{day} 00:00:00+00') TO ('{day + timedelta(days=1)} 00:00:00+00');""")
+        PARTITIONS.add((table_name, day))
+
+
+def archive_partitions(table_name, db_pg, retain_days=None, drop=None):
+    '''
+    Detaches partitions for days more than retain_days before today (UTC)
+    Detached partitions stay around as standalone tables (e.g. for pg_dump),
+    renamed by archive_name, unless drop is set. The aggregate sums keep
+    their contribution, but rebuild_aggregates() only sees what is still attached.
+    Returns the names of the archived partitions
+    '''
+    retain_days = RETAIN_DAYS if retain_days is None else retain_days
+    drop = DROP_ARCHIVED if drop is None else drop
+    if retain_days is None:
+        return []
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=retain_days)
+    archived = []
+    for day, name in sorted(list_partitions(table_name, db_pg).items()):
+        if day >= cutoff:
+            continue
+        db_pg.execute(f'ALTER TABLE {table_name} DETACH PARTITION {name};')
+        if drop:
+            db_pg.execute(f'DROP TABLE {name};')
+        else:
+            keep_archived(table_name, db_pg, day, name)
+        PARTITIONS.discard((table_name, day))
+        archived.append(name)
+    if archived:
+        logging.critical('\n*\n*\n--- %s %s partitions of %s older than %s ---\n*\n*',
+                         'Dropped' if drop else 'Detached', len(archived), table_name, cutoff)
+    return archived
+
+
+def migrate_to_partitioned(table_name, db_pg):
+    '''
+    Copies a plain (unpartitioned) v2 table into the partitioned layout in one transaction
+    '''
+    logging.critical('\n*\n*\n--- Partitioning %s by day ---\n*\n*\n*', table_name)
+    old_name = f'{table_name}_unpartitioned'
+    columns = ', '.join(TWEET_COLUMNS)
+    with db_pg.begin() as conn:
+        conn.execute(f'ALTER TABLE {table_name} RENAME TO {old_name};')
+        conn.execute(create_table_query(table_name))
+        days = [day for (day,) in conn.execute(f"""SELECT DISTINCT \
+        (created_at AT TIME ZONE 'UTC')::DATE FROM {old_name};""").fetchall()]
+        ensure_partitions(table_name, conn, days)
+        # a table from before the unique index may repeat tweets; keep one copy
+        conn.execute(f"""INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {old_name} \
+        ON CONFLICT DO NOTHING;""")
+        conn.execute(f'DROP TABLE {old_name};')
+
+
+def migrate_to_v2(table_name, db_pg):
+    '''
+    Converts a v1 table (string dates, coordinates and flags) to schema v2 in one transaction
+    '''
+    logging.critical('\n*\n*\n--- Migrating %s to schema v2 ---\n*\n*\n*', table_name)
+    with db_pg.begin() as conn:
+        # the sums are keyed on the old string date_hour; create_aggregates backfills them.
+        # Before the views, agg_* were plain tables rebuilt on every run
+        for name in list(VIEWS) + list(SUM_TABLES):
+            drop_relation(name, conn)
+        conn.execute(f'''ALTER TABLE {table_name} ADD COLUMN created_at TIMESTAMPTZ;''')
+        conn.execute(f'''UPDATE {table_name} \
+        SET created_at = (date + time::TIME) AT TIME ZONE 'UTC';''')
+        conn.execute(f'''ALTER TABLE {table_name} ALTER COLUMN created_at SET NOT NULL, \
+        DROP COLUMN date, DROP COLUMN time, DROP COLUMN date_hour, \
+        ALTER COLUMN was_retweeted TYPE BOOLEAN USING was_retweeted = 'true', \
+        ALTER COLUMN loc_lat TYPE DOUBLE PRECISION USING \
+        CASE WHEN loc_lat ~ '{NUMBER_PATTERN}' THEN loc_lat::DOUBLE PRECISION END, \
+        ALTER COLUMN loc_lon TYPE DOUBLE PRECISION USING \
+        CASE WHEN loc_lon ~ '{NUMBER_PATTERN}' THEN loc_lon::DOUBLE PRECISION END;''')
+        conn.execute(f'''ALTER TABLE {table_name} ''' + ', '.join(
+            f'ADD COLUMN {definition}' for definition in generated_columns()) + ';')
@@ -0,0 +1,105 @@
+'''
+Grid index over the US and state boundary polygons.
+
+Every polygon is registered in each GRID_SIZE x GRID_SIZE degree cell its
+bounding box touches, as a shapely prepared geometry. A lookup only tests
+the handful of polygons in the point's cell, and answers both questions
+get_state is asked per tweet (in the US? which state?) in one pass.
+States keep their dict order, so a point on a shared border gets the same
+state get_state would return.
+'''
+import math
+from collections import defaultdict
+
+from shapely.geometry import Point
+from shapely.prepared import prep
+
+GRID_SIZE = 1.0
+
+STATE = 0
+COUNTRY = 1
+
+
+class StateIndex():
+    '''
+    locate() answers one point, locate_many() a whole batch of lon/lat arrays.
+    Both return 'other' where a point is outside every polygon.
+    '''
+
+    def __init__(self, state_dict, usa_dict, grid_size=GRID_SIZE):
+        self.grid_size = grid_size
+        self.cells = defaultdict(list)
+        order = 0
+        for kind, search_space in ((STATE, state_dict), (COUNTRY, usa_dict)):
+            for name, polygons in search_space.items():
+                for polygon in polygons:
+                    self.add(kind, order, name, polygon)
+                order += 1
+        for candidates in self.cells.values():
+            candidates.sort(key=lambda candidate: candidate[:2])
+
+    def cell(self, lon, lat):
+        '''
+        Grid cell containing a point
+        '''
+        return (math.floor(lon / self.grid_size), math.floor(lat / self.grid_size))
+
+    def add(self, kind, order, name, polygon):
+        '''
+        Registers a polygon in every cell its bounding box touches
+        '''
+        min_lon, min_lat, max_lon, max_lat = polygon.bounds
+        first = self.cell(min_lon, min_lat)
+        last = self.cell(max_lon, max_lat)
+        prepared = prep(polygon)
+        for x_cell in range(first[0], last[0] + 1):
+            for y_cell in range(first[1], last[1] + 1):
+                self.cells[(x_cell, y_cell)].append((kind, order, name, prepared))
+
+    def locate(self, lon, lat):
+        '''
+        Returns (in_us, us_state) for a point
+        in_us is 'United States of America' or 'other', us_state a state name or 'other'
+        '''
+        in_us = 'other'
+        us_state = 'other'
+        candidates = self.cells.get(self.cell(lon, lat))
+        if not candidates:
+            return in_us, us_state
+        point = Point(lon, lat)
+        for kind, _, name, prepared in candidates:
+            if kind == STATE:
+                if us_state == 'other' and prepared.contains(point):
+                    us_state = name
+            elif prepared.contains(point):
+                in_us = name
+                break
+        return in_us, us_state
+
+    def locate_many(self, lons, lats):
+        '''
+        Bulk version of locate for arrays of lon/lat
+        Points are grouped by grid cell so each cell's candidates are fetched once
+        Returns two lists: in_us and us_state, in input order
+        '''
+        in_us = ['other'] * len(lons)
+        us_state = ['other'] * len(lons)
+        by_cell = defaultdict(list)
+        for position, (lon, lat) in enumerate(zip(lons, lats)):
+            by_cell[self.cell(lon, lat)].append(position)
+        for cell, positions in by_cell.items():
+            candidates = self.cells.get(cell)
+            if not candidates:
+                continue
+            points = [(position, Point(lons[position], lats[position])) for position in positions]
+            for position, point in points:
+                found_state = False
+                for kind, _, name, prepared in candidates:
+                    if kind == STATE:
+                        if not found_state and prepared.contains(point):
+                            us_state[position] = name
+                            found_state = True
+                    elif prepared.contains(point):
+                        in_us[position] = name
+                        break
+        return in_us, us_state
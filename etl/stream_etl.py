@@ -0,0 +1,228 @@
+'''
+Streaming ETL mode (election_etl.py --mode stream).
+
+Instead of waking up every 10 minutes, the ETL follows inserts into the
+tweet collection and processes them in micro-batches: a batch is handed
+over once it holds MAX_BATCH tweets or its first tweet has waited
+MAX_WAIT seconds, whichever comes first.
+
+Inserts are read from a MongoDB change stream. After each micro-batch is
+loaded, the stream's resume token is saved in etl_checkpoint
+({_id: 'stream'}), so a restart picks up where the last loaded batch
+ended. Change streams need a replica set. On a standalone mongod (the
+default docker-compose setup) the stream falls back to polling for tweets
+past the extract high-water mark every POLL_INTERVAL seconds. A tailable
+cursor is not an option: the tweet collection is not capped.
+
+Change events are projected down to the fields TweetRecord needs. An
+event whose document can't be read into a TweetRecord is handed to
+reject() (election_etl dead-letters it) and the stream goes on.
+
+Tweets inserted while the ETL was down are drained in _id order before
+following the stream, and tweets at or below the high-water mark are
+skipped, so nothing is loaded twice. Unextracted tweets inserted below the
+mark (an older _id arriving late) are left to the periodic sweep
+(election_etl.sweep, from periodic()).
+'''
+import logging
+import time
+
+from pymongo.errors import OperationFailure
+
+from tweet_record import TweetRecord, EXTRACT_FIELDS
+
+MAX_BATCH = 500
+MAX_WAIT = 5.0
+POLL_INTERVAL = 2.0
+# how long one change stream read waits for new inserts
+AWAIT_MS = 1000
+# how often the periodic callback runs (cache stats, partition retention)
+PERIODIC_INTERVAL = 600
+
+# OperationFailure codes
+NOT_REPLICA_SET = (40573, 20)
+HISTORY_LOST = 286
+
+CHECKPOINT_ID = 'stream'
+
+
+def load_resume_token(collection):
+    '''
+    Returns the saved change stream resume token, or None
+    '''
+    checkpoint = collection.database.etl_checkpoint.find_one({'_id': CHECKPOINT_ID})
+    return checkpoint['resume_token'] if checkpoint else None
+
+
+def save_resume_token(collection, resume_token):
+    '''
+    Saves the resume token of the last loaded micro-batch
+    '''
+    collection.database.etl_checkpoint.update_one(
+        {'_id': CHECKPOINT_ID}, {'$set': {'resume_token': resume_token}}, upsert=True)
+
+
+def open_stream(collection):
+    '''
+    Opens a change stream over inserts, resuming from the saved token if there is one
+    Returns None if the server doesn't support change streams
+    '''
+    # the event _id is the resume token and has to stay in
+    projection = {f'fullDocument.{field}': 1 for field in EXTRACT_FIELDS}
+    projection.update({'_id': 1, 'operationType': 1, 'fullDocument._id': 1})
+    pipeline = [{'$match': {'operationType': 'insert'}}, {'$project': projection}]
+    resume_token = load_resume_token(collection)
+    try:
+        try:
+            return collection.watch(pipeline, resume_after=resume_token,
+                                    max_await_time_ms=AWAIT_MS)
+        except OperationFailure as error:
+            if resume_token is None or error.code != HISTORY_LOST:
+                raise
+            logging.critical('\n*\n*\n--- Resume token too old, draining instead ---\n*\n*')
+            return collection.watch(pipeline, max_await_time_ms=AWAIT_MS)
+    except OperationFailure as error:
+        if error.code in NOT_REPLICA_SET:
+            return None
+        raise
+
+
+class MicroBatcher():
+    '''
+    Collects tweets until MAX_BATCH of them or MAX_WAIT seconds after the first one
+    '''
+
+    def __init__(self, max_batch=None, max_wait=None):
+        self.max_batch = max_batch or MAX_BATCH
+        self.max_wait = max_wait or MAX_WAIT
+        self.tweets = []
+        self.started = None
+
+    def add(self, tweet):
+        '''
+        Adds a tweet, starting the clock if it is the first one
+        '''
+        if not self.tweets:
+            self.started = time.monotonic()
+        self.tweets.append(tweet)
+
+    def ready(self):
+        '''
+        Whether the batch is full or has waited long enough
+        '''
+        if not self.tweets:
+            return False
+        return (len(self.tweets) >= self.max_batch
+                or time.monotonic() - self.started >= self.max_wait)
+
+    def take(self):
+        '''
+        Returns the collected tweets and starts a new batch
+        '''
+        tweets, self.tweets, self.started = self.tweets, [], None
+        return tweets
+
+
+class StreamRunner():
+    '''
+    Runs process_batch on micro-batches of newly inserted tweets
+    extract(collection, after, batch_size) and process_batch(tweets) -> new high-water mark
+    are election_etl's; periodic() is called every PERIODIC_INTERVAL seconds and
+    reject(document, error) with malformed documents (default: logged and skipped)
+    '''
+
+    def __init__(self, collection, extract, process_batch, checkpoint, periodic=None,
+                 reject=None):
+        self.collection = collection
+        self.extract = extract
+        self.process_batch = process_batch
+        self.checkpoint = checkpoint
+        self.periodic = periodic
+        self.reject = reject
+        self.last_periodic = time.monotonic()
+
+    def process(self, tweets):
+        '''
+        Transforms and loads one batch and moves the high-water mark
+        Change events come in commit order, which isn't always _id order: the
+        batch is sorted first, as process_batch expects (_id range, high-water mark)
+        '''
+        tweets.sort(key=lambda tweet: tweet.mongo_id)
+        self.checkpoint = self.process_batch(tweets)
+
+    def record(self, change):
+        '''
+        Returns the TweetRecord of a change event, or None (rejected) if it is malformed
+        '''
+        document = change.get('fullDocument')
+        try:
+            return TweetRecord.from_document(document)
+        except (KeyError, TypeError) as error:
+            if self.reject is not None:
+                self.reject(document, error)
+            else:
+                logging.critical('--- Skipped malformed change event: %r ---', error)
+            return None
+
+    def tick(self):
+        '''
+        Runs the periodic callback when due
+        '''
+        if self.periodic is not None and time.monotonic() - self.last_periodic >= PERIODIC_INTERVAL:
+            self.periodic()
+            self.last_periodic = time.monotonic()
+
+    def drain(self):
+        '''
+        Processes everything past the high-water mark, MAX_BATCH at a time
+        Returns the number of tweets processed
+        '''
+        processed = 0
+        while True:
+            tweets = self.extract(self.collection, self.checkpoint, MAX_BATCH)
+            if not tweets:
+                return processed
+            self.process(tweets)
+            processed += len(tweets)
+
+    def follow(self, stream):
+        '''
+        Micro-batches inserts from the change stream
+        '''
+        batcher = MicroBatcher()
+        with stream:
+            while stream.alive:
+                change = stream.try_next()
+                tweet = self.record(change) if change is not None else None
+                if tweet is not None:
+                    if self.checkpoint is None or tweet.mongo_id > self.checkpoint:
+                        batcher.add(tweet)
+                if batcher.ready():
+                    self.process(batcher.take())
+                    save_resume_token(self.collection, stream.resume_token)
+                self.tick()
+
+    def poll(self):
+        '''
+        Fallback without change streams: polls past the high-water mark
+        '''
+        while True:
+            if not self.drain():
+                time.sleep(POLL_INTERVAL)
+            self.tick()
+
+    def run(self):
+        '''
+        Opens the stream, catches up on the backlog, then follows new inserts
+        '''
+        stream = open_stream(self.collection)
+        # the stream is open before draining, so nothing inserted in between is missed
+        self.drain()
+        if stream is None:
+            logging.critical('\n*\n*\n--- No change streams (standalone mongod), '
+                             'polling every %s s ---\n*\n*', POLL_INTERVAL)
+            self.poll()
+        else:
+            logging.critical('\n*\n*\n--- Following tweet inserts (micro-batches of up to %s '
+                             'tweets or %s s) ---\n*\n*', MAX_BATCH, MAX_WAIT)
+            self.follow(stream)
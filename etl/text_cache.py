@@ -0,0 +1,220 @@
+'''
+Memo of text analysis results for retweets and duplicate texts.
+
+Retweets carry the original tweet's full text, so on busy nights the same
+text arrives thousands of times. The cache maps a hash of the raw text to
+(handles, hashtags, clean_text, sentiment), so a text that has been seen
+before skips spaCy and VADER entirely:
+- an in-process LRU (LRU_SIZE entries)
+- optionally a Postgres side table (PERSIST_TABLE) that survives ETL
+  restarts; entries not seen for PERSIST_DAYS days are pruned
+
+fill() runs before transform and sets the analysis fields on every tweet
+it has an answer for; transform only analyses the rest. store() runs after
+transform and writes the new entries to the side table, refreshing
+last_seen of the entries fill() found (memory or side table) in the same
+round trip. Hit rates are logged once per ETL cycle by end_cycle().
+'''
+import hashlib
+import logging
+from collections import OrderedDict
+
+import metrics
+
+LRU_SIZE = 100000
+PERSIST = False
+PERSIST_TABLE = 'text_cache'
+PERSIST_DAYS = 14
+
+LOOKUPS = metrics.counter('etl_text_cache_total', 'Text analysis cache lookups by result',
+                          ('result',))
+
+
+def text_key(text):
+    '''
+    Returns the cache key for a tweet text
+    '''
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class TextCache():
+    '''
+    LRU (+ optional Postgres) cache of text analysis results.
+    Values are (handles, hashtags, clean_text, sentiment) with handles/hashtags as tuples.
+    '''
+
+    def __init__(self, maxsize=LRU_SIZE, db_pg=None, table=PERSIST_TABLE):
+        self.maxsize = maxsize
+        self.db_pg = db_pg
+        self.table = table
+        self.memory = OrderedDict()
+        # keys answered by fill() since the last store(), for last_seen
+        self.seen = set()
+        self.totals = self.new_counters()
+        self.cycle = self.new_counters()
+        if db_pg is not None:
+            self.create_table()
+
+    @staticmethod
+    def new_counters():
+        '''
+        Fresh hit/miss counters
+        '''
+        return {'memory_hits': 0, 'db_hits': 0, 'batch_duplicates': 0, 'misses': 0}
+
+    def count(self, counter, amount=1):
+        '''
+        Adds to a counter for both the totals and the current cycle
+        '''
+        self.totals[counter] += amount
+        self.cycle[counter] += amount
+        LOOKUPS.inc(amount, result=counter)
+
+    def create_table(self):
+        '''
+        Creates the Postgres side table
+        '''
+        self.db_pg.execute(f'''CREATE TABLE IF NOT EXISTS {self.table} (
+        text_hash CHAR(40) PRIMARY KEY, handles TEXT[], hashtags TEXT[], clean_text TEXT, \
+        sentiment DOUBLE PRECISION, last_seen TIMESTAMPTZ NOT NULL DEFAULT now());''')
+
+    def remember(self, key, value):
+        '''
+        Puts an entry into the LRU, evicting the oldest one if full
+        '''
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def fetch(self, keys):
+        '''
+        Looks keys up in the side table in one query
+        Returns {key: value}
+        '''
+        connection = self.db_pg.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(f'''SELECT text_hash, handles, hashtags, clean_text, sentiment \
+            FROM {self.table} WHERE text_hash = ANY(%s);''', (keys,))
+            rows = cursor.fetchall()
+            connection.commit()
+        finally:
+            connection.close()
+        return {key: (tuple(handles), tuple(hashtags), clean_text, sentiment)
+                for key, handles, hashtags, clean_text, sentiment in rows}
+
+    def persist(self, entries, seen=()):
+        '''
+        Upserts {key: value} into the side table and refreshes last_seen
+        of the seen keys, in one transaction
+        '''
+        connection = self.db_pg.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if entries:
+                cursor.executemany(f'''INSERT INTO {self.table} \
+                (text_hash, handles, hashtags, clean_text, sentiment) \
+                VALUES (%s, %s, %s, %s, %s) \
+                ON CONFLICT (text_hash) DO UPDATE SET last_seen = now();''',
+                                   [(key, list(handles), list(hashtags), clean_text, sentiment)
+                                    for key, (handles, hashtags, clean_text, sentiment)
+                                    in entries.items()])
+            if seen:
+                cursor.execute(f'''UPDATE {self.table} SET last_seen = now() \
+                WHERE text_hash = ANY(%s);''', (sorted(seen),))
+            connection.commit()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def apply(tweet, value):
+        '''
+        Sets the analysis fields on a tweet (the cached tuples are shared, not copied)
+        '''
+        tweet.handles, tweet.hashtags, tweet.clean_text, tweet.sentiment = value
+
+    def fill(self, tweets):
+        '''
+        Sets handles, hashtags, clean_text and sentiment on tweets whose text is cached
+        Returns the number of tweets filled
+        '''
+        missing = OrderedDict()
+        filled = 0
+        for tweet in tweets:
+            key = text_key(tweet.text)
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.apply(tweet, value)
+                self.count('memory_hits')
+                self.seen.add(key)
+                filled += 1
+            else:
+                missing.setdefault(key, []).append(tweet)
+        if missing and self.db_pg is not None:
+            for key, value in self.fetch(list(missing)).items():
+                self.remember(key, value)
+                self.seen.add(key)
+                for tweet in missing.pop(key):
+                    self.apply(tweet, value)
+                    self.count('db_hits')
+                    filled += 1
+        for same_text in missing.values():
+            # transform analyses each distinct text once (per chunk when parallel)
+            self.count('misses')
+            self.count('batch_duplicates', len(same_text) - 1)
+        return filled
+
+    def store(self, tweets):
+        '''
+        Caches the analysis of transformed tweets whose text wasn't in memory yet
+        With the side table, also refreshes last_seen of the texts fill() found
+        Entries go into memory only once persisted, so a failed store() can be retried
+        '''
+        new_entries = {}
+        for tweet in tweets:
+            key = text_key(tweet.text)
+            if key in self.memory or key in new_entries:
+                continue
+            new_entries[key] = (tuple(tweet.handles), tuple(tweet.hashtags), tweet.clean_text,
+                                tweet.sentiment)
+        if self.db_pg is not None and (new_entries or self.seen):
+            self.persist(new_entries, self.seen - set(new_entries))
+        for key, value in new_entries.items():
+            self.remember(key, value)
+        self.seen = set()
+
+    def prune(self):
+        '''
+        Removes side table entries not seen for PERSIST_DAYS days
+        '''
+        self.db_pg.execute(f'''DELETE FROM {self.table} \
+        WHERE last_seen < now() - INTERVAL '{PERSIST_DAYS} days';''')
+
+    @staticmethod
+    def summarise(counters):
+        '''
+        Adds lookups and the hit rate (any answer that skipped spaCy and VADER)
+        '''
+        stats = dict(counters)
+        stats['lookups'] = sum(counters.values())
+        skipped = stats['lookups'] - counters['misses']
+        stats['hit_rate'] = round(skipped / stats['lookups'], 3) if stats['lookups'] else 0.0
+        return stats
+
+    def stats(self):
+        '''
+        Returns counters since start and for the current cycle
+        '''
+        return {'cycle': self.summarise(self.cycle), 'total': self.summarise(self.totals),
+                'memory_size': len(self.memory)}
+
+    def end_cycle(self):
+        '''
+        Logs this cycle's hit rates, prunes the side table and starts a new cycle
+        '''
+        logging.critical('--- Text cache: %s ---', self.stats())
+        if self.db_pg is not None:
+            self.prune()
+        self.cycle = self.new_counters()
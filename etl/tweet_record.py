@@ -0,0 +1,99 @@
+'''
+Compact in-memory tweet record for the ETL.
+
+Between extract and load a tweet used to be the full pymongo document, a
+dict that transform then widened in place. TweetRecord holds the same
+fields in __slots__ (no per-tweet __dict__), and keeps it lean:
+- extract asks MongoDB for EXTRACT_FIELDS only (PROJECTION)
+- handles and hashtags are tuples, shared by every tweet with the same text
+- texts and low-cardinality strings (politician, loc_type, location) are
+  interned, so the copies of a retweeted text in a batch are one object
+- records pickle as a plain tuple of values (cheap to ship to the
+  transform workers)
+
+The Mongo _id is kept as mongo_id.
+'''
+import sys
+
+# collector document fields the ETL reads (_id is always returned)
+EXTRACT_FIELDS = ('tweet_ID', 'username', 'text', 'followers_count', 'was_retweeted',
+                  'timestamp', 'loc_lat', 'loc_lon', 'loc_type', 'location', 'politician',
+                  'extracted')
+PROJECTION = {field: 1 for field in EXTRACT_FIELDS}
+# string fields that repeat a lot across tweets
+INTERNED = frozenset(['text', 'loc_type', 'location', 'politician', 'extracted', 'in_us',
+                      'us_state'])
+
+
+def intern(value):
+    '''
+    sys.intern for strings, anything else (None, numbers) as is
+    '''
+    return sys.intern(value) if type(value) is str else value
+
+
+class TweetRecord():
+    '''
+    One tweet on its way through transform and load.
+    The fields transform fills in are None until then.
+    '''
+    __slots__ = ('mongo_id', 'tweet_ID', 'username', 'text', 'followers_count', 'was_retweeted',
+                 'timestamp', 'loc_lat', 'loc_lon', 'loc_type', 'location', 'politician',
+                 'extracted',
+                 # set by transform (or the text cache)
+                 'clean_text', 'sentiment', 'handles', 'hashtags', 'created_at', 'in_us',
+                 'us_state')
+
+    def __init__(self, mongo_id=None, tweet_ID=None, username=None, text=None,
+                 followers_count=None, was_retweeted=None, timestamp=None, loc_lat=None,
+                 loc_lon=None, loc_type=None, location=None, politician=None, extracted=None):
+        self.mongo_id = mongo_id
+        self.tweet_ID = tweet_ID
+        self.username = username
+        self.text = intern(text)
+        self.followers_count = followers_count
+        self.was_retweeted = was_retweeted
+        self.timestamp = timestamp
+        self.loc_lat = loc_lat
+        self.loc_lon = loc_lon
+        self.loc_type = intern(loc_type)
+        self.location = intern(location)
+        self.politician = intern(politician)
+        self.extracted = intern(extracted)
+        self.clean_text = None
+        self.sentiment = None
+        self.handles = None
+        self.hashtags = None
+        self.created_at = None
+        self.in_us = None
+        self.us_state = None
+
+    @classmethod
+    def from_document(cls, document):
+        '''
+        Builds a record from a tweet document as the collector stores it
+        '''
+        return cls(document['_id'], document['tweet_ID'], document['username'], document['text'],
+                   document['followers_count'], document['was_retweeted'],
+                   document['timestamp'], document['loc_lat'], document['loc_lon'],
+                   document['loc_type'], document['location'], document['politician'],
+                   document['extracted'])
+
+    def values(self):
+        '''
+        All fields as a tuple, in __slots__ order
+        '''
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __getstate__(self):
+        return self.values()
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, intern(value) if name in INTERNED else value)
+
+    def __eq__(self, other):
+        return isinstance(other, TweetRecord) and self.values() == other.values()
+
+    def __repr__(self):
+        return f'TweetRecord(tweet_ID={self.tweet_ID!r}, politician={self.politician!r})'
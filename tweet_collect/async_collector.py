@@ -0,0 +1,585 @@
+'''
+asyncio runtime for the collector.
+
+election_tweets.py reads the stream with a blocking tweepy Stream, parses
+and geocodes on the IngestPool threads (every ArcGIS call opening a new
+HTTPS connection) and writes with pymongo from the TweetWriter thread.
+Here one event loop does all of that:
+- the filter stream is read with aiohttp, the request signed (OAuth1)
+  with oauthlib
+- ArcGIS lookups share one keep-alive session, at most
+  GEOCODE_CONCURRENCY at a time; concurrent lookups of the same location
+  wait for one request
+- tweets are written with motor from a pool of MONGO_POOL connections
+The rest is the threaded collector's: route_tweet/get_loc/store_tweet,
+the gazetteer and GeoCache (check/settle around the remote call), the
+TweetWriter buffer and the QuotaScheduler windows.
+
+Reconnects follow Twitter's guidance: HTTP 420/429 back off from 60 s,
+doubling; other HTTP errors from 5 s, doubling up to 320 s; network errors
+and stalls (nothing, not even a keep-alive, for STALL_TIMEOUT) from 0.25 s,
+growing linearly up to 16 s. A stream the server ends cleanly is
+reconnected after NETWORK_BACKOFF, without counting as a failure.
+
+SIGINT/SIGTERM shut down gracefully: the stream is closed, the queued
+tweets are processed and the write buffer is flushed.
+
+--stream-url and --geocode-url can point at local stubs
+(benchmarks/http_stubs.py).
+
+Usage: python async_collector.py [--mode combined] [--stream-url URL] [--geocode-url URL]
+'''
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import time
+from urllib.parse import urlencode
+
+import aiohttp
+from motor.motor_asyncio import AsyncIOMotorClient
+from oauthlib.oauth1 import Client as OAuthClient
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+import election_tweets
+import geocache
+import ingest
+import metrics
+from credentials import *
+from election_tweets import geocode_query, get_loc, route_tweet, store_tweet
+from ingest import IngestPool, PROCESS_SECONDS, QUEUE_DEPTH
+from mongo_writer import TweetWriter
+from scheduler import QuotaScheduler
+
+STREAM_URL = 'https://stream.twitter.com/1.1/statuses/filter.json'
+# coroutines parsing, locating and buffering tweets
+WORKERS = 64
+GEOCODE_CONCURRENCY = 8
+# keep-alive connections of the shared HTTP session
+HTTP_CONNECTIONS = 16
+MONGO_POOL = 10
+STALL_TIMEOUT = 90
+GEOCODE_TIMEOUT = 10
+
+RATE_LIMIT_BACKOFF = 60
+MAX_RATE_LIMIT_BACKOFF = 15 * 60
+HTTP_BACKOFF = 5
+MAX_HTTP_BACKOFF = 320
+NETWORK_BACKOFF = 0.25
+MAX_NETWORK_BACKOFF = 16
+
+TWEET_LATENCY = metrics.histogram('collector_tweet_latency_seconds',
+                                  'Stream arrival to write buffer, per payload (async runtime)')
+RECONNECTS = metrics.counter('collector_stream_reconnects_total',
+                             'Stream reconnects by cause (async runtime)', ('cause',))
+
+
+class Backoff():
+    '''
+    Delays between stream reconnects, by cause:
+    'rate_limit' (420/429), 'http' (other statuses) or 'network'
+    (connection errors and stalls)
+    '''
+
+    def __init__(self):
+        self.cause = None
+        self.delay = 0
+
+    def failed(self, cause):
+        '''
+        Returns the delay before the next attempt
+        '''
+        if cause != self.cause:
+            self.cause = cause
+            self.delay = 0
+        if cause == 'rate_limit':
+            self.delay = min(MAX_RATE_LIMIT_BACKOFF, max(RATE_LIMIT_BACKOFF, self.delay * 2))
+        elif cause == 'http':
+            self.delay = min(MAX_HTTP_BACKOFF, max(HTTP_BACKOFF, self.delay * 2))
+        else:
+            self.delay = min(MAX_NETWORK_BACKOFF, self.delay + NETWORK_BACKOFF)
+        RECONNECTS.inc(cause=cause)
+        return self.delay
+
+    def reset(self):
+        '''
+        After a successful connect
+        '''
+        self.cause = None
+        self.delay = 0
+
+
+class AsyncGeocoder():
+    '''
+    Gazetteer, then GeoCache (its SQLite tier on the default executor),
+    then ArcGIS over the shared session
+    '''
+
+    def __init__(self, session, cache, url=None, concurrency=GEOCODE_CONCURRENCY):
+        self.session = session
+        self.cache = cache
+        self.url = url or geocache.ARCGIS_URL
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pending = {}
+        self.calls = 0
+
+    async def lookup(self, location):
+        '''
+        Asks ArcGIS; same answers as geocache.arcgis_lookup
+        '''
+        self.calls += 1
+        params = {'f': 'json', 'text': location, 'maxLocations': 1}
+        try:
+            async with self.session.get(self.url, params=params,
+                                        timeout=aiohttp.ClientTimeout(total=GEOCODE_TIMEOUT)) \
+                    as response:
+                if response.status != 200:
+                    return 'error', None
+                answer = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return 'error', None
+        if answer.get('error'):
+            return 'error', None
+        locations = answer.get('locations') or []
+        geometry = locations[0].get('feature', {}).get('geometry', {}) if locations else {}
+        if geometry.get('y') is None or geometry.get('x') is None:
+            return 'not_found', None
+        return 'ok', (geometry['y'], geometry['x'])
+
+    async def resolve(self, key, location):
+        '''
+        One remote lookup, cached (on a thread: SQLite) when done
+        '''
+        try:
+            async with self.semaphore:
+                started = time.perf_counter()
+                status, coords = await self.lookup(location)
+                seconds = time.perf_counter() - started
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.cache.settle, key, status, coords, seconds)
+            return coords
+        finally:
+            del self.pending[key]
+
+    async def geocode(self, location):
+        '''
+        Returns (lat, lon) for a location string, or None, like election_tweets.geocode_location
+        '''
+        coords = election_tweets.GAZETTEER.resolve(location)
+        if coords is not None:
+            return coords
+        # the LRU on the loop, the SQLite tier on a thread
+        key, found, coords = self.cache.check(location, disk=False)
+        if found is None:
+            key, found, coords = await asyncio.get_event_loop().run_in_executor(
+                None, self.cache.check, location)
+        if found:
+            return coords
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.resolve(key, location))
+        return await asyncio.shield(self.pending[key])
+
+
+class AsyncTweetWriter(TweetWriter):
+    '''
+    TweetWriter on the event loop: the collection is a motor collection,
+    and full batches are written by background tasks
+    '''
+
+    def __init__(self, collection, **kwargs):
+        super().__init__(collection, **kwargs)
+        self.flush_lock = asyncio.Lock()
+        self.flushes = set()
+
+    def start(self):
+        '''
+        Starts the task that flushes on flush_interval
+        '''
+        self.timer = asyncio.ensure_future(self.flush_periodically())
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.write()
+            except Exception:
+                logging.exception('--- Mongo writer: periodic flush failed ---')
+
+    def flush(self):
+        '''
+        Called by add() with a full batch: writes it in the background
+        '''
+        task = asyncio.ensure_future(self.write())
+        self.flushes.add(task)
+        task.add_done_callback(self.flushed)
+        return task
+
+    def flushed(self, task):
+        self.flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.critical('--- Mongo writer failed to flush: %r ---', task.exception())
+
+    async def write(self):
+        '''
+        Writes the buffered tweets in one unordered insert_many
+        '''
+        async with self.flush_lock:
+            batch = self.take()
+            if not batch:
+                return 0
+            details = None
+            started = time.perf_counter()
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as err:
+                details = err.details
+            except PyMongoError as err:
+                self.restore(batch, err)
+                return 0
+            return self.written(batch, details, time.perf_counter() - started)
+
+    async def close(self):
+        '''
+        Stops the timer and writes out anything still buffered
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+            try:
+                await self.timer
+            except asyncio.CancelledError:
+                pass
+            self.timer = None
+        if self.flushes:
+            await asyncio.wait(list(self.flushes))
+        await self.write()
+
+
+class AsyncIngestPool(IngestPool):
+    '''
+    IngestPool with worker coroutines and an asyncio queue.
+    handler is a coroutine function; submit() has to be awaited.
+    '''
+
+    def __init__(self, handler, workers=WORKERS, maxsize=ingest.QUEUE_SIZE,
+                 policy=ingest.DROP_POLICY):
+        super().__init__(handler, workers, maxsize, policy)
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.tasks = []
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    def start(self):
+        '''
+        Starts the worker tasks
+        '''
+        self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    async def submit(self, item):
+        '''
+        Enqueues item; only waits (up to BLOCK_TIMEOUT) under 'block'
+        Returns False if something had to be dropped.
+        '''
+        self.count('submitted')
+        accepted = True
+        try:
+            if self.policy == 'block':
+                await asyncio.wait_for(self.queue.put(item), ingest.BLOCK_TIMEOUT)
+            else:
+                self.queue.put_nowait(item)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            accepted = False
+            if self.policy == 'drop_oldest':
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.queue.put_nowait(item)
+                except (asyncio.QueueEmpty, asyncio.QueueFull):
+                    pass
+            self.count('dropped')
+        depth = self.queue.qsize()
+        if depth > self.counters['max_depth']:
+            self.counters['max_depth'] = depth
+        return accepted
+
+    async def work(self):
+        '''
+        Worker loop: awaits handler on queued items until told to stop
+        '''
+        while True:
+            item = await self.queue.get()
+            try:
+                if item is ingest.STOP:
+                    return
+                started = time.perf_counter()
+                await self.handler(item)
+                PROCESS_SECONDS.observe(time.perf_counter() - started)
+                self.count('processed')
+            except Exception:
+                self.count('errors')
+                logging.exception('--- Ingest worker failed to process a tweet ---')
+            finally:
+                self.queue.task_done()
+
+    async def stop(self, drain=True):
+        '''
+        Stops the workers, by default after the queue has been worked off
+        '''
+        if drain:
+            await self.queue.join()
+        for _ in self.tasks:
+            await self.queue.put(ingest.STOP)
+        await asyncio.wait(self.tasks)
+        self.tasks = []
+
+
+async def ensure_indexes(collection):
+    '''
+    mongo_writer.ensure_indexes for a motor collection
+    '''
+    try:
+        await collection.create_index('tweet_ID', unique=True)
+    except OperationFailure as err:
+        logging.critical('--- Could not create unique index on tweet_ID: %s ---', err)
+
+
+def oauth_client():
+    '''
+    Signs stream requests with the keys in credentials.py
+    '''
+    return OAuthClient(consumer_key, client_secret=consumer_secret,
+                       resource_owner_key=access_token, resource_owner_secret=access_token_secret)
+
+
+class AsyncCollector():
+    '''
+    Streams, locates and stores tweets in scheduler windows, on one event loop
+    '''
+
+    def __init__(self, session, collection, scheduler, stream_url=None, geocode_url=None,
+                 workers=WORKERS, policy=ingest.DROP_POLICY, concurrency=GEOCODE_CONCURRENCY,
+                 oauth=None, stream_mode=None):
+        self.session = session
+        self.scheduler = scheduler
+        self.stream_url = stream_url or STREAM_URL
+        self.oauth = oauth
+        self.stream_mode = stream_mode or election_tweets.STREAM_MODE
+        self.geocoder = AsyncGeocoder(session, election_tweets.GEOCODE_CACHE, geocode_url,
+                                      concurrency)
+        self.tweet_writer = AsyncTweetWriter(collection)
+        self.ingest_pool = AsyncIngestPool(self.process, workers=workers, policy=policy)
+        self.backoff = Backoff()
+        self.resume_at = 0
+        self.stopping = asyncio.Event()
+
+    async def process(self, item):
+        '''
+        process_tweet for the event loop: the geocoder is awaited instead of called
+        '''
+        payload, politician, arrived = item
+        raw_tweet = json.loads(payload)
+        routed = route_tweet(raw_tweet, politician, self.tweet_writer, self.scheduler)
+        if routed is not None:
+            text, was_retweeted, politician = routed
+            query = geocode_query(raw_tweet)
+            coords = None if query is None else await self.geocoder.geocode(query)
+            store_tweet(raw_tweet, text, was_retweeted, politician,
+                        get_loc(raw_tweet, lambda location: coords), self.tweet_writer,
+                        self.scheduler)
+        TWEET_LATENCY.observe(time.perf_counter() - arrived)
+
+    def request(self, politician):
+        '''
+        POSTs the filter request for politician (all of them if None)
+        '''
+        body = urlencode({'track': ','.join(self.scheduler.track(politician)), 'language': 'en'})
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        url = self.stream_url
+        if self.oauth is not None:
+            url, headers, body = self.oauth.sign(url, 'POST', body, headers)
+        return self.session.post(url, data=body, headers=headers,
+                                 timeout=aiohttp.ClientTimeout(total=None,
+                                                               sock_read=STALL_TIMEOUT))
+
+    async def connect(self, politician):
+        '''
+        Reads one stream connection until it ends
+        Returns the backoff before the next connect
+        '''
+        try:
+            async with self.request(politician) as response:
+                if response.status in (420, 429):
+                    cause = 'rate_limit'
+                elif response.status != 200:
+                    cause = 'http'
+                else:
+                    self.backoff.reset()
+                    logging.critical(
+                        '\n*\n*\n--- GETTING TWEETS ABOUT POLITICIAN %s ---\n*\n*\n',
+                        politician or 'ALL')
+                    async for line in response.content:
+                        line = line.strip()
+                        if line:
+                            await self.ingest_pool.submit((line, politician, time.perf_counter()))
+                    cause = None
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            cause = 'network'
+            status = repr(error)
+        if cause is None:
+            RECONNECTS.inc(cause='closed')
+            delay = NETWORK_BACKOFF
+        else:
+            delay = self.backoff.failed(cause)
+        logging.critical('--- Stream closed (%s), reconnecting in %s seconds ---', status, delay)
+        return delay
+
+    async def pause(self, seconds):
+        '''
+        Sleeps for seconds, or until shutdown
+        '''
+        if seconds > 0:
+            try:
+                await asyncio.wait_for(self.stopping.wait(), seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def window(self, politician, runtime):
+        '''
+        Streams tweets about politician (all of them if None) for runtime seconds,
+        reconnecting as needed
+        '''
+        deadline = time.time() + runtime
+        while not self.stopping.is_set() and time.time() < deadline:
+            if self.resume_at > time.time():
+                await self.pause(min(self.resume_at, deadline) - time.time())
+                continue
+            connection = asyncio.ensure_future(self.connect(politician))
+            stopped = asyncio.ensure_future(self.stopping.wait())
+            done, _ = await asyncio.wait([connection, stopped], timeout=deadline - time.time(),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            stopped.cancel()
+            if connection not in done:
+                connection.cancel()
+                try:
+                    await connection
+                except asyncio.CancelledError:
+                    pass
+                break
+            self.resume_at = time.time() + connection.result()
+        logging.critical('\n*\n*\n--- DISCONNECTING TWITTER STREAM ABOUT POLITICIAN %s ---\n*\n*\n',
+                         politician or 'ALL')
+        await self.tweet_writer.write()
+        self.log_stats()
+
+    async def run(self):
+        '''
+        Stream windows as the scheduler hands them out, until shutdown
+        '''
+        self.tweet_writer.start()
+        self.ingest_pool.start()
+        try:
+            while not self.stopping.is_set():
+                if self.stream_mode == 'combined':
+                    politician, runtime, wait = self.scheduler.next_combined_window()
+                else:
+                    politician, runtime, wait = self.scheduler.next_window()
+                if wait > 0:
+                    logging.critical('... sleeping for %s seconds', round(wait))
+                    await self.pause(wait)
+                    if self.stopping.is_set():
+                        break
+                start = time.time()
+                with metrics.PROFILER.cycle('collect-window'):
+                    await self.window(politician, runtime)
+                self.scheduler.end_window(politician, start, time.time())
+                logging.critical('--- Collected this period: %s ---', self.scheduler.collected())
+        finally:
+            await self.ingest_pool.stop()
+            await self.tweet_writer.close()
+            self.log_stats()
+
+    def stop(self):
+        '''
+        Graceful shutdown (signal handler)
+        '''
+        logging.critical('\n*\n*\n--- Shutting down ---\n*\n*')
+        self.stopping.set()
+
+    def stats(self):
+        '''
+        Returns the ingest, writer and geocoder counters
+        '''
+        return {'pool': self.ingest_pool.stats(), 'writer': self.tweet_writer.stats(),
+                'geocoder_calls': self.geocoder.calls,
+                'geocode_cache': election_tweets.GEOCODE_CACHE.stats()}
+
+    def log_stats(self):
+        '''
+        Logs the counters
+        '''
+        election_tweets.GEOCODE_CACHE.log_stats()
+        self.ingest_pool.log_stats()
+        self.tweet_writer.log_stats()
+
+
+async def collect(args):
+    '''
+    Sets up the connections and runs the collector until SIGINT/SIGTERM
+    '''
+    client = AsyncIOMotorClient(host=MDB_HOST, port=MDB_PORT, maxPoolSize=MONGO_POOL)
+    tweets = client.tweet_mongodb.tweet
+    await ensure_indexes(tweets)
+    logging.critical('Connected to MongoDB database tweet_mongodb\n*\n*\n*')
+    connector = aiohttp.TCPConnector(limit=HTTP_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        collector = AsyncCollector(session, tweets, QuotaScheduler(election_tweets.SEARCHTERMS),
+                                   args.stream_url, args.geocode_url, args.workers,
+                                   concurrency=args.geocode_concurrency, oauth=oauth_client(),
+                                   stream_mode=args.mode)
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, collector.stop)
+        await collector.run()
+    client.close()
+
+
+def parse_args():
+    '''
+    Command line options
+    '''
+    parser = argparse.ArgumentParser(description='Tweet collector on asyncio')
+    parser.add_argument('--mode', choices=['scheduled', 'combined'],
+                        default=election_tweets.STREAM_MODE,
+                        help='scheduled: one politician per window; combined: one stream for all')
+    parser.add_argument('--stream-url', default=STREAM_URL)
+    parser.add_argument('--geocode-url', default=geocache.ARCGIS_URL)
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='coroutines parsing, locating and buffering tweets')
+    parser.add_argument('--geocode-concurrency', type=int, default=GEOCODE_CONCURRENCY,
+                        help='ArcGIS requests in flight at most')
+    parser.add_argument('--metrics-port', type=int, default=election_tweets.METRICS_PORT,
+                        help='serve /metrics and /metrics.json on this port (0: off)')
+    parser.add_argument('--log-level', default=election_tweets.LOG_LEVEL)
+    return parser.parse_args()
+
+
+def main():
+    '''
+    All systems go, on one event loop
+    '''
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+    metrics.start(args.metrics_port or None, election_tweets.METRICS_DUMP,
+                  election_tweets.PROFILE_WINDOWS)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(collect(args))
+    finally:
+        loop.close()
+
+##########
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,44 @@
 import json
 import logging
 import time
-import random
 import datetime
-import geocoder
 
 from tweepy import OAuthHandler, Stream, API
 from tweepy.streaming import StreamListener
 
 from pymongo import MongoClient
 
+import metrics
 from credentials import *
+from geocache import GeoCache
+from gazetteer import Gazetteer
+from ingest import IngestPool
+from mongo_writer import TweetWriter, ensure_indexes
+from scheduler import QuotaScheduler
 
 SEARCHTERMS = [['joe biden', 'joebiden'], ['kamala harris', 'kamalaharris'], \
  ['donald trump', 'donaldtrump'], ['mike pence', 'mikepence']]
 
+# 'scheduled': one politician per stream window, chosen by QuotaScheduler
+# 'combined': one stream tracking all SEARCHTERMS, tweets routed by keyword
+STREAM_MODE = 'scheduled'
+
+GAZETTEER = Gazetteer()
+GEOCODE_CACHE = GeoCache()
+
+# metrics endpoint (None: off) and periodic JSON dump (None: off), see metrics.py
+METRICS_PORT = 9101
+METRICS_DUMP = None
+# stream windows to profile from the start; kill -USR1 profiles the next one
+PROFILE_WINDOWS = 0
+# per-batch messages are logged at DEBUG
+LOG_LEVEL = 'WARNING'
+
+TWEETS_RECEIVED = metrics.counter('collector_tweets_received_total',
+                                  'Tweets parsed and routed to a politician', ('politician',))
+LOCATIONS = metrics.counter('collector_locations_total',
+                            'Received tweets by location source', ('loc_type',))
+
 def mongo_connect(db_name, collection_name):
     '''
     Connects to MongoDB database
@@ -23,6 +47,7 @@ def mongo_connect(db_name, collection_name):
     client = MongoClient(host=MDB_HOST, port=MDB_PORT)
     collection_name = getattr(client, db_name)
     tweets = collection_name.tweet
+    ensure_indexes(tweets)
     logging.critical('Connected to MongoDB database %s\n*\n*\n*', db_name)
     return tweets
 
@@ -42,7 +67,33 @@ def authenticate():
     return auth
 
 
-def get_loc(raw_tweet):
+def geocode_location(location):
+    '''
+    Resolves a place name or self-reported location to (lat, lon), or None.
+    Tries the offline gazetteer first; the remote geocoder (behind
+    GEOCODE_CACHE) is only called on a gazetteer miss.
+    '''
+    coords = GAZETTEER.resolve(location)
+    if coords is None:
+        coords = GEOCODE_CACHE.geocode(location)
+    return coords
+
+
+def geocode_query(raw_tweet):
+    '''
+    Returns the place name or self-reported location get_loc would geocode,
+    or None if the tweet carries coordinates or no location at all
+    '''
+    if raw_tweet.get('geo') is not None:
+        return None
+    if raw_tweet.get('place') is not None:
+        if raw_tweet['place']['bounding_box'] is not None:
+            return None
+        return raw_tweet['place']['full_name']
+    return raw_tweet['user'].get('location')
+
+
+def get_loc(raw_tweet, geocode=geocode_location):
     '''
     Returns:
     1. tweet location (with coordinates where possible),
@@ -57,6 +108,8 @@ def get_loc(raw_tweet):
     - coordinates in 'geo' are in order lat, lon
     - coordinates elsewhere are in order lon, lat
     - bounding_box: only 1st set of coordinates; sufficient for present purposes
+    - place names and self-reported locations go through geocode
+      (geocode_location; see geocode_query for the string it gets)
     '''
     loc_lat = 'no_loc'
     loc_lon = 'no_loc'
@@ -73,18 +126,16 @@ def get_loc(raw_tweet):
         loc_type = 'bound_box_coords'
         location = 'box_coords'
     elif 'place' in raw_tweet and raw_tweet['place'] is not None:
-        pre = geocoder.arcgis(raw_tweet['place']['full_name'])
+        coords = geocode(raw_tweet['place']['full_name'])
         location = raw_tweet['place']['full_name']
-        if pre.ok:
-            loc_lon = pre.x
-            loc_lat = pre.y
+        if coords is not None:
+            loc_lat, loc_lon = coords
             loc_type = 'place'
     elif 'location' in raw_tweet['user'] and raw_tweet['user']['location'] is not None:
         location = raw_tweet['user']['location'][:50]
-        pre = geocoder.arcgis(raw_tweet['user']['location'])
-        if pre.ok:
-            loc_lon = pre.x
-            loc_lat = pre.y
+        coords = geocode(raw_tweet['user']['location'])
+        if coords is not None:
+            loc_lat, loc_lon = coords
             loc_type = 'user_loc'
         else:
             location = 'no_loc'
@@ -109,67 +160,102 @@ def get_retweet(raw_tweet):
         was_retweeted = 'false'
     return text, was_retweeted
 
+def route_tweet(raw_tweet, politician, tweet_writer, scheduler):
+    '''
+    Skips payloads that aren't tweets or were seen recently, and finds the
+    politician of a combined-stream tweet (politician None) with the scheduler
+    Returns (text, was_retweeted, politician), or None if the tweet isn't kept
+    '''
+    if 'user' not in raw_tweet or tweet_writer.seen(raw_tweet['id_str'], politician):
+        return None
+
+    text, was_retweeted = get_retweet(raw_tweet)
+
+    if politician is None:
+        politician = scheduler.route(text + ' ' + raw_tweet.get('text', ''))
+        if politician is None:
+            return None
+
+    TWEETS_RECEIVED.inc(politician=politician)
+    return text, was_retweeted, politician
+
+def store_tweet(raw_tweet, text, was_retweeted, politician, loc, tweet_writer, scheduler):
+    '''
+    Builds the document for a routed and located tweet and hands it to the MongoDB writer
+    '''
+    loc_lat, loc_lon, loc_type, location = loc
+    LOCATIONS.inc(loc_type=loc_type)
+
+    tweet = {
+        'text': text,
+        'username': raw_tweet['user']['screen_name'],
+        'followers_count': raw_tweet['user']['followers_count'],
+        'was_retweeted': was_retweeted,
+        'timestamp': raw_tweet['created_at'],
+        'tweet_ID': raw_tweet['id_str'],
+        'loc_lat': loc_lat,
+        'loc_lon': loc_lon,
+        'loc_type': loc_type,
+        'location': location,
+        'politician': politician,
+        'extracted': 'no'
+    }
+
+    if tweet['text'] != 'text_empty' and tweet_writer.add(tweet):
+        scheduler.record(politician)
+
+def process_tweet(data, politician, tweet_writer, scheduler):
+    '''
+    Parses a raw stream payload, locates it and hands it to the MongoDB writer.
+    Runs on the ingest worker threads, not on the stream thread.
+    politician is None for combined streams; the scheduler routes those tweets.
+    '''
+    raw_tweet = json.loads(data)
+    routed = route_tweet(raw_tweet, politician, tweet_writer, scheduler)
+    if routed is not None:
+        text, was_retweeted, politician = routed
+        store_tweet(raw_tweet, text, was_retweeted, politician, get_loc(raw_tweet),
+                    tweet_writer, scheduler)
+
+
 class TwitterListener(StreamListener):
     '''
     Defines TwitterListener as an instance of StreamListener
-    Additions for passing in API, politician, runtime and database
+    Additions for passing in API, politician, runtime, the ingest pool
+    and the MongoDB writer
     '''
 
-    def __init__(self, api, politician, runtime, mongo_database):
+    def __init__(self, api, politician, runtime, ingest_pool, tweet_writer):
         self.api = api
         self.politician = politician
         self.start = time.time()
         self.runtime = runtime
-        self.mongo_database = mongo_database
+        self.ingest_pool = ingest_pool
+        self.tweet_writer = tweet_writer
 
     def on_connect(self):
         logging.critical(
             '\n*\n*\n--- GETTING TWEETS ABOUT POLITICIAN %s FOR %s SECONDS ---\n*\n*\n',
-            self.politician, self.runtime)
+            self.politician or 'ALL', self.runtime)
 
     def on_data(self, data):
         '''
-        Extracts tweets with specified keywords.
-        Stores them in a MongoDB database.
+        Hands tweets with specified keywords to the ingest pool.
+        Parsing, geocoding and storage happen in process_tweet on the workers,
+        so the stream thread keeps up with bursts.
         '''
         now = time.time()
         if (now - self.start) < self.runtime:
-
-            raw_tweet = json.loads(data)
-
-            if 'user' in raw_tweet:
-
-                text, was_retweeted = get_retweet(raw_tweet)
-
-                loc_lat, loc_lon, loc_type, location = get_loc(raw_tweet)
-
-                tweet = {
-                    'text': text,
-                    'username': raw_tweet['user']['screen_name'],
-                    'followers_count': raw_tweet['user']['followers_count'],
-                    'was_retweeted': was_retweeted,
-                    'timestamp': raw_tweet['created_at'],
-                    'tweet_ID': raw_tweet['id_str'],
-                    'loc_lat': loc_lat,
-                    'loc_lon': loc_lon,
-                    'loc_type': loc_type,
-                    'location': location,
-                    'politician': self.politician,
-                    'extracted': 'no'
-                }
-
-                tweet_id = tweet['tweet_ID']
-
-                if tweet['text'] != 'text_empty' and self.mongo_database.find({'tweet_ID': tweet_id}).count() == 0:
-                    self.mongo_database.insert_one(tweet)
-                    logging.critical(
-                        '\n*\n*\n--- LOGGED %s ABOUT %s---', str(tweet_id), self.politician)
-                    logging.critical('--- Remaining runtime: %s seconds---\n*\n*\n*',
-                                     round(self.runtime - (now - self.start), 2))
+            self.ingest_pool.submit((data, self.politician))
 
         else:
             logging.critical(
-                '\n*\n*\n--- DISCONNECTING TWITTER STREAM ABOUT POLITICIAN %s ---\n*\n*\n', self.politician)
+                '\n*\n*\n--- DISCONNECTING TWITTER STREAM ABOUT POLITICIAN %s ---\n*\n*\n',
+                self.politician or 'ALL')
+            self.tweet_writer.flush()
+            GEOCODE_CACHE.log_stats()
+            self.ingest_pool.log_stats()
+            self.tweet_writer.log_stats()
             return False
 
     def on_error(self, status):
@@ -178,65 +264,64 @@ class TwitterListener(StreamListener):
             return False
 
 
-def tweet_sleep():
+def tweet_sleep(sleep):
     '''
-    Pauses tweet collection for ca. 7 min.
+    Pauses tweet collection for as long as the scheduler asks
     '''
-    sleep = random.randint(50, 70) * random.randint(3, 8)
-    # jitter for sleep: sleep duration is roughly 1 minute * roughly 7 minutes
-    logging.critical('... sleeping for %s seconds', sleep)
+    logging.critical('... sleeping for %s seconds', round(sleep))
     logging.critical('... sleeping at: %s---\n*\n*\n',
                      datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
     time.sleep(sleep)
 
-def get_runtime(politician):
-    '''
-    Sets runtime of tweet collection
-    '''
-    runtime_basic = 75
-    # standard runtime is short to avoid timeouts due to too-rapid rate of incoming tweets
-    # these can otherwise cause backlogs that overwhelm the data architecture
-    if politician == 'mikepence':
-        runtime_basic = 120
-        # people tweet less about Mike Pence
-        # setting runtime higher to get more data
-    runtime_jitter = random.randint(8, 17)
-    runtime = runtime_basic - runtime_jitter
-    return runtime
-
 def setup():
     '''
-    Set up connection to database, authentication and API config
+    Set up connection to database, authentication, API config,
+    the stream scheduler, the buffered MongoDB writer and the ingest workers
+    (sizes and policies are set in scheduler.py, mongo_writer.py and ingest.py)
     '''
     mongo_collection_tweets = mongo_connect('tweet_mongodb', 'tweet_db')
     auth = authenticate()
     my_api = API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
-    return mongo_collection_tweets, auth, my_api
-
-def get_tweets(i, auth, my_api, mongo_database):
+    scheduler = QuotaScheduler(SEARCHTERMS)
+    tweet_writer = TweetWriter(mongo_collection_tweets)
+    tweet_writer.start()
+    ingest_pool = IngestPool(
+        lambda item: process_tweet(item[0], item[1], tweet_writer, scheduler))
+    ingest_pool.start()
+    return ingest_pool, tweet_writer, scheduler, auth, my_api
+
+def get_tweets(politician, runtime, auth, my_api, ingest_pool, tweet_writer, scheduler):
     '''
-    Stream tweets
+    Stream tweets about politician (or all of them if None) for runtime seconds
     '''
-    current_search = SEARCHTERMS[i]
-    politician = current_search[1]
-    runtime = get_runtime(politician)
-    listener = TwitterListener(my_api, politician, runtime, mongo_database)
+    listener = TwitterListener(my_api, politician, runtime, ingest_pool, tweet_writer)
     stream = Stream(auth, listener)
-    stream.filter(track=current_search, languages=['en'])
+    stream.filter(track=scheduler.track(politician), languages=['en'])
 
 def main():
     '''
     All systems go!
     '''
-    mongo_collection_tweets, auth, my_api = setup()
-    i = 0
-    while True:
-        get_tweets(i, auth, my_api, mongo_collection_tweets)
-        if i >= 3:
-            i = 0
-        else:
-            i += 1
-        tweet_sleep()
+    logging.basicConfig(level=LOG_LEVEL)
+    metrics.start(METRICS_PORT, METRICS_DUMP, PROFILE_WINDOWS)
+    ingest_pool, tweet_writer, scheduler, auth, my_api = setup()
+    try:
+        while True:
+            if STREAM_MODE == 'combined':
+                politician, runtime, wait = scheduler.next_combined_window()
+            else:
+                politician, runtime, wait = scheduler.next_window()
+            if wait > 0:
+                tweet_sleep(wait)
+            start = time.time()
+            # the work happens on the ingest threads, which only the sampling profiler sees
+            with metrics.PROFILER.cycle('collect-window', kind='sampling'):
+                get_tweets(politician, runtime, auth, my_api, ingest_pool, tweet_writer, scheduler)
+            scheduler.end_window(politician, start, time.time())
+            logging.critical('--- Collected this period: %s ---', scheduler.collected())
+    finally:
+        ingest_pool.stop()
+        tweet_writer.close()
 
 ##########
 
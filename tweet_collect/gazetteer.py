@@ -0,0 +1,141 @@
+'''
+Offline geocoder for US-centric self-reported locations.
+
+Builds token hashes from the bundled gazetteer_us.csv (country names, states,
+state abbreviations, large cities and common aliases like NYC or Philly)
+and resolves strings like "West Chester, PA", "Houston Texas" or
+"Florida, USA" to (lat, lon) without any network call.
+Anything it can't resolve confidently is a miss (None), so the caller can
+fall back to the remote geocoder.
+'''
+import csv
+import os
+import re
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer_us.csv')
+
+# state codes that are also everyday words; only accepted next to a city name
+AMBIGUOUS_CODES = {'in', 'me', 'or', 'ok', 'hi', 'la', 'de'}
+
+SEPARATORS = re.compile(r'[|/;&]|\s-\s')
+NOT_WORD = re.compile(r"[^\w\s,]")
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalise(text):
+    '''
+    Lowercases, drops dots/emoji/punctuation and maps |, /, ; and & to commas
+    '''
+    text = text.casefold().replace('.', '').replace('_', ' ')
+    text = SEPARATORS.sub(',', text)
+    text = NOT_WORD.sub(' ', text)
+    return WHITESPACE.sub(' ', text).strip(' ,')
+
+
+class Gazetteer():
+    '''
+    In-memory index over the gazetteer file.
+    resolve() returns (lat, lon) or None.
+    '''
+
+    def __init__(self, path=GAZETTEER_PATH):
+        self.country = None
+        self.countries = set()
+        self.state_codes = {}     # 'texas' / 'tx' / 'tex' -> 'tx'
+        self.state_coords = {}    # 'tx' -> (lat, lon)
+        self.places = {}          # 'houston' -> [(lat, lon, 'tx'), ...] in file order
+        self.cities = {}          # ('houston', 'tx') -> (lat, lon)
+        with open(path, newline='', encoding='utf-8') as gazetteer_file:
+            for row in csv.DictReader(gazetteer_file):
+                self.add(row)
+
+    def add(self, row):
+        '''
+        Adds one gazetteer row to the index
+        '''
+        name = normalise(row['name'])
+        code = row['state'].casefold()
+        if row['kind'] == 'country':
+            self.countries.add(name)
+            self.country = (float(row['lat']), float(row['lon']))
+        elif row['kind'] == 'state':
+            self.state_codes[name] = code
+            self.state_codes[code] = code
+            self.state_coords[code] = (float(row['lat']), float(row['lon']))
+        elif row['kind'] == 'state_alias':
+            self.state_codes[name] = code
+        else:
+            coords = (float(row['lat']), float(row['lon']))
+            self.places.setdefault(name, []).append(coords + (code,))
+            self.cities.setdefault((name, code), coords)
+
+    def lookup_name(self, name):
+        '''
+        Resolves a single name: city/alias first, then state, then country
+        '''
+        if name in self.places:
+            return self.places[name][0][:2]
+        code = self.state_codes.get(name)
+        if code is not None and name not in AMBIGUOUS_CODES:
+            return self.state_coords[code]
+        if name in self.countries:
+            return self.country
+        return None
+
+    def lookup_city_state(self, city, state):
+        '''
+        Resolves a city qualified by a state name or code
+        '''
+        code = self.state_codes.get(state)
+        if code is None:
+            return None
+        if not city:
+            return self.state_coords[code]
+        return self.cities.get((city, code))
+
+    def lookup_words(self, text):
+        '''
+        Resolves comma-free strings like "houston texas" or "norman ok"
+        by trying the last one to three words as a state
+        '''
+        coords = self.lookup_name(text)
+        if coords is not None:
+            return coords
+        words = text.split(' ')
+        for size in (3, 2, 1):
+            if len(words) > size:
+                city = ' '.join(words[:-size])
+                state = ' '.join(words[-size:])
+                coords = self.lookup_city_state(city, state)
+                if coords is not None:
+                    return coords
+        return None
+
+    def strip_country(self, parts):
+        '''
+        Drops a trailing "USA" / "United States" part or word
+        '''
+        if parts and parts[-1] in self.countries:
+            parts = parts[:-1]
+        if parts:
+            words = parts[-1].rsplit(' ', 1)
+            if len(words) == 2 and words[1] in self.countries:
+                parts = parts[:-1] + [words[0]]
+        return parts
+
+    def resolve(self, location):
+        '''
+        Returns (lat, lon) for a location string, or None on a miss
+        '''
+        text = normalise(location)
+        if not text:
+            return None
+        if text in self.countries:
+            return self.country
+        parts = [part.strip() for part in text.split(',')]
+        parts = self.strip_country([part for part in parts if part])
+        if not parts:
+            return self.country
+        if len(parts) == 1:
+            return self.lookup_words(parts[0])
+        return self.lookup_city_state(parts[-2], parts[-1])
@@ -0,0 +1,219 @@
+'''
+Geocoding cache for self-reported tweet locations.
+
+Two tiers sit in front of the ArcGIS geocoder:
+- an in-process LRU for the hot strings ("California", "NYC", "Texas, USA")
+- a SQLite file that survives container restarts (/app is a mounted volume)
+
+Locations the geocoder has no answer for ("nunya", "hell since 2016") are
+cached as negative results, but only for NEGATIVE_TTL seconds.
+Lookups that failed because of network trouble are not cached at all.
+
+check() and settle() are the two halves of geocode() around the remote
+call, for callers that make that call themselves (async_collector.py).
+check(location, disk=False) only looks at the LRU, so an event loop can
+leave the SQLite tier (check() and settle()) to a thread. The LRU and the
+SQLite connection have separate locks: disk I/O never holds up a memory hit.
+'''
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import geocoder
+
+import metrics
+
+CACHE_PATH = 'geocache.sqlite3'
+LRU_SIZE = 20000
+NEGATIVE_TTL = 3 * 24 * 60 * 60
+# point this at a local stub for tests and benchmarks
+ARCGIS_URL = 'https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/find'
+
+GEOCODE_RESULTS = metrics.counter('collector_geocode_total',
+                                  'Geocode cache lookups by result', ('result',))
+GEOCODE_SECONDS = metrics.histogram('collector_geocode_seconds',
+                                    'Remote geocoder call duration by status', ('status',))
+
+WHITESPACE = re.compile(r'\s+')
+EDGE_PUNCTUATION = ' \t\n.,;:!?-_*~|/\\\'"()[]{}'
+
+
+def normalise_location(location):
+    '''
+    Returns the cache key for a location string:
+    lowercased, whitespace collapsed, stray punctuation stripped from both ends
+    '''
+    key = WHITESPACE.sub(' ', location.casefold())
+    return key.strip(EDGE_PUNCTUATION)
+
+
+def arcgis_lookup(location):
+    '''
+    Calls the ArcGIS geocoder.
+    Returns (status, coords) where status is one of
+    'ok' (coords is (lat, lon)), 'not_found' or 'error' (coords is None)
+    '''
+    pre = geocoder.arcgis(location, url=ARCGIS_URL)
+    if pre.ok:
+        return 'ok', (pre.y, pre.x)
+    if pre.status_code == 200:
+        return 'not_found', None
+    return 'error', None
+
+
+class GeoCache():
+    '''
+    LRU + SQLite cache around a geocoding function.
+    Safe to share between threads.
+    '''
+
+    def __init__(self, path=CACHE_PATH, maxsize=LRU_SIZE, negative_ttl=NEGATIVE_TTL,
+                 lookup=arcgis_lookup):
+        self.path = path
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self.lookup = lookup
+        self.memory = OrderedDict()
+        # LRU and counters
+        self.lock = threading.Lock()
+        # SQLite connection
+        self.disk_lock = threading.Lock()
+        self.conn = None
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'negative_hits': 0,
+                         'misses': 0, 'errors': 0}
+
+    def connect(self):
+        '''
+        Opens the SQLite store on first use
+        '''
+        if self.conn is None and self.path is not None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS geocode (
+            key TEXT PRIMARY KEY, lat REAL, lon REAL, expires REAL);''')
+            self.conn.commit()
+        return self.conn
+
+    def count(self, counter):
+        '''
+        Adds one to a counter (check and settle run on several threads)
+        '''
+        with self.lock:
+            self.counters[counter] += 1
+
+    def remember(self, key, coords, expires):
+        '''
+        Puts an entry into the LRU tier, evicting the oldest one if full
+        '''
+        self.memory[key] = (coords, expires)
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def cached(self, key, now, disk=True):
+        '''
+        Looks key up in memory, then (if disk) on disk.
+        Returns (tier, coords): tier is 'memory', 'disk' or None if not found
+        '''
+        with self.lock:
+            if key in self.memory:
+                coords, expires = self.memory[key]
+                if expires is None or expires > now:
+                    self.memory.move_to_end(key)
+                    return 'memory', coords
+                del self.memory[key]
+        if not disk:
+            return None, None
+        with self.disk_lock:
+            conn = self.connect()
+            if conn is None:
+                return None, None
+            row = conn.execute('SELECT lat, lon, expires FROM geocode WHERE key = ?;',
+                               (key,)).fetchone()
+        if row is None or (row[2] is not None and row[2] <= now):
+            return None, None
+        coords = None if row[0] is None else (row[0], row[1])
+        with self.lock:
+            self.remember(key, coords, row[2])
+        return 'disk', coords
+
+    def store(self, key, coords, expires):
+        '''
+        Writes an entry to both tiers
+        '''
+        with self.lock:
+            self.remember(key, coords, expires)
+        with self.disk_lock:
+            conn = self.connect()
+            if conn is not None:
+                lat, lon = coords if coords is not None else (None, None)
+                conn.execute('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?);',
+                             (key, lat, lon, expires))
+                conn.commit()
+
+    def check(self, location, disk=True):
+        '''
+        Looks a location string up in the cache
+        Returns (key, found, coords); found is False if the geocoder has to be asked.
+        With disk False only the LRU is looked at, and found is None (nothing
+        counted yet) if the SQLite tier still has to be asked with check(location)
+        '''
+        key = normalise_location(location)
+        if not key:
+            return key, True, None
+        tier, coords = self.cached(key, time.time(), disk)
+        if tier is None and not disk and self.path is not None:
+            return key, None, None
+        if tier is not None:
+            # each lookup is counted once: cached "not found" answers as negative hits
+            result = 'negative_hit' if coords is None else f'{tier}_hit'
+            self.count(result + 's')
+            GEOCODE_RESULTS.inc(result=result)
+            return key, True, coords
+        self.count('misses')
+        GEOCODE_RESULTS.inc(result='miss')
+        return key, False, None
+
+    def settle(self, key, status, coords, seconds):
+        '''
+        Caches the geocoder's answer for key (see arcgis_lookup), seconds being how long it took
+        '''
+        GEOCODE_SECONDS.observe(seconds, status=status)
+        if status == 'ok':
+            self.store(key, coords, None)
+        elif status == 'not_found':
+            self.store(key, None, time.time() + self.negative_ttl)
+        else:
+            self.count('errors')
+
+    def geocode(self, location):
+        '''
+        Returns (lat, lon) for a location string, or None if it can't be resolved
+        '''
+        key, found, coords = self.check(location)
+        if found:
+            return coords
+        started = time.perf_counter()
+        status, coords = self.lookup(location)
+        self.settle(key, status, coords, time.perf_counter() - started)
+        return coords
+
+    def stats(self):
+        '''
+        Returns hit/miss counters plus the overall hit rate
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+            stats['memory_size'] = len(self.memory)
+        hits = stats['memory_hits'] + stats['disk_hits'] + stats['negative_hits']
+        total = hits + stats['misses']
+        stats['hit_rate'] = round(hits / total, 3) if total else 0.0
+        return stats
+
+    def log_stats(self):
+        '''
+        Logs the counters
+        '''
+        logging.critical('--- Geocode cache: %s ---', self.stats())
@@ -0,0 +1,140 @@
+'''
+Bounded hand-off between the tweepy stream thread and the workers that
+parse, geocode and store tweets.
+
+The stream thread only calls IngestPool.submit(); if the workers fall behind
+and the queue is full, DROP_POLICY decides what gives:
+- 'drop_newest': the incoming payload is discarded
+- 'drop_oldest': the oldest queued payload is discarded to make room
+- 'block': the stream thread waits up to BLOCK_TIMEOUT seconds, then drops
+'''
+import logging
+import queue
+import threading
+import time
+
+import metrics
+
+WORKERS = 4
+QUEUE_SIZE = 5000
+DROP_POLICY = 'drop_oldest'
+BLOCK_TIMEOUT = 1.0
+
+STOP = object()
+
+INGEST_ITEMS = metrics.counter('collector_ingest_total',
+                               'Payloads through the ingest queue by outcome', ('outcome',))
+PROCESS_SECONDS = metrics.histogram('collector_process_seconds',
+                                    'Worker time per payload (parse, locate, buffer)')
+QUEUE_DEPTH = metrics.gauge('collector_queue_depth', 'Payloads waiting for a worker')
+
+
+class IngestPool():
+    '''
+    Fixed pool of worker threads consuming a bounded queue.
+    handler is called with each submitted item.
+    '''
+
+    def __init__(self, handler, workers=WORKERS, maxsize=QUEUE_SIZE, policy=DROP_POLICY):
+        if policy not in ('drop_newest', 'drop_oldest', 'block'):
+            raise ValueError(f'unknown drop policy {policy}')
+        self.handler = handler
+        self.workers = workers
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.counters = {'submitted': 0, 'processed': 0, 'dropped': 0, 'errors': 0,
+                         'max_depth': 0}
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    def start(self):
+        '''
+        Starts the worker threads
+        '''
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f'ingest-{number}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def count(self, name, amount=1):
+        '''
+        Bumps a counter (and its metric)
+        '''
+        with self.lock:
+            self.counters[name] += amount
+        INGEST_ITEMS.inc(amount, outcome=name)
+
+    def submit(self, item):
+        '''
+        Enqueues item without blocking the caller (except under 'block').
+        Returns False if something had to be dropped.
+        '''
+        self.count('submitted')
+        accepted = True
+        try:
+            if self.policy == 'block':
+                self.queue.put(item, timeout=BLOCK_TIMEOUT)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            accepted = False
+            if self.policy == 'drop_oldest':
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.queue.put_nowait(item)
+                except (queue.Empty, queue.Full):
+                    pass
+            self.count('dropped')
+        depth = self.queue.qsize()
+        with self.lock:
+            if depth > self.counters['max_depth']:
+                self.counters['max_depth'] = depth
+        return accepted
+
+    def work(self):
+        '''
+        Worker loop: runs handler on queued items until told to stop
+        '''
+        while True:
+            item = self.queue.get()
+            try:
+                if item is STOP:
+                    return
+                started = time.perf_counter()
+                self.handler(item)
+                PROCESS_SECONDS.observe(time.perf_counter() - started)
+                self.count('processed')
+            except Exception:
+                self.count('errors')
+                logging.exception('--- Ingest worker failed to process a tweet ---')
+            finally:
+                self.queue.task_done()
+
+    def stop(self, drain=True):
+        '''
+        Stops the workers, by default after the queue has been worked off
+        '''
+        if drain:
+            self.queue.join()
+        for _ in self.threads:
+            self.queue.put(STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self):
+        '''
+        Returns counters plus the current queue depth
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+        stats['depth'] = self.queue.qsize()
+        return stats
+
+    def log_stats(self):
+        '''
+        Logs the counters
+        '''
+        logging.critical('--- Ingest queue: %s ---', self.stats())
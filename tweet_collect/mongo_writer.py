@@ -0,0 +1,237 @@
+'''
+Buffered writes of collected tweets to MongoDB.
+
+Tweets are collected in memory and written with insert_many(ordered=False)
+once BATCH_SIZE tweets are waiting or FLUSH_INTERVAL seconds have passed.
+Duplicates are rejected by the unique index on tweet_ID (see ensure_indexes);
+a small set of recently seen IDs lets the collector skip obvious repeats
+before spending a geocoding call on them.
+
+A batch that can't be written at all (MongoDB unreachable) goes back to the
+front of the buffer for the next flush. Past MAX_BUFFER tweets the oldest
+are dropped; they, and tweets rejected for reasons other than being
+duplicates, are taken out of the recent-ID set so a redelivery gets in.
+'''
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+import metrics
+
+BATCH_SIZE = 200
+FLUSH_INTERVAL = 5.0
+RECENT_IDS = 50000
+# tweets kept in memory while MongoDB can't be written to
+MAX_BUFFER = 20000
+DUPLICATE_KEY = 11000
+
+TWEETS_STORED = metrics.counter('collector_tweets_stored_total',
+                                'Tweets inserted into MongoDB', ('politician',))
+TWEETS_DEDUPED = metrics.counter('collector_tweets_deduped_total',
+                                 'Repeat tweets skipped (recent: ID set, index: unique index)',
+                                 ('politician', 'stage'))
+FLUSH_SECONDS = metrics.histogram('collector_flush_seconds', 'insert_many duration per batch')
+BUFFERED = metrics.gauge('collector_write_buffer', 'Tweets waiting for the next flush')
+
+
+def ensure_indexes(collection):
+    '''
+    Creates the unique tweet_ID index the writer relies on for dedup
+    '''
+    try:
+        collection.create_index('tweet_ID', unique=True)
+    except OperationFailure as err:
+        # existing duplicate documents block the unique index;
+        # the recent-ID set still catches most repeats
+        logging.critical('--- Could not create unique index on tweet_ID: %s ---', err)
+
+
+class TweetWriter():
+    '''
+    Thread-safe write buffer in front of a MongoDB collection
+    '''
+
+    def __init__(self, collection, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 recent_size=RECENT_IDS):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.recent_size = recent_size
+        self.buffer = []
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = None
+        self.counters = {'added': 0, 'inserted': 0, 'duplicates': 0, 'skipped_recent': 0,
+                         'flushes': 0, 'requeued': 0, 'dropped': 0}
+        BUFFERED.set_function(lambda: len(self.buffer))
+
+    def start(self):
+        '''
+        Starts the background thread that flushes on FLUSH_INTERVAL
+        '''
+        self.timer = threading.Thread(target=self.flush_periodically, name='mongo-writer',
+                                      daemon=True)
+        self.timer.start()
+
+    def flush_periodically(self):
+        '''
+        Timer loop: flushes whatever is buffered every flush_interval seconds
+        '''
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('--- Mongo writer: periodic flush failed ---')
+
+    def seen(self, tweet_id, politician=None):
+        '''
+        Returns True if tweet_id was added recently; counts it as skipped
+        (politician is None in combined streams, where tweets are routed later)
+        '''
+        with self.lock:
+            if tweet_id in self.recent:
+                self.recent.move_to_end(tweet_id)
+                self.counters['skipped_recent'] += 1
+                TWEETS_DEDUPED.inc(politician=politician or 'all', stage='recent')
+                return True
+        return False
+
+    def add(self, tweet):
+        '''
+        Buffers a tweet, flushing if the batch is full.
+        Returns False if the tweet was skipped as a recent repeat.
+        '''
+        tweet_id = tweet['tweet_ID']
+        with self.lock:
+            if tweet_id in self.recent:
+                self.counters['skipped_recent'] += 1
+                TWEETS_DEDUPED.inc(politician=tweet['politician'], stage='recent')
+                return False
+            self.recent[tweet_id] = None
+            if len(self.recent) > self.recent_size:
+                self.recent.popitem(last=False)
+            self.buffer.append(tweet)
+            self.counters['added'] += 1
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+        return True
+
+    def take(self):
+        '''
+        Empties the buffer and returns what was in it
+        '''
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        return batch
+
+    def flush(self):
+        '''
+        Writes the buffered tweets in one unordered insert_many
+        '''
+        with self.flush_lock:
+            batch = self.take()
+            if not batch:
+                return 0
+            details = None
+            started = time.perf_counter()
+            try:
+                self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as err:
+                details = err.details
+            except PyMongoError as err:
+                self.restore(batch, err)
+                return 0
+            return self.written(batch, details, time.perf_counter() - started)
+
+    def forget(self, tweets):
+        '''
+        Takes tweets out of the recent-ID set (call with self.lock held)
+        '''
+        for tweet in tweets:
+            self.recent.pop(tweet['tweet_ID'], None)
+
+    def restore(self, batch, error):
+        '''
+        Puts a batch that could not be written back in front of the buffer,
+        dropping the oldest tweets past MAX_BUFFER
+        '''
+        with self.lock:
+            self.buffer[:0] = batch
+            dropped = self.buffer[:max(0, len(self.buffer) - MAX_BUFFER)]
+            del self.buffer[:len(dropped)]
+            self.forget(dropped)
+            self.counters['requeued'] += len(batch)
+            self.counters['dropped'] += len(dropped)
+        logging.critical('--- Could not write %s tweets (%r), retrying with the next flush; '
+                         '%s dropped ---', len(batch), error, len(dropped))
+
+    def written(self, batch, details, seconds):
+        '''
+        Counts a flushed batch; details are the BulkWriteError's, if insert_many raised one
+        Returns the number of tweets inserted
+        '''
+        inserted = len(batch)
+        errors = []
+        if details is not None:
+            errors = details.get('writeErrors', [])
+            duplicates = sum(1 for error in errors if error.get('code') == DUPLICATE_KEY)
+            inserted = details.get('nInserted', inserted - len(errors))
+            with self.lock:
+                self.counters['duplicates'] += duplicates
+                self.forget(batch[error['index']] for error in errors
+                            if error.get('code') != DUPLICATE_KEY)
+            if duplicates != len(errors):
+                logging.critical('--- %s tweets failed to insert: %s ---',
+                                 len(errors) - duplicates, errors[0].get('errmsg'))
+        FLUSH_SECONDS.observe(seconds)
+        self.count_politicians(batch, errors)
+        with self.lock:
+            self.counters['inserted'] += inserted
+            self.counters['flushes'] += 1
+        logging.debug('--- Logged %s tweets ---', inserted)
+        return inserted
+
+    def count_politicians(self, batch, errors):
+        '''
+        Updates the per-politician metrics for a flushed batch
+        errors are insert_many's writeErrors (their index points into batch)
+        '''
+        stored = Counter(tweet['politician'] for tweet in batch)
+        for error in errors:
+            politician = batch[error['index']]['politician']
+            stored[politician] -= 1
+            if error.get('code') == DUPLICATE_KEY:
+                TWEETS_DEDUPED.inc(politician=politician, stage='index')
+        for politician, count in stored.items():
+            TWEETS_STORED.inc(count, politician=politician)
+
+    def close(self):
+        '''
+        Stops the timer and writes out anything still buffered
+        '''
+        self.stopped.set()
+        if self.timer is not None:
+            self.timer.join()
+            self.timer = None
+        self.flush()
+
+    def stats(self):
+        '''
+        Returns write counters plus the current buffer size
+        '''
+        with self.lock:
+            stats = dict(self.counters)
+            stats['buffered'] = len(self.buffer)
+        return stats
+
+    def log_stats(self):
+        '''
+        Logs the counters
+        '''
+        logging.critical('--- Mongo writer: %s ---', self.stats())
@@ -0,0 +1,285 @@
+'''
+Decides which politician to stream next, for how long, and when.
+
+QuotaScheduler keeps a rolling PERIOD of collected-tweet counts per
+politician and an estimate of each politician's tweet rate (tweets per
+streamed second). Each window goes to the politician furthest behind its
+quota. The window is sized to close that gap at the estimated rate, within
+the streaming budget (stream seconds per PERIOD). MIN_RUNTIME only applies
+while it doesn't overshoot the gap: a busy politician close to its quota
+gets a shorter window. When every quota is met, the next window waits
+until enough tweets have rolled out of the period for one second of
+streaming and is sized to what rolled out. A politician's first window is
+at most MIN_RUNTIME long, since its rate is only a guess (DEFAULT_RATE)
+until then.
+
+In 'combined' mode a single stream tracks every politician's terms and
+KeywordRouter assigns each tweet to a politician in-process. A tweet goes
+to the matching politician furthest behind quota among those still under
+it, or to the least-filled match when every match is at quota: tweets
+already received are never thrown away, the quotas only size the windows.
+
+The counts and rate estimates live in process memory only: after a
+restart every politician starts from zero collected tweets (and
+DEFAULT_RATE), so the first PERIOD can go over quota by what was collected
+before the restart.
+
+The clock is injectable: SimulatedClock lets scheduling decisions be
+replayed offline (see benchmarks/simulate_scheduler.py).
+'''
+import random
+import re
+import threading
+import time
+from collections import deque
+
+PERIOD = 60 * 60
+QUOTAS = {'joebiden': 600, 'kamalaharris': 600, 'donaldtrump': 600, 'mikepence': 600}
+STREAM_BUDGET = 12 * 60
+MIN_RUNTIME = 30
+MAX_RUNTIME = 180
+MIN_PAUSE = 60
+RUNTIME_JITTER = 10
+DEFAULT_RATE = 5.0
+RATE_SMOOTHING = 0.3
+
+WORDS = re.compile(r'\w+')
+
+
+class SystemClock():
+    '''
+    Wall-clock time
+    '''
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SimulatedClock():
+    '''
+    Virtual time for offline runs: sleep() just moves the clock forward
+    '''
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class KeywordRouter():
+    '''
+    Maps tweet text to politicians using Twitter's track semantics:
+    a phrase matches if all of its words appear in the text, in any order
+    '''
+
+    def __init__(self, searchterms):
+        self.phrases = [(terms[1], [set(phrase.casefold().split()) for phrase in terms])
+                        for terms in searchterms]
+
+    def match(self, text):
+        '''
+        Returns the politicians whose terms match text, in SEARCHTERMS order
+        '''
+        words = set(WORDS.findall(text.casefold()))
+        return [politician for politician, phrases in self.phrases
+                if any(phrase <= words for phrase in phrases)]
+
+
+class QuotaScheduler():
+    '''
+    Plans stream windows to fill per-politician quotas within a streaming budget.
+    record() is thread-safe; it is called from the ingest workers.
+    Counts are kept in memory and reset on restart.
+    '''
+
+    def __init__(self, searchterms, quotas=QUOTAS, budget=STREAM_BUDGET, period=PERIOD,
+                 clock=None, seed=None):
+        self.searchterms = {terms[1]: terms for terms in searchterms}
+        self.router = KeywordRouter(searchterms)
+        self.quotas = quotas
+        self.budget = budget
+        self.period = period
+        self.clock = clock or SystemClock()
+        self.random = random.Random(seed)
+        self.rates = {politician: DEFAULT_RATE for politician in self.searchterms}
+        # politicians whose rate has been observed at least once
+        self.measured = set()
+        self.events = deque()     # (time, politician, count)
+        self.counts = dict.fromkeys(self.searchterms, 0)
+        self.windows = deque()    # (start, end)
+        self.last_end = None
+        self.lock = threading.Lock()
+
+    def record(self, politician, count=1):
+        '''
+        Counts collected tweets for a politician
+        '''
+        with self.lock:
+            self.events.append((self.clock.time(), politician, count))
+            self.counts[politician] = self.counts.get(politician, 0) + count
+
+    def trim(self, now):
+        '''
+        Forgets events and windows older than the rolling period
+        '''
+        with self.lock:
+            while self.events and self.events[0][0] <= now - self.period:
+                _, politician, count = self.events.popleft()
+                self.counts[politician] -= count
+        while self.windows and self.windows[0][1] <= now - self.period:
+            self.windows.popleft()
+
+    def collected(self, since=None):
+        '''
+        Returns tweets collected per politician in the period (or since a time)
+        '''
+        with self.lock:
+            if since is None:
+                return dict(self.counts)
+            counts = dict.fromkeys(self.searchterms, 0)
+            for when, politician, count in reversed(self.events):
+                if when < since:
+                    break
+                counts[politician] = counts.get(politician, 0) + count
+        return counts
+
+    def deficit_at(self, politician, when):
+        '''
+        Tweets still missing from a politician's quota at time when,
+        counting only what is collected by now and not rolled out by then
+        '''
+        with self.lock:
+            collected = sum(count for time, name, count in self.events
+                            if name == politician and time > when - self.period)
+        return self.quotas.get(politician, 0) - collected
+
+    def fill(self, politician, counts):
+        '''
+        Share of the quota already collected
+        '''
+        return counts[politician] / max(self.quotas.get(politician, 1), 1)
+
+    def budget_left(self, now):
+        '''
+        Stream seconds still available in the rolling period
+        '''
+        used = sum(min(end, now) - max(start, now - self.period) for start, end in self.windows)
+        return self.budget - used
+
+    def wait_time(self, now, runtime):
+        '''
+        Seconds to wait before a window of runtime seconds fits the budget
+        and the minimum pause between connections
+        '''
+        wait = 0.0
+        if self.last_end is not None:
+            wait = max(wait, MIN_PAUSE - (now - self.last_end))
+        left = self.budget_left(now)
+        for start, end in self.windows:
+            if left >= runtime:
+                break
+            # budget comes back as old windows roll out of the period
+            wait = max(wait, end + self.period - now)
+            left += end - start
+        return max(wait, 0.0)
+
+    def next_window(self):
+        '''
+        Returns (politician, runtime, wait): stream politician for runtime seconds
+        after sleeping wait seconds. politician is None in combined mode.
+        '''
+        now = self.clock.time()
+        self.trim(now)
+        counts = self.collected()
+        politician = min(self.searchterms, key=lambda name: self.fill(name, counts))
+        rate = max(self.rates[politician], 0.01)
+        deficit = self.quotas.get(politician, 0) - counts[politician]
+        if deficit <= 0:
+            # every quota is met: wait until a second's worth of tweets has rolled out
+            return politician, 1, self.saturated_wait(politician, now, rate)
+        runtime = deficit / rate
+        jittered = runtime - self.random.randint(0, RUNTIME_JITTER)
+        runtime = min(max(jittered, min(MIN_RUNTIME, runtime)), MAX_RUNTIME)
+        if politician not in self.measured:
+            # DEFAULT_RATE is a guess: a short first window measures the rate
+            runtime = min(runtime, MIN_RUNTIME)
+        runtime = max(int(runtime), 1)
+        return politician, runtime, self.wait_time(now, runtime)
+
+    def saturated_wait(self, politician, now, rate):
+        '''
+        Seconds until politician's quota has room for one second of streaming
+        (at least MIN_PAUSE)
+        '''
+        deficit = self.deficit_at(politician, now)
+        when = now
+        with self.lock:
+            for time, name, count in self.events:
+                if deficit >= rate:
+                    break
+                if name == politician:
+                    deficit += count
+                    when = time + self.period
+        return max(when - now, MIN_PAUSE)
+
+    def next_combined_window(self):
+        '''
+        Like next_window, but sized for one stream covering every politician
+        '''
+        politician, runtime, wait = self.next_window()
+        counts = self.collected()
+        combined_rate = max(sum(self.rates.values()), 0.01)
+        deficits = sum(max(self.quotas.get(name, 0) - counts[name], 0) for name in self.searchterms)
+        if deficits > 0:
+            runtime = int(min(max(deficits / combined_rate, MIN_RUNTIME), MAX_RUNTIME))
+            wait = self.wait_time(self.clock.time(), runtime)
+        return None, runtime, wait
+
+    def end_window(self, politician, start, end):
+        '''
+        Books a finished window against the budget and updates rate estimates
+        '''
+        self.windows.append((start, end))
+        self.last_end = end
+        seconds = max(end - start, 1)
+        counts = self.collected(since=start)
+        politicians = self.searchterms if politician is None else [politician]
+        for name in politicians:
+            observed = counts[name] / seconds
+            if name not in self.measured:
+                # the first observation replaces the DEFAULT_RATE guess
+                self.rates[name] = observed
+                self.measured.add(name)
+            else:
+                self.rates[name] = ((1 - RATE_SMOOTHING) * self.rates[name]
+                                    + RATE_SMOOTHING * observed)
+
+    def route(self, text):
+        '''
+        Picks the politician a combined-stream tweet is filed under:
+        of the matching politicians still under quota, the one furthest behind,
+        else (every match at quota) the least-filled match.
+        Returns None only if nothing matches.
+        '''
+        matches = self.router.match(text)
+        if not matches:
+            return None
+        counts = self.collected()
+        under_quota = [name for name in matches
+                       if counts.get(name, 0) < self.quotas.get(name, 0)]
+        return min(under_quota or matches, key=lambda name: self.fill(name, counts))
+
+    def track(self, politician):
+        '''
+        Returns the track= terms for a window
+        '''
+        if politician is None:
+            return [term for terms in self.searchterms.values() for term in terms]
+        return self.searchterms[politician]